@@ -124,6 +124,43 @@ DATABASES_SQLITE = {
 
 DATABASES = DATABASES_POSTGRES if MODE is PROD else DATABASES_SQLITE
 
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# TEMPLATE_DOCUMENT_CACHE holds the version counters the cached template documents
+# and the per process snap indexes (UpTemplateAPI.snapping) are checked against.
+# The local-memory backend below is per process, so it only fits a single worker:
+# with several workers it must be a shared backend (Redis, Memcached), otherwise
+# the other workers never see a bump and keep serving stale documents and guides.
+
+TEMPLATE_DOCUMENT_CACHE = 'template_documents'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    TEMPLATE_DOCUMENT_CACHE: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template-documents',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'CULL_FREQUENCY': 4,
+        }
+    }
+}
+
+# Number of entries kept per template by the compact_changes command,
+# clients behind the compacted revision are told to reload the whole template
+TEMPLATE_CHANGES_RETENTION = 1000
+
+
+# Realtime editing (UpTemplateAPI.realtime), the in-process backend only reaches
+# the editors connected to the same ASGI process
+REALTIME_BROADCAST_BACKEND = 'UpTemplateAPI.realtime.InProcessBroadcast'
+REALTIME_FLUSH_INTERVAL = 0.25
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -162,6 +199,59 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Media files are served by UpTemplateAPI.serving.serve_media. Behind nginx set
+# MEDIA_SENDFILE = 'x-accel-redirect' with an internal location for
+# MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT ('x-sendfile' for Apache / lighttpd)
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+MEDIA_CACHE_MAX_AGE = 60 * 60
+
+# Resized / re-encoded images served by /api/medias/<id>/render/ and template
+# exports (/api/templates/<id>/export/), least recently
+# used ones are dropped once the directory grows over the budget
+MEDIA_DERIVATIVES_ROOT = BASE_DIR / 'media_derivatives'
+MEDIA_DERIVATIVES_MAX_BYTES = 256 * 1024 * 1024
+MEDIA_RENDER_MAX_WIDTH = 4096
+
+# PNG template exports are at most MEDIA_RENDER_MAX_WIDTH pixels per side and
+# EXPORT_MAX_PIXELS pixels. Text is drawn with the fonts of EXPORT_FONTS, font
+# family: file under EXPORT_FONTS_ROOT, other families with the default font
+EXPORT_MAX_PIXELS = 8 * 1024 * 1024
+EXPORT_FONTS_ROOT = BASE_DIR / 'fonts'
+EXPORT_FONTS = {}
+
+# Chunked uploads (/api/uploads/), part files of sessions untouched for
+# UPLOAD_SESSION_EXPIRY seconds are removed by the collect_upload_sessions command
+UPLOAD_SESSIONS_ROOT = BASE_DIR / 'upload_sessions'
+UPLOAD_SESSION_EXPIRY = 24 * 60 * 60
+UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+UPLOAD_MAX_BYTES = 100 * 1024 * 1024
+
+# Batch exports (/api/jobs/), run by a pool of EXPORT_JOB_WORKERS processes (None
+# for the CPU count), EXPORT_JOBS_PER_USER at a time per user. Finished jobs are
+# removed after EXPORT_JOB_EXPIRY seconds by the collect_export_jobs command
+EXPORT_JOB_WORKERS = None
+EXPORT_JOBS_PER_USER = 2
+EXPORT_JOB_MAX_TARGETS = 1000
+EXPORT_JOB_TIMEOUT = 60 * 60
+EXPORT_JOB_START_TIMEOUT = 24 * 60 * 60
+EXPORT_JOB_EXPIRY = 7 * 24 * 60 * 60
+EXPORT_JOBS_EAGER = False
+# Zip artifacts of the jobs, outside MEDIA_ROOT since /media/ is public
+EXPORT_ARTIFACTS_ROOT = BASE_DIR / 'export_artifacts'
+
+# Spatial index of row stored shapes (?bbox= filter and hit tests), a grid of
+# SPATIAL_LEVELS levels of cells from SPATIAL_CELL_SIZE canvas units, doubling
+# at each level. Rebuilt with the index_shapes command
+SPATIAL_CELL_SIZE = 512
+SPATIAL_LEVELS = 8
+
+# Snapping guides: ?tolerance= of the snap endpoint by default and at most, in
+# canvas units, and the layouts whose sorted edges each process keeps
+SNAP_DEFAULT_TOLERANCE = 5
+SNAP_MAX_TOLERANCE = 100
+SNAP_INDEX_LAYOUTS = 128
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -5,6 +5,9 @@ class UptemplateapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'UpTemplateAPI'
     content_types = {}
+
+    def ready(self):
+        from . import signals
     
 
         
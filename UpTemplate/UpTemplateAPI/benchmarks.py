@@ -0,0 +1,142 @@
+"""
+Microbenchmarks of the serialization and bulk write hot paths.
+
+    python manage.py benchmark <name> [--count N] [--repeat R]
+
+Each benchmark returns {label: callable}; the command times every callable on
+the same input and reports the cost per shape. Rows created by a benchmark are
+rolled back once it is done.
+"""
+import re
+from django.contrib.auth.models import User
+from .bulk import bulk_create_shapes, bulk_update_shapes
+from .clones import clone_template
+from .encoders import encode_shapes
+from .models import Template, Layout, Shape, ShapeBox, Rectangle, Circle, Text, Media, MediaContent
+from .serializers import ShapeSerializer, dict_keys_snake_to_camel
+from .snapping import AXIS_EDGES, EdgeIndex, candidate_order, edge_coordinates
+from .utils import camel_to_snake, snake_to_camel_list, camel_to_snake_list
+
+
+def regex_snake_to_camel(d):
+    return {
+        re.sub(r'_([a-zA-Z])', lambda x: x.group(1).upper(), k) if k != "_id" else k: v
+        for k, v in d.items()
+    }
+
+
+def regex_camel_to_snake(d):
+    return {re.sub(r'(?<!^)(?=[A-Z])', '_', k).lower(): v for k, v in d.items()}
+
+
+def sample_shape_representations(count):
+    """Flattened shape representations as ShapeSerializer builds them before the key translation."""
+    shapes = []
+    for i in range(count):
+        model = (Rectangle, Circle, Text, Media)[i % 4]
+        fields = [field.name for field in (*Shape._meta.concrete_fields, *model._meta.concrete_fields)]
+        shapes.append({name: i for name in fields if name not in ("content_type", "shape_id", "layout")})
+    return shapes
+
+
+def key_case(count):
+    snake_shapes = sample_shape_representations(count)
+    camel_shapes = [regex_snake_to_camel(shape) for shape in snake_shapes]
+    assert [dict_keys_snake_to_camel(shape) for shape in snake_shapes] == camel_shapes
+    assert [camel_to_snake(shape) for shape in camel_shapes] == [regex_camel_to_snake(shape) for shape in camel_shapes]
+
+    return {
+        "snake_to_camel regex": lambda: [regex_snake_to_camel(shape) for shape in snake_shapes],
+        "snake_to_camel tables": lambda: [dict_keys_snake_to_camel(shape) for shape in snake_shapes],
+        "snake_to_camel list": lambda: snake_to_camel_list(snake_shapes),
+        "camel_to_snake regex": lambda: [regex_camel_to_snake(shape) for shape in camel_shapes],
+        "camel_to_snake tables": lambda: [camel_to_snake(shape) for shape in camel_shapes],
+        "camel_to_snake list": lambda: camel_to_snake_list(camel_shapes),
+    }
+
+
+def create_sample_layout(count):
+    """A layout holding count shapes, cycling through the shape types."""
+    user = User.objects.create_user(username="benchmark")
+    layout = Layout.objects.create(template=Template.objects.create(user=user, name="benchmark"))
+    media_content = MediaContent.objects.create(user=user, content="src/benchmark.png")
+    payloads = [
+        {"type": "Rect", "width": 10, "height": 20, "fill": "red"},
+        {"type": "Circle", "radius": 5, "shadowOffsetX": 2},
+        {"type": "Text", "fontFamily": "Arial", "fontSize": 12, "text": "text"},
+        {"type": "Image", "width": 30, "height": 40, "mediaContent": media_content.id},
+    ]
+    _, errors = bulk_create_shapes(layout, [{**payloads[i % 4], "x": i} for i in range(count)])
+    assert not errors, errors
+    return layout
+
+
+def shape_encoding(count):
+    shapes = Shape.objects.filter(layout=create_sample_layout(count).id)
+    assert encode_shapes(shapes) == ShapeSerializer(instance=shapes, many=True).data
+
+    return {
+        "ShapeSerializer": lambda: ShapeSerializer(instance=shapes, many=True).data,
+        "encoder": lambda: encode_shapes(shapes),
+    }
+
+
+def template_clone(count):
+    layout = create_sample_layout(count)
+
+    return {
+        "clone_template": lambda: clone_template(layout.template, layout.template.user),
+    }
+
+
+def scan_candidates(boxes, box, tolerance, exclude=()):
+    """EdgeIndex.candidates by a scan of every box, as the editor did on every drag tick."""
+    result = {}
+    for axis in (0, 1):
+        candidates = []
+        for shape_id, other in boxes.items():
+            if shape_id in exclude:
+                continue
+            for edge, value in enumerate(edge_coordinates(box, axis)):
+                for target_edge, coordinate in enumerate(edge_coordinates(other, axis)):
+                    if abs(coordinate - value) <= tolerance:
+                        candidates.append({
+                            "edge": AXIS_EDGES[axis][edge], "shape": shape_id, "targetEdge": AXIS_EDGES[axis][target_edge],
+                            "position": coordinate, "offset": coordinate - value,
+                        })
+        result["xy"[axis]] = sorted(candidates, key=candidate_order)
+    return result
+
+
+def snapping(count):
+    """Snap candidates of 100 drag ticks, and moving one shape in the index. Try --count 10000."""
+    layout = create_sample_layout(count)
+    shape_ids = list(Shape.objects.filter(layout=layout.id).order_by("_id").values_list("_id", flat=True))
+    # Spread the shapes over a 4000 x 3000 layout
+    _, errors = bulk_update_shapes(layout, [
+        {"id": shape_id, "x": index * 37 % 4000, "y": index * 91 % 3000} for index, shape_id in enumerate(shape_ids)
+    ])
+    assert not errors, errors
+
+    boxes = {row[0]: row[1:] for row in ShapeBox.objects.filter(layout=layout.id).values_list("shape", "x0", "y0", "x1", "y1")}
+    index = EdgeIndex(boxes, 0)
+    dragged = shape_ids[0]
+    ticks = [(x, x * 0.75, x + 25, x * 0.75 + 30) for x in range(0, 4000, 40)]
+    for box in ticks[:10]:
+        assert index.candidates(box, 5, [dragged]) == scan_candidates(boxes, box, 5, [dragged])
+
+    moves = ((x % 4000, 0, x % 4000 + 10, 20) for x in range(0, 10 ** 9, 13))
+    return {
+        "scan": lambda: [scan_candidates(boxes, box, 5, [dragged]) for box in ticks],
+        "EdgeIndex build": lambda: EdgeIndex(boxes, 0),
+        "EdgeIndex candidates": lambda: [index.candidates(box, 5, [dragged]) for box in ticks],
+        "EdgeIndex move one shape": lambda: index.update({dragged: next(moves)}),
+    }
+
+
+BENCHMARKS = {
+    "key_case": key_case,
+    "shape_encoding": shape_encoding,
+    "template_clone": template_clone,
+    "snapping": snapping,
+}
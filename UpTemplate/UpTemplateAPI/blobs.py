@@ -0,0 +1,144 @@
+"""
+Content addressed storage of uploaded media.
+
+Each distinct file is stored once, as a MediaBlob named after its sha256
+(blobs/ab/cd/abcd....png). MediaContent.content points at the blob file so
+URLs, derivatives and manifests keep working on the shared file, and
+MediaBlob.references counts the MediaContent rows using it.
+
+A blob file is written before the transaction creating its row commits, files
+left without a row by a rollback are deleted by collect_blobs once older than
+ORPHAN_BLOB_AGE seconds.
+"""
+import hashlib
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import MediaBlob, MediaContent
+
+ORPHAN_BLOB_AGE = getattr(settings, "ORPHAN_BLOB_AGE", 24 * 60 * 60)
+BLOBS_ROOT = "blobs"
+
+
+def file_digest(file):
+    """(size, sha256 hex digest) of a Django File, read in chunks. Files open on entry are left open."""
+    digest = hashlib.sha256()
+    size = 0
+    was_closed = file.closed
+    try:
+        for chunk in file.chunks():
+            digest.update(chunk)
+            size += len(chunk)
+    finally:
+        if was_closed:
+            file.close()
+    return size, digest.hexdigest()
+
+
+def blob_name(sha256, original_name):
+    extension = os.path.splitext(original_name or "")[1].lower()
+    return f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+
+def acquire_blob(file, size=None, sha256=None):
+    """
+    Blob holding the content of file with one more reference, the file is only written
+    when no blob has this content yet. size / sha256 skip hashing when already known.
+    """
+    was_closed = file.closed
+    if was_closed:
+        file.open("rb")
+    try:
+        if sha256 is None:
+            size, sha256 = file_digest(file)
+
+        while True:
+            blob = MediaBlob.objects.filter(sha256=sha256).first()
+            if blob is None:
+                name = default_storage.save(blob_name(sha256, file.name), file)
+                try:
+                    with transaction.atomic():
+                        # Created referenced, collect_blobs never sees it unreferenced
+                        return MediaBlob.objects.create(sha256=sha256, file=name, size=size, references=1)
+                except IntegrityError:
+                    # Stored concurrently by another upload of the same content
+                    default_storage.delete(name)
+                    continue
+
+            # Counted only if the blob still exists: collect_blobs deletes it under a row lock once
+            # unreferenced, which this update waits for. Looked up again when it was collected
+            if MediaBlob.objects.filter(pk=blob.pk).update(references=F("references") + 1):
+                return blob
+    finally:
+        if was_closed:
+            file.close()
+
+
+def release_blob(blob_id):
+    if blob_id is not None:
+        MediaBlob.objects.filter(pk=blob_id, references__gt=0).update(references=F("references") - 1)
+
+
+def collect_blobs(max_age=None):
+    """
+    Delete the blobs no MediaContent references anymore and the blob files without a
+    MediaBlob untouched for max_age seconds, returns how many were deleted.
+    Each blob is locked and checked again before its deletion, see acquire_blob.
+    """
+    deleted = 0
+    for blob_id in MediaBlob.objects.filter(references=0).values_list("id", flat=True):
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(pk=blob_id, references=0).first()
+            # Checked again under the lock, an upload may have acquired it since
+            if blob is None or MediaContent.objects.filter(blob=blob_id).exists():
+                continue
+            name = blob.file.name
+            blob.delete()
+            transaction.on_commit(lambda name=name: default_storage.delete(name))
+        deleted += 1
+    return deleted + collect_orphan_files(max_age)
+
+
+def collect_orphan_files(max_age=None):
+    # Files younger than max_age may belong to a transaction still creating their blob
+    written_before = timezone.now() - timedelta(seconds=ORPHAN_BLOB_AGE if max_age is None else max_age)
+    orphans = 0
+    for names in stored_blob_names():
+        stored = set(MediaBlob.objects.filter(file__in=names).values_list("file", flat=True))
+        for name in names:
+            if name not in stored and default_storage.get_modified_time(name) < written_before:
+                default_storage.delete(name)
+                orphans += 1
+    return orphans
+
+
+def stored_blob_names(directory=BLOBS_ROOT):
+    """Names of the files stored under directory, one list per directory."""
+    if not default_storage.exists(directory):
+        return
+    directories, files = default_storage.listdir(directory)
+    if files:
+        yield [f"{directory}/{name}" for name in files]
+    for name in directories:
+        yield from stored_blob_names(f"{directory}/{name}")
+
+
+def adopt_legacy_media():
+    """Move the media contents uploaded before blobs onto blobs, dropping duplicate files. Returns how many moved."""
+    adopted = 0
+    for media_content in MediaContent.objects.filter(blob__isnull=True).exclude(content="").exclude(content__isnull=True):
+        legacy_name = media_content.content.name
+        if not default_storage.exists(legacy_name):
+            continue
+
+        with transaction.atomic():
+            blob = acquire_blob(media_content.content)
+            MediaContent.objects.filter(pk=media_content.pk).update(blob=blob, content=blob.file.name)
+        if legacy_name != blob.file.name:
+            default_storage.delete(legacy_name)
+        adopted += 1
+    return adopted
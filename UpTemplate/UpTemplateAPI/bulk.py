@@ -0,0 +1,154 @@
+from django.db import transaction
+from .models import Shape, TemplateChange
+from .ranks import ranks_after
+from .serializers import CLASSNAME_TO_MODELS, ShapeBulkSerializer, ShapeTransformSerializer
+from .signals import touch_template
+from .spatial import index_new_shapes, move_boxes, with_boxes
+from .utils import camel_to_snake, camel_to_snake_list
+
+
+def split_shape_payload(item):
+    """Split one camelCase shape payload into (type, concrete object data, Shape data)."""
+    shape_data = camel_to_snake(item)
+    shape_type = shape_data.pop('type', None)
+    model_data = CLASSNAME_TO_MODELS.get(shape_type, None)
+    if not model_data:
+        return shape_type, None, shape_data
+
+    object_data = {field: shape_data.pop(field, None) for field in model_data["fields"]}
+    if "draggable" in shape_data:
+        shape_data["draggable"] = str(shape_data["draggable"])
+    return shape_type, object_data, shape_data
+
+
+def list_errors(errors):
+    """(index, errors) pairs of a ListSerializer, whose errors are a list or an {index: errors} dict."""
+    pairs = errors.items() if isinstance(errors, dict) else enumerate(errors)
+    return [(index, item_errors) for index, item_errors in pairs if isinstance(index, int) and item_errors]
+
+
+def validate_shape_payloads(items):
+    """
+    Validate a list of mixed-type shape payloads in one pass.
+    Returns ([(type, object data, Shape data)] in input order, None) or (None, per item errors).
+    """
+    errors = [{} for _ in items]
+    indexes_by_type = {}
+    shape_payloads = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = {"non_field_errors": ["Expected a shape object."]}
+            shape_payloads.append({})
+            continue
+
+        shape_type, object_data, shape_data = split_shape_payload(item)
+        shape_payloads.append(shape_data)
+        if object_data is None:
+            errors[index] = {"type": [f"Unknown shape type {shape_type!r}."]}
+            continue
+        indexes_by_type.setdefault(shape_type, []).append((index, object_data))
+
+    shape_serializer = ShapeBulkSerializer(data=shape_payloads, many=True)
+    if not shape_serializer.is_valid():
+        for index, item_errors in list_errors(shape_serializer.errors):
+            errors[index].update(item_errors)
+
+    object_serializers = {}
+    for shape_type, entries in indexes_by_type.items():
+        serializer = CLASSNAME_TO_MODELS[shape_type]["serializer"](data=[data for _, data in entries], many=True)
+        object_serializers[shape_type] = serializer
+        if not serializer.is_valid():
+            for entry_index, item_errors in list_errors(serializer.errors):
+                errors[entries[entry_index][0]].update(item_errors)
+
+    if any(errors):
+        return None, errors
+
+    validated = [None] * len(items)
+    for shape_type, entries in indexes_by_type.items():
+        for (index, _), object_data in zip(entries, object_serializers[shape_type].validated_data):
+            validated[index] = (shape_type, object_data, shape_serializer.validated_data[index])
+    return validated, None
+
+
+def bulk_create_shapes(layout, items):
+    """
+    Validate a list of mixed-type shape payloads in one pass, then insert every concrete
+    object and every Shape with one bulk_create per table inside a single transaction.
+    The shapes are stacked on top of the layout, in input order.
+    Returns (shapes in input order, None) or (None, per item errors).
+    """
+    validated, errors = validate_shape_payloads(items)
+    if errors:
+        return None, errors
+
+    indexes_by_type = {}
+    for index, (shape_type, _, _) in enumerate(validated):
+        indexes_by_type.setdefault(shape_type, []).append(index)
+
+    shapes, objects = [None] * len(items), [None] * len(items)
+    with transaction.atomic():
+        for shape_type, indexes in indexes_by_type.items():
+            model_data = CLASSNAME_TO_MODELS[shape_type]
+            created = model_data["model"].objects.bulk_create(
+                [model_data["model"](**validated[index][1]) for index in indexes]
+            )
+            for index, obj in zip(indexes, created):
+                objects[index] = obj
+                shapes[index] = Shape(
+                    layout_id=layout.id,
+                    content_type_id=model_data["content_type"],
+                    shape_id=obj.id,
+                    **validated[index][2]
+                )
+
+        top_rank = Shape.objects.filter(layout=layout.id).order_by("-z_rank").values_list("z_rank", flat=True).first()
+        for shape, rank in zip(shapes, ranks_after(top_rank, len(shapes))):
+            shape.z_rank = rank
+
+        shapes = Shape.objects.bulk_create(shapes)
+        # bulk_create bypasses the post_save receivers
+        index_new_shapes(shapes, objects)
+        touch_template(layout.template_id, TemplateChange.SHAPE, TemplateChange.CREATE, [shape.pk for shape in shapes], layout.id)
+
+    return shapes, None
+
+
+def validate_shape_updates(items, serializer_class=ShapeTransformSerializer):
+    """Returns ({shape id: fields}, updatable columns, None) or (None, None, errors)."""
+    serializer = serializer_class(data=camel_to_snake_list(items), many=True)
+    if not serializer.is_valid():
+        return None, None, serializer.errors
+
+    fields = [name for name in serializer.child.fields if name != "id"]
+    return {update.pop("id"): update for update in serializer.validated_data}, fields, None
+
+
+def bulk_update_shapes(layout, items, serializer_class=ShapeTransformSerializer, ignore_unknown=False):
+    """
+    Apply a list of {id, ...fields} updates to the shapes of a layout with a single bulk_update
+    of the columns declared by serializer_class (transform columns by default).
+    Returns (updated shape ids, None) or (None, errors).
+    """
+    updates, fields, errors = validate_shape_updates(items, serializer_class)
+    if errors:
+        return None, errors
+
+    with transaction.atomic():
+        shapes = list(with_boxes(Shape.objects.filter(layout=layout.id, pk__in=updates.keys()), ["_id", *fields]))
+        unknown_ids = updates.keys() - {shape.pk for shape in shapes}
+        if unknown_ids and not ignore_unknown:
+            return None, {"id": [f"Unknown shape {shape_id} in layout {layout.id}." for shape_id in sorted(unknown_ids)]}
+
+        for shape in shapes:
+            for field, value in updates[shape.pk].items():
+                setattr(shape, field, value)
+
+        updated = [shape.pk for shape in shapes]
+        if updated:
+            Shape.objects.bulk_update(shapes, fields)
+            # bulk_update bypasses the post_save receivers
+            move_boxes(shapes)
+            touch_template(layout.template_id, TemplateChange.SHAPE, TemplateChange.UPDATE, updated, layout.id)
+
+    return [shape_id for shape_id in updates if shape_id not in unknown_ids], None
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.cache import caches
+import time
+
+
+TEMPLATE_DOCUMENT_CACHE = getattr(settings, "TEMPLATE_DOCUMENT_CACHE", "template_documents")
+
+
+def get_template_cache():
+    return caches[TEMPLATE_DOCUMENT_CACHE]
+
+
+def template_version_key(template_id):
+    return f"template:{template_id}:version"
+
+
+def template_document_key(template_id, version):
+    return f"template:{template_id}:document:{version}"
+
+
+def layout_boxes_version_key(layout_id):
+    return f"layout:{layout_id}:boxes:version"
+
+
+def get_version(key):
+    cache = get_template_cache()
+    version = cache.get(key)
+    if version is None:
+        # A lost counter must never restart at a value that may still have a document cached,
+        # so it is seeded with a fresh timestamp instead of 0.
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    cache = get_template_cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+        return cache.get(key)
+
+
+def get_template_version(template_id):
+    return get_version(template_version_key(template_id))
+
+
+def bump_template_version(template_id):
+    return bump_version(template_version_key(template_id))
+
+
+def get_layout_boxes_version(layout_id):
+    """Version of the spatial boxes of a row stored layout, bumped by every committed box write."""
+    return get_version(layout_boxes_version_key(layout_id))
+
+
+def bump_layout_boxes_version(layout_id):
+    return bump_version(layout_boxes_version_key(layout_id))
+
+
+def get_cached_template_document(template_id):
+    """
+    Returns (version, document). document is None on a cache miss, in which case
+    it should be rendered and stored with set_cached_template_document under the same version.
+    """
+    version = get_template_version(template_id)
+    return version, get_template_cache().get(template_document_key(template_id, version))
+
+
+def set_cached_template_document(template_id, version, document):
+    get_template_cache().set(template_document_key(template_id, version), document)
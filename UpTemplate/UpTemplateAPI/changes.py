@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.db import transaction
+from .models import Template, Layout, Shape, TemplateChange
+from .serializers import ShapeSerializer, LayoutSerializer
+
+
+TEMPLATE_CHANGES_RETENTION = getattr(settings, "TEMPLATE_CHANGES_RETENTION", 1000)
+
+
+def collapse_changes(changes):
+    """
+    Keep one entry per changed object, in the order of its last change.
+    An object created inside the window stays a create unless it was deleted afterwards.
+    """
+    collapsed = {}
+    for change in changes:
+        key = (change.target, change.object_id)
+        previous = collapsed.pop(key, None)
+        if previous is not None and previous.action == TemplateChange.CREATE and change.action == TemplateChange.UPDATE:
+            change.action = TemplateChange.CREATE
+        collapsed[key] = change
+    return list(collapsed.values())
+
+
+def build_change_feed(template, since):
+    """
+    Everything that changed in a template after revision `since`.
+    Returns {"reload": True, ...} when the log no longer reaches back to `since`.
+    """
+    if since < template.compacted_revision:
+        return {"revision": template.revision, "reload": True, "changes": []}
+
+    changes = collapse_changes(TemplateChange.objects.filter(template=template.id, revision__gt=since).order_by("revision", "id"))
+    revision = max([template.revision] + [change.revision for change in changes])
+
+    upserted_ids = {
+        target: [change.object_id for change in changes if change.target == target and change.action != TemplateChange.DELETE]
+        for target in (TemplateChange.SHAPE, TemplateChange.LAYOUT)
+    }
+    shapes = {
+        shape["config"]["_id"]: shape
+        for shape in ShapeSerializer(instance=Shape.objects.filter(pk__in=upserted_ids[TemplateChange.SHAPE]), many=True).data
+    }
+    layouts = {
+        layout["id"]: layout
+        for layout in LayoutSerializer(instance=Layout.objects.filter(pk__in=upserted_ids[TemplateChange.LAYOUT]), many=True).data
+    }
+    objects = {
+        TemplateChange.SHAPE: shapes,
+        TemplateChange.LAYOUT: layouts,
+        TemplateChange.TEMPLATE: {template.id: {"name": template.name, "stage_width": template.width, "stage_height": template.height}},
+    }
+
+    feed = []
+    for change in changes:
+        entry = {"target": change.target, "action": change.action, "id": change.object_id, "layout": change.layout_id}
+        if change.action != TemplateChange.DELETE:
+            obj = objects[change.target].get(change.object_id)
+            if obj is None:
+                # Removed without a log entry, e.g. by a cascade
+                entry["action"] = TemplateChange.DELETE
+            else:
+                entry["object"] = obj
+        feed.append(entry)
+
+    return {"revision": revision, "reload": False, "changes": feed}
+
+
+def compact_changes(template_id, keep=TEMPLATE_CHANGES_RETENTION):
+    """Drop all but the newest `keep` change entries of a template, returns the number of dropped entries."""
+    threshold = (
+        TemplateChange.objects.filter(template=template_id)
+        .order_by("-revision", "-id")
+        .values_list("revision", flat=True)[keep:keep + 1]
+        .first()
+    )
+    if threshold is None:
+        return 0
+
+    with transaction.atomic():
+        # Whole revisions are dropped so a revision is never half in the log
+        deleted, _ = TemplateChange.objects.filter(template=template_id, revision__lte=threshold).delete()
+        Template.objects.filter(pk=template_id, compacted_revision__lt=threshold).update(compacted_revision=threshold)
+    return deleted
@@ -0,0 +1,114 @@
+"""
+Deep copies of templates and layouts.
+
+Each table is copied in bulk: the layouts and the concrete rows of each shape
+type with bulk_create, then the Shape rows pointing at the new concrete rows with
+multi row INSERTs, z-order ranks included, and their spatial index boxes. Media
+rows are copied but keep their MediaContent, so uploaded files are shared rather
+than duplicated.
+Document stored layouts carry their shapes in their own row and are copied as is.
+"""
+from django.db import connection, transaction
+from .models import Template, Layout, Shape, ShapeBox, TemplateChange
+from .serializers import CLASSNAME_TO_MODELS
+from .signals import touch_template
+from .snapping import boxes_changed
+from .storage import SHAPE_COLUMNS, object_fields
+
+
+SHAPE_COPY_FIELDS = [Shape._meta.get_field(name) for name in ('layout', 'content_type', 'shape_id')] + SHAPE_COLUMNS
+BOX_COPY_FIELDS = ShapeBox._meta.concrete_fields
+# Rows of multi row INSERTs, on top of the limit of the database on query parameters
+INSERT_BATCH_SIZE = 1000
+
+
+def insert_values(fields, rows):
+    """
+    INSERT rows of plain column values as values_list reads them, in order.
+    Skips the per value preparation of bulk_create, which dominates the cost of wide rows.
+    """
+    model = fields[0].model
+    quote_name = connection.ops.quote_name
+    columns = ", ".join(quote_name(field.column) for field in fields)
+    placeholders = "(" + ", ".join(["%s"] * len(fields)) + ")"
+    batch_size = min(INSERT_BATCH_SIZE, connection.ops.bulk_batch_size(fields, rows) or INSERT_BATCH_SIZE)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                f"INSERT INTO {quote_name(model._meta.db_table)} ({columns}) VALUES {', '.join([placeholders] * len(batch))}",
+                [value for row in batch for value in row]
+            )
+
+
+def copy_shape_rows(layout_map):
+    """Copy the shapes of the row stored layouts {source layout id: copy layout id}, returns {source shape id: copy id}."""
+    shapes = Shape.objects.filter(layout__in=layout_map.keys())
+
+    object_map = {}
+    for model_data in CLASSNAME_TO_MODELS.values():
+        model = model_data["model"]
+        attnames = [field.attname for field in object_fields(model)]
+        sources = list(
+            model.objects.filter(pk__in=shapes.filter(content_type=model_data["content_type"]).values("shape_id"))
+            .values_list("id", *attnames)
+        )
+        copies = model.objects.bulk_create([model(None, *source[1:]) for source in sources])
+        object_map.update({(model_data["content_type"], source[0]): copy.pk for source, copy in zip(sources, copies)})
+
+    sources = [
+        row for row in shapes.order_by("_id").values_list("_id", *[field.attname for field in SHAPE_COPY_FIELDS])
+        if (row[2], row[3]) in object_map
+    ]
+    insert_values(SHAPE_COPY_FIELDS, [
+        (layout_map[row[1]], row[2], object_map[(row[2], row[3])], *row[4:]) for row in sources
+    ])
+    # The copy layouts are new to this transaction, their shapes are these rows, numbered in insertion order
+    copy_ids = Shape.objects.filter(layout__in=layout_map.values()).order_by("_id").values_list("_id", flat=True)
+    return {row[0]: copy_id for row, copy_id in zip(sources, copy_ids)}
+
+
+def copy_shape_boxes(layout_map, id_map):
+    """Copy the spatial index boxes of the shapes copied by copy_shape_rows, they do not move."""
+    position = {field.name: index for index, field in enumerate(BOX_COPY_FIELDS)}
+    shape_index, layout_index = position['shape'], position['layout']
+
+    copies = []
+    for row in ShapeBox.objects.filter(layout__in=layout_map.keys()).values_list(*[field.attname for field in BOX_COPY_FIELDS]):
+        if row[shape_index] in id_map:
+            row = list(row)
+            row[shape_index], row[layout_index] = id_map[row[shape_index]], layout_map[row[layout_index]]
+            copies.append(row)
+    insert_values(BOX_COPY_FIELDS, copies)
+    # Inserted without model instances, the ids of the new layouts may have been used before
+    boxes_changed(dict.fromkeys(layout_map.values()))
+
+
+def clone_layouts(layouts, template_id):
+    """Copies of layouts and their shapes in the template template_id, in the same order."""
+    copies = Layout.objects.bulk_create([
+        Layout(template_id=template_id, storage=layout.storage, shapes_document=layout.shapes_document)
+        for layout in layouts
+    ])
+
+    layout_map = {layout.id: copy.id for layout, copy in zip(layouts, copies) if layout.storage == Layout.ROWS}
+    if layout_map:
+        copy_shape_boxes(layout_map, copy_shape_rows(layout_map))
+    return copies
+
+
+def clone_template(template, user, name=None):
+    """Copy of a template owned by user, with every layout and shape."""
+    with transaction.atomic():
+        copy = Template.objects.create(user=user, name=name or template.name, width=template.width, height=template.height)
+        copy.cloned_layouts = clone_layouts(list(Layout.objects.filter(template=template.id).order_by("id")), copy.id)
+    return copy
+
+
+def clone_layout(layout):
+    """Copy of a layout and its shapes, added to the same template."""
+    with transaction.atomic():
+        copy, = clone_layouts([layout], layout.template_id)
+        # bulk_create bypasses the post_save receivers
+        touch_template(layout.template_id, TemplateChange.LAYOUT, TemplateChange.CREATE, [copy.id], copy.id)
+    return copy
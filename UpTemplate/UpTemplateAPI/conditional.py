@@ -0,0 +1,47 @@
+from django.db.models import Count, Max, Sum
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from .models import Template
+
+
+def make_etag(*parts):
+    return quote_etag("-".join(str(part) for part in parts))
+
+
+def template_etag(template, *parts):
+    return make_etag("t", template.id, "r", template.revision, *parts)
+
+
+def template_list_etag(templates, *parts):
+    """Strong ETag of a template listing, changes when any template is created, deleted or revised."""
+    stamp = templates.aggregate(count=Count("id"), last_id=Max("id"), revisions=Sum("revision"), updated_at=Max("updated_at"))
+    updated_at = stamp["updated_at"].timestamp() if stamp["updated_at"] else 0
+    return make_etag("tl", stamp["count"], stamp["last_id"] or 0, stamp["revisions"] or 0, updated_at, *parts), stamp["updated_at"]
+
+
+def get_template_stamp(template_id, for_update=False):
+    templates = Template.objects.only("id", "revision", "updated_at")
+    return get_object_or_404(templates.select_for_update() if for_update else templates, pk=template_id)
+
+
+def timestamp(last_modified):
+    return int(last_modified.timestamp()) if last_modified else None
+
+
+def conditional_response(request, etag, last_modified=None):
+    """
+    Evaluate If-Match / If-None-Match / If-Modified-Since against the given validators.
+    Returns a 304 or 412 response, or None when the request should be processed.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp(last_modified))
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response.headers["ETag"] = etag
+    if last_modified:
+        response.headers["Last-Modified"] = http_date(timestamp(last_modified))
+    return response
@@ -0,0 +1,156 @@
+"""
+Read-only shape encoder.
+
+Builds the {"type": ..., "config": ...} representation of ShapeSerializer straight
+from values_list rows: one plan per shape type maps every selected column to its
+output key and converter, so no serializer or model instance is created per shape.
+ShapeSerializer stays the reference for writes and for the output format.
+"""
+from django.db import models
+from .models import Shape, MediaContent
+from .serializers import CLASSNAME_TO_MODELS, CONTENT_TYPE_TO_TYPE, MediaContentSerializer
+from .utils import snake_to_camel_key
+
+
+def identity(value):
+    return value
+
+
+def file_url(field):
+    storage = field.storage
+    return lambda name: storage.url(name) if name else None
+
+
+# Same conversions as the DRF fields ModelSerializer maps these model fields to
+CONVERTERS = {
+    models.FloatField: float,
+    models.IntegerField: int,
+    models.CharField: str,
+    models.TextField: str,
+}
+
+
+def column_converter(field):
+    if field.is_relation:
+        return identity
+    if isinstance(field, models.FileField):
+        return file_url(field)
+    for field_class, converter in CONVERTERS.items():
+        if isinstance(field, field_class):
+            return converter
+    return identity
+
+
+def serialized_fields(model, exclude=()):
+    """Concrete fields in ModelSerializer order: primary key, plain fields, then relations."""
+    fields = [field for field in model._meta.concrete_fields if field.name not in exclude]
+    return (
+        [field for field in fields if field.primary_key]
+        + [field for field in fields if not field.primary_key and not field.is_relation]
+        + [field for field in fields if not field.primary_key and field.is_relation]
+    )
+
+
+def encode_values(keys, converters, values):
+    return {
+        key: None if value is None else convert(value)
+        for key, convert, value in zip(keys, converters, values)
+    }
+
+
+SHADOW_OFFSET_COLUMNS = ['shadow_offset_x', 'shadow_offset_y']
+SHAPE_CONFIG_FIELDS = serialized_fields(Shape, exclude=['layout', 'content_type', 'shape_id', *SHADOW_OFFSET_COLUMNS])
+
+# layout, content type and concrete id, then the config columns, then the shadow offset
+SHAPE_ROW_COLUMNS = (
+    ['layout_id', 'content_type_id', 'shape_id']
+    + [field.attname for field in SHAPE_CONFIG_FIELDS]
+    + SHADOW_OFFSET_COLUMNS
+)
+SHAPE_CONFIG_SLICE = slice(3, 3 + len(SHAPE_CONFIG_FIELDS))
+SHAPE_CONFIG_KEYS = [snake_to_camel_key(field.name) for field in SHAPE_CONFIG_FIELDS]
+SHAPE_CONFIG_CONVERTERS = [column_converter(field) for field in SHAPE_CONFIG_FIELDS]
+
+MEDIA_CONTENT_FIELDS = serialized_fields(MediaContent, exclude=MediaContentSerializer.Meta.exclude)
+
+
+class ShapeTypePlan:
+    """Columns selected for one concrete shape model and how they are written in the config."""
+
+    def __init__(self, model_data):
+        self.model = model_data["model"]
+        self.type = CONTENT_TYPE_TO_TYPE[str(model_data["content_type"])]
+
+        fields = serialized_fields(self.model, exclude=['id'])
+        self.columns = ['id']
+        self.keys, self.converters = [], []
+        self.nested = {}
+        for field in fields:
+            if field.is_relation and field.related_model is MediaContent:
+                # Nested as the MediaContentSerializer representation, its keys are not camelCased
+                start = len(self.columns)
+                self.columns += [f"{field.name}__{nested.attname}" for nested in MEDIA_CONTENT_FIELDS]
+                self.nested[snake_to_camel_key(field.name)] = (
+                    slice(start, len(self.columns)),
+                    [nested.name for nested in MEDIA_CONTENT_FIELDS],
+                    [column_converter(nested) for nested in MEDIA_CONTENT_FIELDS],
+                )
+            else:
+                self.columns.append(field.attname)
+                self.keys.append(snake_to_camel_key(field.name))
+                self.converters.append(column_converter(field))
+        self.plain_slice = slice(1, 1 + len(self.keys))
+
+
+    def load(self, ids):
+        """{id: values row} of the concrete objects, in one query."""
+        return {row[0]: row for row in self.model.objects.filter(pk__in=ids).values_list(*self.columns)}
+
+
+    def encode(self, shape_row, object_row):
+        config = encode_values(SHAPE_CONFIG_KEYS, SHAPE_CONFIG_CONVERTERS, shape_row[SHAPE_CONFIG_SLICE])
+        config.update(encode_values(self.keys, self.converters, object_row[self.plain_slice]))
+        for key, (columns, nested_keys, converters) in self.nested.items():
+            config[key] = encode_values(nested_keys, converters, object_row[columns])
+
+        shadow_offset_x, shadow_offset_y = shape_row[-2:]
+        config["shadowOffset"] = {"x": float(shadow_offset_x), "y": float(shadow_offset_y)}
+        return {"type": self.type, "config": config}
+
+
+PLANS = {model_data["content_type"]: ShapeTypePlan(model_data) for model_data in CLASSNAME_TO_MODELS.values()}
+
+
+def encode_shape_rows(rows):
+    """
+    Encode SHAPE_ROW_COLUMNS rows with one query per shape type.
+    Returns [(layout id, representation)] in row order; shapes whose concrete object is gone are left out.
+    """
+    ids_by_content_type = {}
+    for row in rows:
+        ids_by_content_type.setdefault(row[1], []).append(row[2])
+
+    objects = {
+        content_type_id: PLANS[content_type_id].load(ids)
+        for content_type_id, ids in ids_by_content_type.items() if content_type_id in PLANS
+    }
+
+    encoded = []
+    for row in rows:
+        object_row = objects.get(row[1], {}).get(row[2])
+        if object_row is not None:
+            encoded.append((row[0], PLANS[row[1]].encode(row, object_row)))
+    return encoded
+
+
+def encode_shapes(queryset):
+    """Representations of a Shape queryset."""
+    return [representation for _, representation in encode_shape_rows(list(queryset.values_list(*SHAPE_ROW_COLUMNS)))]
+
+
+def encode_shapes_by_layout(queryset):
+    """{layout id: representations} of a Shape queryset."""
+    shapes_by_layout = {}
+    for layout_id, representation in encode_shape_rows(list(queryset.values_list(*SHAPE_ROW_COLUMNS))):
+        shapes_by_layout.setdefault(layout_id, []).append(representation)
+    return shapes_by_layout
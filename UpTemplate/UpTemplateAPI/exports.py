@@ -0,0 +1,417 @@
+"""
+Server side rendering of templates to SVG and PNG.
+
+Layouts are drawn in id order, stacked like Konva layers, and the shapes of a
+layout in z-order, as the shape storages return them.
+Every shape follows the Konva transform model,
+translate(x, y) rotate(rotation) scale(scaleX, scaleY) translate(-offsetX, -offsetY),
+with Rect, Image and Text drawn from their top left corner and Circle around its center.
+
+SVG is written as a stream of fragments and PNG is rasterized with Pillow. Both
+go to the derivative cache under the template revision, so a revision is
+rendered once and served from disk afterwards.
+
+PNG exports are at most MEDIA_RENDER_MAX_WIDTH pixels per side and
+EXPORT_MAX_PIXELS pixels in all. Text is drawn with the font files EXPORT_FONTS
+maps font families to, other families with the default Pillow font.
+"""
+import math
+import os
+from functools import lru_cache
+from django.conf import settings
+from xml.sax.saxutils import escape
+from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont, ImageOps, UnidentifiedImageError
+from .images import derivative_key, get_derivative_cache, MEDIA_RENDER_MAX_WIDTH
+from .loaders import load_template_tree
+from .models import MediaContent
+from .serializers import TYPE_TO_CLASSNAME
+from .spatial import shape_matrix, multiply, invert, apply, scaling
+from .storage import get_shape_storage
+
+
+EXPORT_FORMATS = {"svg": "image/svg+xml", "png": "image/png"}
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+
+# PNG shapes are drawn this many times larger and scaled down, Pillow does not antialias polygons
+SUPERSAMPLING = 2
+CIRCLE_SEGMENTS = 96
+EXPORT_MAX_PIXELS = getattr(settings, "EXPORT_MAX_PIXELS", 8 * 1024 * 1024)
+TEXT_TOO_LARGE = {"text": ["A text shape is too large to be exported to PNG."]}
+
+
+class ExportError(Exception):
+    """Export that cannot be rendered, carries the errors and the status code of the response."""
+
+    def __init__(self, errors, status_code=400):
+        super().__init__(errors)
+        self.errors = errors
+        self.status_code = status_code
+
+
+def png_size(template, width=None):
+    """
+    (width, height) in pixels of a PNG export, width defaults to the template width.
+    Raises ExportError for templates without a positive size and exports over the limits.
+    """
+    if not (math.isfinite(template.width) and math.isfinite(template.height)) or template.width <= 0 or template.height <= 0:
+        raise ExportError({"template": ["Only templates with a positive width and height are exported to PNG."]})
+    if width is None:
+        width = min(max(1, round(template.width)), MEDIA_RENDER_MAX_WIDTH)
+    height = max(1, round(template.height * width / template.width))
+    if width > MEDIA_RENDER_MAX_WIDTH or height > MEDIA_RENDER_MAX_WIDTH or width * height > EXPORT_MAX_PIXELS:
+        raise ExportError({"w": [
+            f"PNG exports are at most {MEDIA_RENDER_MAX_WIDTH} pixels per side and {EXPORT_MAX_PIXELS} pixels, "
+            f"this one would be {width}x{height}."
+        ]})
+    return width, height
+
+
+def template_layers(template, layout_id=None):
+    """[(layout, shape representations in drawing order)] of a template, or of one of its layouts."""
+    context = load_template_tree([template])
+    return [
+        (layout, get_shape_storage(layout).representations(layout, context))
+        for layout in sorted(template.loaded_layouts, key=lambda layout: layout.id)
+        if layout_id is None or layout.id == layout_id
+    ]
+
+
+def shadow(config):
+    """(dx, dy, blur, color, opacity) of the Konva shadow in layout units, None when the shape casts none."""
+    opacity, color = config.get("shadowOpacity") or 0, config.get("shadowColor")
+    if not opacity or not color:
+        return None
+    # Konva scales the shadow with the shape but does not rotate it
+    scale_x, scale_y = config.get("scaleX", 1), config.get("scaleY", 1)
+    offset = config.get("shadowOffset") or {}
+    blur = (config.get("shadowBlurr") or 0) * min(abs(scale_x), abs(scale_y))
+    return (offset.get("x") or 0) * scale_x, (offset.get("y") or 0) * scale_y, blur, color, opacity
+
+
+def media_path(config):
+    return (config.get("mediaContent") or {}).get("content")
+
+
+# SVG
+
+def svg_number(value):
+    text = f"{float(value):.4f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+def svg_attributes(attributes):
+    return "".join(
+        f' {name}="{escape(str(value), {chr(34): "&quot;"})}"' for name, value in attributes.items() if value is not None
+    )
+
+
+def svg_shape_body(shape_type, config, absolute_url):
+    paint = svg_attributes({
+        "fill": config.get("fill") or "none",
+        "stroke": config.get("stroke") or "none",
+        "stroke-width": svg_number(config.get("strokeWidth") or 0),
+    })
+
+    if shape_type == "Rect":
+        return f'<rect width="{svg_number(config["width"])}" height="{svg_number(config["height"])}"{paint}/>'
+
+    if shape_type == "Circle":
+        return f'<circle r="{svg_number(config["radius"])}"{paint}/>'
+
+    if shape_type == "Text":
+        font_size = config.get("fontSize") or 12
+        # Konva draws each line around its middle, one font size apart
+        lines = "".join(
+            f'<tspan x="0" y="{svg_number(font_size * (index + 0.5))}">{escape(line)}</tspan>'
+            for index, line in enumerate(str(config.get("text") or "").split("\n"))
+        )
+        attributes = svg_attributes({
+            "font-family": config.get("fontFamily") or None,
+            "font-size": svg_number(font_size),
+            "dominant-baseline": "middle",
+            "xml:space": "preserve",
+        })
+        return f"<text{attributes}{paint}>{lines}</text>"
+
+    if shape_type == "Image":
+        href = media_path(config)
+        if not href:
+            return None
+        size = svg_attributes({"width": svg_number(config["width"]), "height": svg_number(config["height"])})
+        # Konva fills and strokes the image box before drawing the image
+        return f'<rect{size}{paint}/><image{size}{svg_attributes({"href": absolute_url(href), "preserveAspectRatio": "none"})}/>'
+
+    return None
+
+
+def svg_shape(layout, shape, absolute_url):
+    config = shape["config"]
+    body = svg_shape_body(TYPE_TO_CLASSNAME.get(shape["type"]), config, absolute_url)
+    if body is None:
+        return ""
+
+    a, b, c, d, e, f = shape_matrix(config)
+    transform = " ".join(svg_number(value) for value in (a, d, b, e, c, f))
+    opacity = config.get("opacity", 1)
+    attributes = {"opacity": svg_number(opacity) if opacity != 1 else None}
+
+    definitions = ""
+    cast = shadow(config)
+    if cast is not None:
+        dx, dy, blur, color, shadow_opacity = cast
+        filter_id = f"shadow-{layout.id}-{config['_id']}"
+        drop_shadow = svg_attributes({
+            "dx": svg_number(dx), "dy": svg_number(dy), "stdDeviation": svg_number(blur / 2),
+            "flood-color": color, "flood-opacity": svg_number(shadow_opacity),
+        })
+        definitions = (
+            f'<defs><filter id="{filter_id}" x="-50%" y="-50%" width="200%" height="200%">'
+            f"<feDropShadow{drop_shadow}/></filter></defs>"
+        )
+        # Applied outside the transform, so the shadow is not rotated
+        attributes["filter"] = f"url(#{filter_id})"
+
+    return f'{definitions}<g{svg_attributes(attributes)}><g transform="matrix({transform})">{body}</g></g>'
+
+
+def svg_stream(template, layers, absolute_url=str):
+    """The SVG document of the layers, as a stream of fragments."""
+    width, height = svg_number(template.width), svg_number(template.height)
+    yield (
+        f'<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="{SVG_NAMESPACE}" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+        f"<title>{escape(template.name)}</title>"
+    )
+    for layout, shapes in layers:
+        yield f'<g id="layout-{layout.id}">'
+        for shape in shapes:
+            yield svg_shape(layout, shape, absolute_url)
+        yield "</g>"
+    yield "</svg>\n"
+
+
+# PNG
+
+def parse_color(value):
+    """RGBA tuple of a CSS color, None for missing or unknown colors."""
+    try:
+        rgba = ImageColor.getrgb(value)
+    except (ValueError, AttributeError, TypeError):
+        return None
+    return rgba if len(rgba) == 4 else (*rgba, 255)
+
+
+def font_path(family):
+    """Font file of a font family in EXPORT_FONTS, None for the others. Families are never used as paths."""
+    fonts = {name.lower(): file for name, file in getattr(settings, "EXPORT_FONTS", {}).items()}
+    file = fonts.get(str(family or "").strip().lower())
+    if file is None:
+        return None
+    return os.path.join(str(getattr(settings, "EXPORT_FONTS_ROOT", os.path.join(os.path.dirname(__file__), "fonts"))), file)
+
+
+@lru_cache(maxsize=64)
+def load_font(path, size):
+    if path is not None:
+        try:
+            return ImageFont.truetype(path, size)
+        except (OSError, ValueError):
+            pass
+    return ImageFont.load_default(size)
+
+
+def with_alpha(image, factor):
+    if factor < 1:
+        image.putalpha(image.getchannel("A").point(lambda alpha: round(alpha * factor)))
+    return image
+
+
+def composite(canvas, image, left, top):
+    """Alpha composite image at (left, top), clipped to the canvas."""
+    box = (max(0, -left), max(0, -top), min(image.width, canvas.width - left), min(image.height, canvas.height - top))
+    if box[0] < box[2] and box[1] < box[3]:
+        canvas.alpha_composite(image, dest=(left + box[0], top + box[1]), source=box)
+
+
+class Rasterizer:
+    """Draws shape representations on an RGBA canvas of `scale` pixels per template unit."""
+
+    def __init__(self, width, height, scale, media_contents):
+        self.scale = scale * SUPERSAMPLING
+        self.size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        self.canvas = Image.new("RGBA", (self.size[0] * SUPERSAMPLING, self.size[1] * SUPERSAMPLING), (0, 0, 0, 0))
+        self.media_contents = media_contents
+        self.media_images = {}
+
+
+    def image(self):
+        return self.canvas.resize(self.size, Image.LANCZOS)
+
+
+    def outline(self, shape_type, config):
+        """Polygon of the shape in its own coordinates, None for text."""
+        if shape_type in ("Rect", "Image"):
+            width, height = config["width"], config["height"]
+            return [(0, 0), (width, 0), (width, height), (0, height)]
+        if shape_type == "Circle":
+            radius = config["radius"]
+            return [
+                (radius * math.cos(2 * math.pi * index / CIRCLE_SEGMENTS), radius * math.sin(2 * math.pi * index / CIRCLE_SEGMENTS))
+                for index in range(CIRCLE_SEGMENTS)
+            ]
+        return None
+
+
+    def text_bitmap(self, config, pixels_per_unit):
+        """(bitmap, units per bitmap pixel) of a text shape."""
+        font_size = config.get("fontSize") or 12
+        pixel_size = max(1, round(font_size * pixels_per_unit))
+        lines = str(config.get("text") or "").split("\n")
+        # The bitmap is drawn whole before being clipped to the canvas, it gets the budget of the canvas
+        max_pixels = EXPORT_MAX_PIXELS * SUPERSAMPLING ** 2
+        if pixel_size * len(lines) > max_pixels:
+            raise ExportError(TEXT_TOO_LARGE)
+        font = load_font(font_path(config.get("fontFamily")), pixel_size)
+        stroke_width = round((config.get("strokeWidth") or 0) * pixels_per_unit / 2)
+        width = max(1, math.ceil(max(font.getlength(line) for line in lines)) + 2 * stroke_width)
+        if width * pixel_size * len(lines) > max_pixels:
+            raise ExportError(TEXT_TOO_LARGE)
+
+        bitmap = Image.new("RGBA", (width, pixel_size * len(lines)), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(bitmap, "RGBA")
+        stroke = parse_color(config.get("stroke")) if stroke_width else None
+        for index, line in enumerate(lines):
+            draw.text(
+                (stroke_width, pixel_size * (index + 0.5)), line, font=font, anchor="lm",
+                fill=parse_color(config.get("fill")) or (0, 0, 0, 0),
+                stroke_width=stroke_width if stroke else 0, stroke_fill=stroke,
+            )
+        return bitmap, font_size / pixel_size
+
+
+    def media_bitmap(self, config):
+        """(bitmap, (units per bitmap pixel horizontally, vertically)) of an image shape, None when unreadable."""
+        media_content_id = (config.get("mediaContent") or {}).get("id")
+        if media_content_id not in self.media_images:
+            image = None
+            media_content = self.media_contents.get(media_content_id)
+            if media_content is not None and media_content.content:
+                try:
+                    with media_content.content.open("rb") as file, Image.open(file) as opened:
+                        image = ImageOps.exif_transpose(opened).convert("RGBA")
+                except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+                    # Unreadable or too large to decode, the export goes on without it
+                    image = None
+            self.media_images[media_content_id] = image
+
+        image = self.media_images[media_content_id]
+        if image is None:
+            return None
+        return image, (config["width"] / image.width, config["height"] / image.height)
+
+
+    def draw(self, shape):
+        shape_type, config = TYPE_TO_CLASSNAME.get(shape["type"]), shape["config"]
+        matrix = multiply((self.scale, 0, 0, 0, self.scale, 0), shape_matrix(config))
+        pixels_per_unit = scaling(matrix)
+        if pixels_per_unit == 0:
+            return
+
+        bitmap = None
+        polygon = self.outline(shape_type, config)
+        if shape_type == "Text":
+            bitmap, units = self.text_bitmap(config, pixels_per_unit)
+            bitmap_matrix = multiply(matrix, (units, 0, 0, 0, units, 0))
+            corners = [(0, 0), (bitmap.width * units, 0), (bitmap.width * units, bitmap.height * units), (0, bitmap.height * units)]
+        elif shape_type == "Image":
+            media = self.media_bitmap(config)
+            if media is None:
+                return
+            bitmap, (units_x, units_y) = media
+            bitmap_matrix = multiply(matrix, (units_x, 0, 0, 0, units_y, 0))
+            corners = polygon
+        elif polygon is not None:
+            corners = polygon
+        else:
+            return
+
+        # Device box of the shape, with room for its stroke and its shadow
+        stroke_width = (config.get("strokeWidth") or 0) * pixels_per_unit
+        points = [apply(matrix, x, y) for x, y in corners]
+        margin = stroke_width / 2 + 2
+        cast = shadow(config)
+        if cast is not None:
+            margin += cast[2] * self.scale * 1.5
+        left = math.floor(min(x for x, _ in points) - margin)
+        top = math.floor(min(y for _, y in points) - margin)
+        right = math.ceil(max(x for x, _ in points) + margin)
+        bottom = math.ceil(max(y for _, y in points) + margin)
+
+        # Huge shapes only need the part that can reach the canvas
+        reach = 0 if cast is None else (abs(cast[0]) + abs(cast[1])) * self.scale + margin
+        left, top = max(left, -math.ceil(reach)), max(top, -math.ceil(reach))
+        right = min(right, self.canvas.width + math.ceil(reach))
+        bottom = min(bottom, self.canvas.height + math.ceil(reach))
+        if left >= right or top >= bottom:
+            return
+
+        layer = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        to_layer = multiply((1, 0, -left, 0, 1, -top), matrix)
+        draw = ImageDraw.Draw(layer, "RGBA")
+        if polygon is not None:
+            outline = [apply(to_layer, x, y) for x, y in polygon]
+            fill = parse_color(config.get("fill"))
+            if fill is not None:
+                draw.polygon(outline, fill=fill)
+            stroke = parse_color(config.get("stroke"))
+            if stroke is not None and stroke_width > 0:
+                draw.line(outline + outline[:1], fill=stroke, width=max(1, round(stroke_width)), joint="curve")
+        if bitmap is not None:
+            placement = invert(multiply((1, 0, -left, 0, 1, -top), bitmap_matrix))
+            # Resampled premultiplied so transparent pixels do not bleed into the edges
+            placed = bitmap.convert("RGBa").transform(layer.size, Image.AFFINE, placement, resample=Image.BICUBIC)
+            layer.alpha_composite(placed.convert("RGBA"))
+
+        layer = with_alpha(layer, config.get("opacity", 1))
+        if cast is not None:
+            dx, dy, blur, color, shadow_opacity = cast
+            rgba = parse_color(color)
+            if rgba is not None:
+                silhouette = Image.new("RGBA", layer.size, rgba[:3] + (0,))
+                silhouette.putalpha(layer.getchannel("A").point(lambda alpha: round(alpha * rgba[3] / 255 * shadow_opacity)))
+                if blur:
+                    silhouette = silhouette.filter(ImageFilter.GaussianBlur(blur * self.scale / 2))
+                composite(self.canvas, silhouette, left + round(dx * self.scale), top + round(dy * self.scale))
+        composite(self.canvas, layer, left, top)
+
+
+def rasterize(template, layers, width=None):
+    """PNG image of the layers, width pixels wide, see png_size."""
+    width, _ = png_size(template, width)
+    media_content_ids = {
+        (shape["config"].get("mediaContent") or {}).get("id")
+        for _, shapes in layers for shape in shapes if TYPE_TO_CLASSNAME.get(shape["type"]) == "Image"
+    }
+    media_contents = MediaContent.objects.in_bulk([pk for pk in media_content_ids if pk is not None])
+    rasterizer = Rasterizer(template.width, template.height, width / template.width, media_contents)
+    for _, shapes in layers:
+        for shape in shapes:
+            rasterizer.draw(shape)
+    return rasterizer.image()
+
+
+def write_export(template, fmt, destination, layout_id=None, width=None, absolute_url=str):
+    layers = template_layers(template, layout_id)
+    if fmt == "svg":
+        for fragment in svg_stream(template, layers, absolute_url):
+            destination.write(fragment.encode())
+    else:
+        rasterize(template, layers, width).save(destination, format="PNG", optimize=True)
+
+
+def export_template(template, fmt, layout_id=None, width=None, absolute_url=str):
+    """(key, open file) of the cached export of a template at its revision, rendered on the first request."""
+    key = derivative_key(f"template:{template.id}:{template.revision}:{layout_id or ''}:{absolute_url('/')}", width, fmt)
+    return key, get_derivative_cache().open(
+        key, fmt, lambda destination: write_export(template, fmt, destination, layout_id, width, absolute_url)
+    )
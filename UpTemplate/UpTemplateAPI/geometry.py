@@ -0,0 +1,218 @@
+"""
+Align, distribute and group transforms of a selection of shapes.
+
+The selection is loaded into NumPy arrays, one entry per shape: the transform
+columns of Shape, the stroke, and the local box computed from the size columns of
+the concrete rows (Rectangle and Media width / height, Circle radius, Text font
+size and lines, see spatial.local_box). Layout space bounds and new transforms are
+computed on the whole arrays, then written back by the storage in one update.
+
+Group transforms scale and rotate every shape around a common origin. A shape has
+no skew, so a non uniform scale of a rotated shape keeps the rotation and the
+scales of the combined transform and drops its skew, as the editor does.
+"""
+import math
+import numpy as np
+from .models import Shape
+from .serializers import (
+    CLASSNAME_TO_MODELS, CONTENT_TYPE_TO_CLASSNAME,
+    LEFT, CENTER, RIGHT, TOP, BOTTOM, HORIZONTAL, ALIGN, DISTRIBUTE
+)
+from .spatial import local_box
+
+
+TRANSFORM_FIELDS = ['x', 'y', 'offset_x', 'offset_y', 'scale_x', 'scale_y', 'rotation']
+GEOMETRY_FIELDS = TRANSFORM_FIELDS + ['stroke', 'stroke_width']
+
+
+class Selection:
+    """Geometry of selected shapes, the columns of TRANSFORM_FIELDS are float arrays."""
+
+    def __init__(self, ids, types, columns, objects):
+        self.ids = list(ids)
+        count = len(self.ids)
+        values = np.array([row[:len(TRANSFORM_FIELDS)] for row in columns], dtype=float).reshape(count, len(TRANSFORM_FIELDS))
+        for index, name in enumerate(TRANSFORM_FIELDS):
+            setattr(self, name, values[:, index].copy())
+
+        stroke_widths = np.array([row[-1] or 0 for row in columns], dtype=float)
+        self.margin = np.where([bool(row[-2]) for row in columns], stroke_widths / 2, 0)
+        self.local = self.local_boxes(np.array(types, dtype=object), objects)
+
+
+    @staticmethod
+    def local_boxes(types, objects):
+        """(n, 4) local boxes, vectorized per shape type."""
+        boxes = np.zeros((len(types), 4))
+        for shape_type in set(types):
+            indexes = np.flatnonzero(types == shape_type)
+            if shape_type == "Text":
+                boxes[indexes] = [
+                    local_box("Text", {"fontSize": objects[index].get("font_size"), "text": objects[index].get("text")})
+                    for index in indexes
+                ]
+            elif shape_type == "Circle":
+                radius = np.abs(np.array([objects[index].get("radius") or 0 for index in indexes], dtype=float))
+                boxes[indexes] = np.stack([-radius, -radius, radius, radius], axis=1)
+            else:
+                width = np.array([objects[index].get("width") or 0 for index in indexes], dtype=float)
+                height = np.array([objects[index].get("height") or 0 for index in indexes], dtype=float)
+                boxes[indexes] = np.stack([
+                    np.minimum(0, width), np.minimum(0, height), np.maximum(0, width), np.maximum(0, height)
+                ], axis=1)
+        return boxes
+
+
+    @classmethod
+    def from_rows(cls, layout_id, shape_ids):
+        """Selection of row stored shapes, locked for update, in the order of shape_ids. Unknown ids are left out."""
+        rows = {
+            row[0]: row for row in Shape.objects.select_for_update()
+            .filter(layout=layout_id, pk__in=shape_ids)
+            .values_list('_id', 'content_type_id', 'shape_id', *GEOMETRY_FIELDS)
+        }
+        rows = [rows[shape_id] for shape_id in shape_ids if shape_id in rows]
+
+        objects = {}
+        for content_type in {row[1] for row in rows}:
+            model_data = CLASSNAME_TO_MODELS[CONTENT_TYPE_TO_CLASSNAME[str(content_type)]]
+            fields = [name for name in model_data["fields"] if name != "media_content"]
+            objects.update({
+                (content_type, values[0]): dict(zip(fields, values[1:]))
+                for values in model_data["model"].objects
+                .filter(pk__in=[row[2] for row in rows if row[1] == content_type])
+                .values_list('id', *fields)
+            })
+
+        # Shapes whose concrete row is missing are not drawn, they are not arranged either
+        rows = [row for row in rows if (row[1], row[2]) in objects]
+        return cls(
+            [row[0] for row in rows],
+            [CONTENT_TYPE_TO_CLASSNAME[str(row[1])] for row in rows],
+            [row[3:] for row in rows],
+            [objects[(row[1], row[2])] for row in rows],
+        )
+
+
+    @classmethod
+    def from_records(cls, records):
+        """Selection of shape document records."""
+        return cls(
+            [record["_id"] for record in records],
+            [record["type"] for record in records],
+            [[record.get(name) for name in GEOMETRY_FIELDS] for record in records],
+            [record["object"] for record in records],
+        )
+
+
+    def matrices(self):
+        """Linear part (n, 2, 2) of the shape transforms, their translation is in x and y."""
+        angle = np.radians(self.rotation)
+        cos, sin = np.cos(angle), np.sin(angle)
+        return np.stack([
+            np.stack([cos * self.scale_x, -sin * self.scale_y], axis=1),
+            np.stack([sin * self.scale_x, cos * self.scale_y], axis=1),
+        ], axis=1)
+
+
+    def bounds(self):
+        """(n, 4) layout space boxes, stroke included."""
+        x0, y0 = self.local[:, 0] - self.margin - self.offset_x, self.local[:, 1] - self.margin - self.offset_y
+        x1, y1 = self.local[:, 2] + self.margin - self.offset_x, self.local[:, 3] + self.margin - self.offset_y
+        # (n, 2, 4) corners relative to the offset
+        corners = np.stack([np.stack([x0, x1, x1, x0], axis=1), np.stack([y0, y0, y1, y1], axis=1)], axis=1)
+        points = self.matrices() @ corners
+        points[:, 0] += self.x[:, None]
+        points[:, 1] += self.y[:, None]
+        return np.concatenate([points.min(axis=2), points.max(axis=2)], axis=1)
+
+
+    @staticmethod
+    def union(bounds):
+        return np.concatenate([bounds[:, :2].min(axis=0), bounds[:, 2:].max(axis=0)])
+
+
+    def align(self, edge):
+        """Move the shapes to the edge (or center line) of the selection bounds."""
+        bounds = self.bounds()
+        union = self.union(bounds)
+        axis = 0 if edge in (LEFT, CENTER, RIGHT) else 1
+        if edge in (LEFT, TOP):
+            delta = union[axis] - bounds[:, axis]
+        elif edge in (RIGHT, BOTTOM):
+            delta = union[axis + 2] - bounds[:, axis + 2]
+        else:
+            delta = (union[axis] + union[axis + 2] - bounds[:, axis] - bounds[:, axis + 2]) / 2
+        self.translate(delta, axis)
+
+
+    def distribute(self, axis):
+        """Space the shapes evenly along the axis, in the order of their centers, within the selection bounds."""
+        if len(self.ids) < 3:
+            return
+        axis = 0 if axis == HORIZONTAL else 1
+        bounds = self.bounds()
+        start, end = bounds[:, axis], bounds[:, axis + 2]
+        order = np.argsort(start + end, kind="stable")
+        sizes = (end - start)[order]
+        gap = (end.max() - start.min() - sizes.sum()) / (len(sizes) - 1)
+
+        # New start of each shape in order: the previous start, size and a gap further
+        starts = start.min() + np.concatenate([[0], np.cumsum(sizes[:-1] + gap)])
+        delta = np.empty_like(start)
+        delta[order] = starts - start[order]
+        self.translate(delta, axis)
+
+
+    def transform(self, scale_x=1, scale_y=1, rotation=0, origin=None):
+        """Scale then rotate the whole selection around origin, the center of its bounds by default."""
+        if origin is None:
+            union = self.union(self.bounds())
+            origin = ((union[0] + union[2]) / 2, (union[1] + union[3]) / 2)
+
+        angle = math.radians(rotation)
+        cos, sin = math.cos(angle), math.sin(angle)
+        group = np.array([[cos * scale_x, -sin * scale_y], [sin * scale_x, cos * scale_y]])
+
+        # The offset point stays where the group transform sends it
+        positions = group @ np.stack([self.x - origin[0], self.y - origin[1]])
+        self.x, self.y = positions[0] + origin[0], positions[1] + origin[1]
+
+        # Rotation and scales of the combined linear part, its skew is dropped
+        linear = group @ self.matrices()
+        a, c = linear[:, 0, 0], linear[:, 1, 0]
+        scale = np.hypot(a, c)
+        determinant = linear[:, 0, 0] * linear[:, 1, 1] - linear[:, 0, 1] * linear[:, 1, 0]
+        self.rotation = np.where(scale > 0, np.degrees(np.arctan2(c, a)), self.rotation + rotation)
+        self.scale_x = scale
+        self.scale_y = np.divide(determinant, scale, out=np.zeros_like(scale), where=scale > 0)
+
+
+    def translate(self, delta, axis):
+        if axis == 0:
+            self.x = self.x + delta
+        else:
+            self.y = self.y + delta
+
+
+    def updates(self):
+        """{id, ...transform} updates of the shapes, as the transform endpoint takes them."""
+        columns = [getattr(self, name).tolist() for name in TRANSFORM_FIELDS]
+        return [
+            {"id": shape_id, **dict(zip(TRANSFORM_FIELDS, values))}
+            for shape_id, *values in zip(self.ids, *columns)
+        ]
+
+
+def arrange_selection(selection, operation, edge=None, axis=None, scale_x=1, scale_y=1, rotation=0, origin_x=None, origin_y=None):
+    """Apply an ARRANGE_OPERATIONS operation to the selection, as ShapeArrangeSerializer validates it."""
+    if not selection.ids:
+        return []
+    if operation == ALIGN:
+        selection.align(edge)
+    elif operation == DISTRIBUTE:
+        selection.distribute(axis)
+    else:
+        origin = None if origin_x is None or origin_y is None else (origin_x, origin_y)
+        selection.transform(scale_x, scale_y, rotation, origin)
+    return selection.updates()
@@ -0,0 +1,202 @@
+"""
+Image helpers built on Pillow: header probing at upload time and resized /
+re-encoded derivatives kept in a bounded on-disk cache.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+MEDIA_RENDER_MAX_WIDTH = getattr(settings, "MEDIA_RENDER_MAX_WIDTH", 4096)
+
+# fmt query value -> (Pillow format, content type)
+RENDER_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+SAVE_OPTIONS = {
+    "WEBP": {"quality": 85, "method": 4},
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+}
+
+
+EXIF_ORIENTATION = 0x0112
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def image_dimensions(file):
+    """(width, height) read from the image header, the pixels are not decoded."""
+    position = file.tell() if hasattr(file, "tell") else None
+    try:
+        with Image.open(file) as image:
+            return image.size
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as error:
+        raise InvalidImage(str(error)) from error
+    finally:
+        if position is not None:
+            file.seek(position)
+
+
+def source_format(file):
+    """Default fmt of a derivative: the one of the source when it can be written, png otherwise."""
+    try:
+        with file.open("rb") as opened, Image.open(opened) as image:
+            fmt = (image.format or "").lower()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as error:
+        raise InvalidImage(str(error)) from error
+    return fmt if fmt in RENDER_FORMATS else "png"
+
+
+def render_image(file, destination, width, fmt):
+    """Write file resized to width (never enlarged) and encoded as fmt to the destination file object."""
+    pillow_format = RENDER_FORMATS[fmt][0]
+    try:
+        with file.open("rb") as opened, Image.open(opened) as image:
+            if width and width < image.width and image.getexif().get(EXIF_ORIENTATION, 1) == 1:
+                # Lets the JPEG decoder scale down while decoding
+                image.draft("RGB", (width, max(1, round(image.height * width / image.width))))
+            image = ImageOps.exif_transpose(image)
+            if width and width < image.width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+            if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+                image = image.convert("RGBA")
+            image.save(destination, format=pillow_format, **SAVE_OPTIONS[pillow_format])
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as error:
+        raise InvalidImage(str(error)) from error
+
+
+def derivative_key(name, width, fmt):
+    return hashlib.sha256(f"{name}:{width or ''}:{fmt}".encode()).hexdigest()
+
+
+class DerivativeCache:
+    """
+    Files under root, evicted least recently used first once they exceed max_bytes.
+    Hits refresh the file mtime, which is the recency eviction goes by, so the cache
+    is shared by every process using the same root.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        # Estimate of the cache size, the directory is only scanned when it goes over budget
+        self.size = None
+        self.lock = threading.Lock()
+
+
+    def path(self, key, fmt):
+        return os.path.join(self.root, key[:2], f"{key}.{fmt}")
+
+
+    def get(self, key, fmt):
+        path = self.path(key, fmt)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+
+    def open(self, key, fmt, write):
+        """
+        Cached file of key opened for reading, stored from write(file) when missing. Opened
+        rather than returned as a path: an open file outlives its eviction by another request.
+        """
+        path = self.get(key, fmt)
+        for attempt in range(2):
+            if path is not None:
+                try:
+                    return open(path, "rb")
+                except FileNotFoundError:
+                    # Evicted between the lookup and the open
+                    pass
+            path = self.put(key, fmt, write)
+        return open(path, "rb")
+
+
+    def put(self, key, fmt, write):
+        """Store what write(file) writes under key, returns the cached path."""
+        path = self.path(key, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                write(file)
+            # Readers only ever see complete files
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.scan_size()
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.evict(keep=path)
+        return path
+
+
+    def entries(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+
+    def scan_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+
+    def evict(self, keep=None):
+        """Drop the least recently used files until the cache is under 90% of its budget."""
+        entries = sorted(self.entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, file_size, path in entries:
+            if size <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self.size = size
+
+
+_derivative_caches = {}
+
+
+def get_derivative_cache():
+    root = str(getattr(settings, "MEDIA_DERIVATIVES_ROOT", os.path.join(settings.MEDIA_ROOT, "derivatives")))
+    max_bytes = getattr(settings, "MEDIA_DERIVATIVES_MAX_BYTES", 256 * 1024 * 1024)
+    if (root, max_bytes) not in _derivative_caches:
+        _derivative_caches[(root, max_bytes)] = DerivativeCache(root, max_bytes)
+    return _derivative_caches[(root, max_bytes)]
+
+
+def get_derivative(file, width, fmt):
+    """(key, open file) of the cached derivative of a stored file, rendered on the first request."""
+    key = derivative_key(file.name, width, fmt)
+    return key, get_derivative_cache().open(key, fmt, lambda destination: render_image(file, destination, width, fmt))
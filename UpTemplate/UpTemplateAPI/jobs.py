@@ -0,0 +1,226 @@
+"""
+Background export jobs.
+
+    POST /api/jobs/                  {fmt, [width], [templates | template]}, queues an ExportJob
+    GET  /api/jobs/<id>/             status and progress (completed out of total)
+    GET  /api/jobs/<id>/artifact/    zip of the exported files once done
+
+Queued jobs are started oldest first, at most EXPORT_JOBS_PER_USER at a time per
+user so one account cannot hold every worker, and run in a ProcessPoolExecutor of
+EXPORT_JOB_WORKERS processes (the CPU count by default). EXPORT_JOBS_EAGER runs
+them synchronously instead, in the scheduling thread.
+
+Claimed jobs are marked running, which counts them against the limit, and get their
+started_at once a worker picks them up. Started jobs that report no progress for
+EXPORT_JOB_TIMEOUT seconds are failed. Claimed jobs still waiting for a worker are
+not: only those left unstarted for EXPORT_JOB_START_TIMEOUT seconds, lost with the
+process that submitted them.
+
+Scheduling happens when a job is queued or finishes, and when a queued job is polled.
+Finished jobs and their artifacts are removed by the collect_export_jobs command.
+Artifacts are stored under EXPORT_ARTIFACTS_ROOT, outside the public MEDIA_ROOT, and
+only served to the owner of their job.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from functools import partial
+from urllib.parse import urljoin
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+from .exports import export_template
+from .models import ExportJob, Layout, Template
+
+
+logger = logging.getLogger(__name__)
+
+EXPORT_JOB_WORKERS = getattr(settings, "EXPORT_JOB_WORKERS", None) or os.cpu_count() or 1
+EXPORT_JOBS_PER_USER = getattr(settings, "EXPORT_JOBS_PER_USER", 2)
+EXPORT_JOB_MAX_TARGETS = getattr(settings, "EXPORT_JOB_MAX_TARGETS", 1000)
+EXPORT_JOB_TIMEOUT = getattr(settings, "EXPORT_JOB_TIMEOUT", 60 * 60)
+EXPORT_JOB_START_TIMEOUT = getattr(settings, "EXPORT_JOB_START_TIMEOUT", 24 * 60 * 60)
+EXPORT_JOB_EXPIRY = getattr(settings, "EXPORT_JOB_EXPIRY", 7 * 24 * 60 * 60)
+
+
+class JobError(Exception):
+    """Rejected job, carries the errors and the status code of the response."""
+
+    def __init__(self, errors, status_code=400):
+        super().__init__(errors)
+        self.errors = errors
+        self.status_code = status_code
+
+
+def start_job(user, validated_data, base_url=""):
+    """Queue an export of the templates asked for by ExportJobSerializer data, returns the job."""
+    validated_data = dict(validated_data)
+    template_ids = validated_data.pop("templates", None)
+    template_id = validated_data.pop("template", None)
+    templates = Template.objects.filter(user=user)
+
+    if template_id is not None:
+        if not templates.filter(pk=template_id).exists():
+            raise JobError({"template": [f"Unknown template {template_id}."]})
+        layout_ids = Layout.objects.filter(template=template_id).order_by("id").values_list("id", flat=True)
+        targets = [[template_id, layout_id] for layout_id in layout_ids]
+    else:
+        if template_ids is None:
+            template_ids = list(templates.order_by("id").values_list("id", flat=True))
+        template_ids = list(dict.fromkeys(template_ids))
+        unknown = set(template_ids) - set(templates.filter(pk__in=template_ids).values_list("id", flat=True))
+        if unknown:
+            raise JobError({"templates": [f"Unknown template {template_id}." for template_id in sorted(unknown)]})
+        targets = [[template_id, None] for template_id in template_ids]
+
+    if not targets:
+        raise JobError({"templates": ["Nothing to export."]})
+    if len(targets) > EXPORT_JOB_MAX_TARGETS:
+        raise JobError({"templates": [f"Jobs export at most {EXPORT_JOB_MAX_TARGETS} files."]})
+
+    job = ExportJob.objects.create(user=user, targets=targets, base_url=base_url, **validated_data)
+    transaction.on_commit(schedule_jobs)
+    return job
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned rather than forked, workers never share the connections of the web process
+            _executor = ProcessPoolExecutor(
+                max_workers=EXPORT_JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=django.setup
+            )
+        return _executor
+
+
+def reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+
+def fail_stalled_jobs():
+    now = timezone.now()
+    running = ExportJob.objects.filter(status=ExportJob.RUNNING)
+    running.filter(started_at__isnull=False, updated_at__lt=now - timedelta(seconds=EXPORT_JOB_TIMEOUT)).update(
+        status=ExportJob.FAILED, error="The export stopped responding.", finished_at=now, updated_at=now
+    )
+    running.filter(started_at__isnull=True, updated_at__lt=now - timedelta(seconds=EXPORT_JOB_START_TIMEOUT)).update(
+        status=ExportJob.FAILED, error="The export never started.", finished_at=now, updated_at=now
+    )
+
+
+def claim_job(job):
+    """Mark a queued job running when its user is under the limit, False when it has to wait. run_job starts it."""
+    with transaction.atomic():
+        # Serializes the claims of one user across processes
+        list(User.objects.select_for_update().filter(pk=job.user_id).values_list("pk", flat=True))
+        if ExportJob.objects.filter(user=job.user_id, status=ExportJob.RUNNING).count() >= EXPORT_JOBS_PER_USER:
+            return False
+        return bool(ExportJob.objects.filter(pk=job.pk, status=ExportJob.QUEUED).update(
+            status=ExportJob.RUNNING, updated_at=timezone.now()
+        ))
+
+
+def schedule_jobs():
+    """Start the queued jobs the per user limits allow, oldest first."""
+    fail_stalled_jobs()
+    for job in ExportJob.objects.filter(status=ExportJob.QUEUED).order_by("created_at").only("id", "user_id"):
+        if claim_job(job):
+            dispatch(job.id)
+
+
+def dispatch(job_id):
+    if getattr(settings, "EXPORT_JOBS_EAGER", False):
+        run_job(job_id)
+        return
+
+    executor = get_executor()
+    try:
+        future = executor.submit(run_job, job_id)
+    except BrokenProcessPool:
+        reset_executor(executor)
+        future = get_executor().submit(run_job, job_id)
+    future.add_done_callback(partial(job_finished, job_id, executor))
+
+
+def job_finished(job_id, executor, future):
+    # Called in a thread of the executor, which holds its own connections
+    try:
+        error = future.exception()
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                reset_executor(executor)
+            finish_job(job_id, ExportJob.FAILED, error=str(error) or error.__class__.__name__)
+        schedule_jobs()
+    except Exception:
+        logger.exception("Export job scheduling failed")
+    finally:
+        connections.close_all()
+
+
+def finish_job(job_id, status, **fields):
+    now = timezone.now()
+    ExportJob.objects.filter(pk=job_id, status=ExportJob.RUNNING).update(status=status, finished_at=now, updated_at=now, **fields)
+
+
+def entry_name(template, layout_id, fmt):
+    base = f"{slugify(template.name) or 'template'}-{template.id}"
+    return f"{base}/layout-{layout_id}.{fmt}" if layout_id is not None else f"{base}.{fmt}"
+
+
+def run_job(job_id):
+    """Export every target of a job into a zip artifact. Runs in a worker process."""
+    now = timezone.now()
+    if not ExportJob.objects.filter(pk=job_id, status=ExportJob.RUNNING).update(started_at=now, updated_at=now):
+        # Failed while waiting for a worker
+        return
+    job = ExportJob.objects.get(pk=job_id)
+    absolute_url = partial(urljoin, job.base_url) if job.base_url else str
+    try:
+        templates = Template.objects.in_bulk({template_id for template_id, _ in job.targets})
+        with tempfile.TemporaryFile() as buffer:
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+                for index, (template_id, layout_id) in enumerate(job.targets, 1):
+                    template = templates.get(template_id)
+                    # Templates deleted since the job was queued are left out
+                    if template is not None:
+                        _, exported = export_template(template, job.fmt, layout_id, job.width, absolute_url)
+                        with exported, archive.open(entry_name(template, layout_id, job.fmt), "w") as entry:
+                            shutil.copyfileobj(exported, entry)
+                    ExportJob.objects.filter(pk=job.pk).update(completed=index, updated_at=timezone.now())
+
+            buffer.seek(0)
+            job.artifact.save(f"{job.id}.zip", File(buffer), save=False)
+        finish_job(job.pk, ExportJob.DONE, artifact=job.artifact.name)
+    except Exception as error:
+        logger.exception("Export job %s failed", job_id)
+        finish_job(job.pk, ExportJob.FAILED, error=str(error) or error.__class__.__name__)
+
+
+def collect_jobs(max_age=None):
+    """Delete the jobs finished more than max_age seconds ago and their artifacts, returns how many."""
+    finished_before = timezone.now() - timedelta(seconds=EXPORT_JOB_EXPIRY if max_age is None else max_age)
+    jobs = list(ExportJob.objects.filter(status__in=[ExportJob.DONE, ExportJob.FAILED], finished_at__lt=finished_before))
+    for job in jobs:
+        if job.artifact:
+            job.artifact.delete(save=False)
+        job.delete()
+    return len(jobs)
@@ -0,0 +1,38 @@
+from .models import Layout, Shape, MediaContent
+from .encoders import encode_shapes_by_layout
+from .storage import DocumentShapeStorage, Z_ORDER
+
+
+def load_template_tree(templates):
+    """
+    Fetch every layout, shape and concrete shape row of the given templates
+    in a fixed number of queries (layouts, shapes, one per shape type).
+
+    Layouts are attached to their template as `loaded_layouts` and the encoded
+    shapes of row stored layouts to their layout as `loaded_shapes`. Returns the
+    serializer context holding the media contents of document stored layouts.
+    """
+    templates = list(templates)
+    templates_by_id = {template.id: template for template in templates}
+    for template in templates:
+        template.loaded_layouts = []
+
+    layouts_by_id = {}
+    document_records = []
+    for layout in Layout.objects.filter(template__in=templates_by_id.keys()):
+        templates_by_id[layout.template_id].loaded_layouts.append(layout)
+        if layout.storage == Layout.DOCUMENT:
+            document_records += DocumentShapeStorage().records(layout)
+        else:
+            layouts_by_id[layout.id] = layout
+
+    shapes_by_layout = encode_shapes_by_layout(
+        Shape.objects.filter(layout__in=layouts_by_id.keys()).order_by('layout', *Z_ORDER)
+    ) if layouts_by_id else {}
+    for layout_id, layout in layouts_by_id.items():
+        layout.loaded_shapes = shapes_by_layout.get(layout_id, [])
+
+    media_content_ids = DocumentShapeStorage.media_content_ids(document_records)
+    return {
+        "media_contents": MediaContent.objects.in_bulk(media_content_ids) if media_content_ids else {},
+    }
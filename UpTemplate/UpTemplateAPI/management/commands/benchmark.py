@@ -0,0 +1,21 @@
+import timeit
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from UpTemplateAPI.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Time the serialization hot paths per shape"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS))
+        parser.add_argument("--count", type=int, default=1000, help="Number of shapes")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per case, the fastest is reported")
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        with transaction.atomic():
+            for label, run in BENCHMARKS[options["name"]](count).items():
+                seconds = min(timeit.repeat(run, number=1, repeat=options["repeat"]))
+                self.stdout.write(f"{label:<32} {seconds * 1000:9.2f} ms  {seconds / count * 1e6:8.2f} us/shape")
+            transaction.set_rollback(True)
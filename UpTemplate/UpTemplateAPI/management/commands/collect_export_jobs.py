@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from UpTemplateAPI.jobs import collect_jobs, EXPORT_JOB_EXPIRY
+
+
+class Command(BaseCommand):
+    help = "Delete the finished export jobs and their zip artifacts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=int, default=EXPORT_JOB_EXPIRY,
+                            help="Seconds since a job finished after which it is deleted")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Deleted {collect_jobs(options['max_age'])} export jobs")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from UpTemplateAPI.blobs import collect_blobs, adopt_legacy_media
+
+
+class Command(BaseCommand):
+    help = "Delete the media blobs no media content references anymore and the blob files left without a blob"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--adopt-legacy", action="store_true",
+                            help="First move the media contents uploaded before blobs onto blobs")
+
+    def handle(self, *args, **options):
+        if options["adopt_legacy"]:
+            self.stdout.write(f"Moved {adopt_legacy_media()} media contents onto blobs")
+        self.stdout.write(f"Deleted {collect_blobs()} unreferenced blobs and orphan blob files")
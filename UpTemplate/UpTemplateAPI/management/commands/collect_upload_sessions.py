@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from UpTemplateAPI.uploads import collect_sessions, UPLOAD_SESSION_EXPIRY
+
+
+class Command(BaseCommand):
+    help = "Delete the abandoned chunked upload sessions and their part files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=int, default=UPLOAD_SESSION_EXPIRY,
+                            help="Seconds since the last chunk after which a session is abandoned")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Deleted {collect_sessions(options['max_age'])} upload sessions")
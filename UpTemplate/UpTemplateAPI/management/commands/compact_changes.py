@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from UpTemplateAPI.models import TemplateChange
+from UpTemplateAPI.changes import compact_changes, TEMPLATE_CHANGES_RETENTION
+
+
+class Command(BaseCommand):
+    help = "Trim the template change logs to their newest entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--keep", type=int, default=TEMPLATE_CHANGES_RETENTION,
+                            help="Number of change entries to keep per template")
+
+    def handle(self, *args, **options):
+        template_ids = TemplateChange.objects.values_list("template", flat=True).distinct()
+        deleted = sum(compact_changes(template_id, options["keep"]) for template_id in template_ids)
+        self.stdout.write(f"Dropped {deleted} change entries")
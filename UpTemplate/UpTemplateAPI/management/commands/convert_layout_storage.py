@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from UpTemplateAPI.models import Layout
+from UpTemplateAPI.storage import convert_layout_storage
+
+
+class Command(BaseCommand):
+    help = "Move layout shapes between Shape rows and the per-layout shapes document"
+
+    def add_arguments(self, parser):
+        parser.add_argument("storage", choices=[Layout.ROWS, Layout.DOCUMENT])
+        parser.add_argument("--layout", type=int, action="append", default=[], help="Layout id, can be repeated")
+        parser.add_argument("--template", type=int, action="append", default=[], help="Template id, can be repeated")
+        parser.add_argument("--all", action="store_true", help="Convert every layout")
+
+    def handle(self, *args, **options):
+        if not (options["layout"] or options["template"] or options["all"]):
+            raise CommandError("Pass --layout, --template or --all")
+
+        layouts = Layout.objects.exclude(storage=options["storage"]).only("id")
+        if not options["all"]:
+            layouts = layouts.filter(pk__in=options["layout"]) | layouts.filter(template__in=options["template"])
+
+        converted = sum(convert_layout_storage(layout, options["storage"]) for layout in layouts)
+        self.stdout.write(f"Converted {converted} layouts to {options['storage']} storage")
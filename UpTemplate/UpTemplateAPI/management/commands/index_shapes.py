@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from UpTemplateAPI.models import Layout
+from UpTemplateAPI.spatial import index_layouts
+
+
+class Command(BaseCommand):
+    help = "Rebuild the spatial index of row stored shapes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--layout", type=int, action="append", default=[], help="Layout id, can be repeated, every layout by default")
+
+    def handle(self, *args, **options):
+        layouts = Layout.objects.filter(storage=Layout.ROWS)
+        if options["layout"]:
+            layouts = layouts.filter(pk__in=options["layout"])
+
+        layout_ids = list(layouts.values_list("id", flat=True))
+        for start in range(0, len(layout_ids), 100):
+            index_layouts(layout_ids[start:start + 100])
+        self.stdout.write(f"Indexed the shapes of {len(layout_ids)} layouts")
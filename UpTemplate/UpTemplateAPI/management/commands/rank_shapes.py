@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from UpTemplateAPI.models import Layout, Shape
+from UpTemplateAPI.storage import get_shape_storage
+
+
+class Command(BaseCommand):
+    help = "Give the shapes created before z-order ranks a rank, following the legacy drawing_index_list of their layout"
+
+    def handle(self, *args, **options):
+        row_layouts = Layout.objects.filter(storage=Layout.ROWS, pk__in=Shape.objects.filter(z_rank='').values('layout'))
+        document_layouts = Layout.objects.filter(storage=Layout.DOCUMENT)
+
+        ranked = 0
+        for layout in [*row_layouts, *document_layouts]:
+            records = (layout.shapes_document or {}).get("shapes", [])
+            if layout.storage == Layout.DOCUMENT and all(record.get("z_rank") for record in records):
+                continue
+            get_shape_storage(layout).set_order(layout, layout.drawing_index_list or [])
+            ranked += 1
+        self.stdout.write(f"Ranked the shapes of {ranked} layouts")
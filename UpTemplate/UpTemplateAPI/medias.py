@@ -0,0 +1,64 @@
+from django.core.cache import cache
+from .blobs import file_digest
+from .models import Layout, Shape, Media, MediaContent
+from .serializers import CLASSNAME_TO_MODELS
+from .storage import DocumentShapeStorage
+
+
+def template_media_contents(template_id):
+    """
+    Every MediaContent used by the shapes of a template, once each, ordered by id.
+    Row stored shapes are resolved in a single statement (shapes -> media -> media contents),
+    document stored layouts add one query for their documents.
+    """
+    image_shape_ids = Shape.objects.filter(
+        layout__template=template_id, content_type=CLASSNAME_TO_MODELS["Image"]["content_type"]
+    ).values("shape_id")
+    media_content_ids = Media.objects.filter(id__in=image_shape_ids).values("media_content")
+
+    document_ids = set()
+    for document in Layout.objects.filter(template=template_id, storage=Layout.DOCUMENT).values_list("shapes_document", flat=True):
+        document_ids |= DocumentShapeStorage.media_content_ids((document or {}).get("shapes", []))
+
+    media_contents = MediaContent.objects.filter(id__in=media_content_ids)
+    if document_ids:
+        media_contents = media_contents | MediaContent.objects.filter(id__in=document_ids)
+    return media_contents.select_related("blob").order_by("id")
+
+
+def content_digest(media_content):
+    """(size, sha256) of the file of a media content, (None, None) when it has no readable file."""
+    if not media_content.content:
+        return None, None
+    if media_content.blob is not None:
+        return media_content.blob.size, media_content.blob.sha256
+
+    # Files written before blobs are hashed once per version: a file replaced under the same name
+    # has another size or modification time
+    name, storage = media_content.content.name, media_content.content.storage
+    try:
+        key = f"media-digest:{name}:{storage.size(name)}:{storage.get_modified_time(name).timestamp()}"
+        digest = cache.get(key)
+        if digest is None:
+            with media_content.content.open("rb") as file:
+                digest = file_digest(file)
+            cache.set(key, digest, timeout=None)
+    except OSError:
+        return None, None
+    return digest
+
+
+def media_manifest(media_contents):
+    """Preload manifest of media contents: where to fetch each file and how to validate it."""
+    manifest = []
+    for media_content in media_contents:
+        size, sha256 = content_digest(media_content)
+        manifest.append({
+            "id": media_content.id,
+            "url": media_content.content.url if media_content.content else None,
+            "size": size,
+            "width": media_content.original_width,
+            "height": media_content.original_height,
+            "sha256": sha256,
+        })
+    return manifest
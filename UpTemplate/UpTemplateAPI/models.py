@@ -1,7 +1,11 @@
 from django.db import models
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
+import os
+import uuid
 
 # Create your models here.  
 
@@ -12,12 +16,33 @@ class Template(models.Model):
     width = models.FloatField(default=800)
     height = models.FloatField(default=600)
 
-    
+    # Bumped on every write to the template, its layouts or its shapes
+    revision = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Changes up to this revision were dropped from the change log
+    compacted_revision = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Listings of a user in id order, and their ETag aggregates read from the index alone
+        indexes = [models.Index(fields=['user', 'id', 'revision', 'updated_at'])]
+
 
 class Layout(models.Model):
+    ROWS = 'rows'
+    DOCUMENT = 'document'
+    STORAGES = [(ROWS, 'Shape rows'), (DOCUMENT, 'Shapes document')]
+
     template = models.ForeignKey(Template, on_delete=models.CASCADE)
+    # Legacy z-order, replaced by Shape.z_rank and only read by the rank_shapes command
     drawing_index_list = models.JSONField(default=list)
 
+    # See storage.py, converted with the convert_layout_storage command
+    storage = models.CharField(max_length=16, choices=STORAGES, default=ROWS)
+    shapes_document = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['template', 'storage'])]
+
 
 class Shape(models.Model):
     _id = models.AutoField(primary_key=True)
@@ -52,6 +77,43 @@ class Shape(models.Model):
 
     draggable = models.CharField(default=True, max_length=16)
 
+    # Z-order in the layout, bottom first, see ranks.py. Shapes created before ranks have an empty one
+    z_rank = models.CharField(max_length=32, default='', blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['layout', 'z_rank']),
+            # Shapes of a concrete row, the generic relation read backwards
+            models.Index(fields=['content_type', 'shape_id']),
+            # Concrete ids of the shapes of a type in a layout (the medias of a template), from the index alone
+            models.Index(fields=['layout', 'content_type', 'shape_id']),
+        ]
+
+
+class ShapeBox(models.Model):
+    """Bounding box of a row stored shape in the spatial index, see spatial.py."""
+    shape = models.OneToOneField(Shape, on_delete=models.CASCADE, primary_key=True, related_name='box')
+    layout = models.ForeignKey(Layout, on_delete=models.CASCADE, db_index=False)
+
+    # Grid level and cell of the box, no level for the boxes larger than the coarsest cells
+    level = models.PositiveSmallIntegerField(null=True)
+    cell_x = models.IntegerField(default=0)
+    cell_y = models.IntegerField(default=0)
+
+    x0 = models.FloatField()
+    y0 = models.FloatField()
+    x1 = models.FloatField()
+    y1 = models.FloatField()
+
+    # Box in the shape coordinates without the stroke, transforms move the box without reading the concrete row
+    local_x0 = models.FloatField()
+    local_y0 = models.FloatField()
+    local_x1 = models.FloatField()
+    local_y1 = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=['layout', 'level', 'cell_x', 'cell_y'])]
+
 
 class Rectangle(models.Model):
     width = models.FloatField()
@@ -67,8 +129,20 @@ class Text(models.Model):
 class Circle(models.Model):
     radius=models.FloatField()
 
+class MediaBlob(models.Model):
+    """One stored file per distinct content, shared by the MediaContent rows uploading it."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='blobs/')
+    size = models.PositiveBigIntegerField()
+
+    # MediaContent rows pointing at the blob, unreferenced blobs are deleted by collect_media_blobs
+    references = models.PositiveIntegerField(default=0)
+
+
 class MediaContent(models.Model):
     content = models.FileField(upload_to='src/', blank=True, null=True)
+    # content is the blob file for uploads stored by content, None for older uploads
+    blob = models.ForeignKey(MediaBlob, null=True, blank=True, on_delete=models.PROTECT, related_name='media_contents')
     original_width = models.IntegerField(default=100)
     original_height = models.IntegerField(default=100)
 
@@ -84,8 +158,102 @@ class Media(models.Model):
 
 
 
+class UploadSession(models.Model):
+    """A chunked upload in progress, its bytes are appended to a part file until it is finalized."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    layout = models.ForeignKey('Layout', on_delete=models.CASCADE)
+
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received = models.PositiveBigIntegerField(default=0)
+
+    # Media shape created on finalize
+    width = models.FloatField()
+    height = models.FloatField()
+    alt = models.CharField(max_length=128, default="Image Description")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ExportArtifactStorage(FileSystemStorage):
+    """Export artifacts, kept out of MEDIA_ROOT: they are only served to their owner by /api/jobs/<id>/artifact/."""
+
+    @property
+    def base_location(self):
+        return str(getattr(settings, "EXPORT_ARTIFACTS_ROOT", os.path.join(os.path.dirname(os.path.abspath(settings.MEDIA_ROOT)), "export_artifacts")))
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+    @property
+    def base_url(self):
+        return None
+
+
+class ExportJob(models.Model):
+    """Batch export run by the job scheduler (see jobs.py), delivered as a zip artifact."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+    FORMATS = [('svg', 'SVG'), ('png', 'PNG')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    fmt = models.CharField(max_length=8, choices=FORMATS, default='svg')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    # [[template id, layout id], ...], a null layout exports the whole template
+    targets = models.JSONField(default=list)
+    # Resolves the media URLs written in SVG exports
+    base_url = models.CharField(max_length=255, blank=True)
+
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    completed = models.PositiveIntegerField(default=0)
+    artifact = models.FileField(upload_to='exports/', storage=ExportArtifactStorage(), blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed as targets complete, running jobs left untouched for EXPORT_JOB_TIMEOUT are failed
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at']), models.Index(fields=['user', 'status'])]
+
+
+class TemplateChange(models.Model):
+    TEMPLATE = 'template'
+    LAYOUT = 'layout'
+    SHAPE = 'shape'
+    TARGETS = [(TEMPLATE, 'Template'), (LAYOUT, 'Layout'), (SHAPE, 'Shape')]
+
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTIONS = [(CREATE, 'Create'), (UPDATE, 'Update'), (DELETE, 'Delete')]
+
+    template = models.ForeignKey(Template, on_delete=models.CASCADE)
+    revision = models.PositiveIntegerField()
+    target = models.CharField(max_length=16, choices=TARGETS)
+    action = models.CharField(max_length=16, choices=ACTIONS)
+    object_id = models.PositiveIntegerField()
+    layout_id = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['template', 'revision'])]
+
+
 class LayoutShapeRelation(models.Model):
     layout = models.ForeignKey(Layout, on_delete=models.CASCADE)
     shape = models.ForeignKey(Shape, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [models.Index(fields=['layout', 'shape'])]
+
 
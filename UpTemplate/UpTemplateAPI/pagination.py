@@ -0,0 +1,68 @@
+import operator
+from rest_framework.pagination import CursorPagination
+from .encoders import SHAPE_ROW_COLUMNS
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on the primary key. Listings stay plain lists unless the
+    client asks for a page with ?page_size= or follows a ?cursor= link.
+    """
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def requested(self, request):
+        return self.cursor_query_param in request.query_params or self.page_size_query_param in request.query_params
+
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.requested(request):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class ShapeKeysetPagination(KeysetPagination):
+    """
+    Shape pages in z-order, as the plain listing returns them. The cursor is keyed on
+    z_rank, shapes sharing a rank are ordered by _id and skipped with the cursor offset.
+    """
+    ordering = ('z_rank', '_id')
+    # Row stored shapes are paged as encoder value rows
+    row_position = SHAPE_ROW_COLUMNS.index('z_rank')
+
+    def _get_position_from_instance(self, instance, ordering):
+        if isinstance(instance, tuple):
+            return str(instance[self.row_position])
+        # Document records written before ranks have none
+        return str(instance.get(ordering[0].lstrip('-'), ''))
+
+
+class KeyedList:
+    """
+    The part of the QuerySet API CursorPagination relies on (order_by, a __gt / __lt
+    filter on the first ordering key, slicing) over a list of dicts. Used to page
+    the shape records of document stored layouts, missing keys sort as ''.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+
+    def order_by(self, *ordering):
+        keys = [name.lstrip('-') for name in ordering]
+        return KeyedList(sorted(
+            self.items, key=lambda item: tuple(item.get(key, '') for key in keys), reverse=ordering[0].startswith('-')
+        ))
+
+
+    def filter(self, **lookup):
+        (name, position), = lookup.items()
+        key, comparison = name.rsplit('__', 1)
+        compare = operator.gt if comparison == 'gt' else operator.lt
+        return KeyedList([item for item in self.items if compare(item.get(key, ''), type(item.get(key, ''))(position))])
+
+
+    def __getitem__(self, index):
+        return self.items[index]
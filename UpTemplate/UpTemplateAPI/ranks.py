@@ -0,0 +1,130 @@
+"""
+Lexicographic z-order ranks.
+
+A rank is a base 36 fraction written with its digits after the point and no
+trailing zero ("i" is 0.5), so ranks sort as plain strings, in the database
+index too (digits and lowercase letters only, which every collation orders the
+same way). There always is a rank between two others, at worst one digit longer:
+moving a shape rewrites its own rank only. Appending steps the last of
+RANK_STEP_LENGTH digits, so long runs of appends keep short ranks.
+
+When ranks grow over RANK_MAX_LENGTH, or shapes share a rank (the empty rank of
+shapes created before ranks), the layout is rebalanced with spaced_ranks.
+"""
+
+
+RANK_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+RANK_BASE = len(RANK_DIGITS)
+RANK_START = "i"
+RANK_STEP_LENGTH = 4
+RANK_MAX_LENGTH = 32
+
+FRONT, BACK, AFTER, BEFORE = "front", "back", "after", "before"
+ORDER_POSITIONS = [FRONT, BACK, AFTER, BEFORE]
+
+
+def rank_to_int(rank, length):
+    value = 0
+    for digit in rank.ljust(length, "0")[:length]:
+        value = value * RANK_BASE + RANK_DIGITS.index(digit)
+    return value
+
+
+def int_to_rank(value, length):
+    digits = []
+    for _ in range(length):
+        value, digit = divmod(value, RANK_BASE)
+        digits.append(RANK_DIGITS[digit])
+    return "".join(reversed(digits)).rstrip("0")
+
+
+def midpoint(low, high):
+    """Rank between low and high (None for 1), low < high."""
+    if high is not None:
+        # Common prefix
+        length = 0
+        while length < len(high) and (low[length] if length < len(low) else "0") == high[length]:
+            length += 1
+        if length:
+            return high[:length] + midpoint(low[length:], high[length:])
+
+    low_digit = RANK_DIGITS.index(low[0]) if low else 0
+    high_digit = RANK_DIGITS.index(high[0]) if high is not None else RANK_BASE
+    if high_digit - low_digit > 1:
+        return RANK_DIGITS[(low_digit + high_digit) // 2]
+    if high is not None and len(high) > 1:
+        return high[0]
+    return RANK_DIGITS[low_digit] + midpoint(low[1:], None)
+
+
+def rank_after(rank):
+    length = max(len(rank), RANK_STEP_LENGTH)
+    value = rank_to_int(rank, length) + 1
+    if value >= RANK_BASE ** length:
+        return midpoint(rank, None)
+    return int_to_rank(value, length)
+
+
+def rank_before(rank):
+    length = max(len(rank), RANK_STEP_LENGTH)
+    value = rank_to_int(rank, length) - 1
+    if value <= 0:
+        return midpoint("", rank)
+    return int_to_rank(value, length)
+
+
+def rank_between(below, above):
+    """
+    Rank sorting after below and before above, None meaning no shape on that side.
+    Returns None when there is no room: above is the empty rank, or the result
+    would be longer than RANK_MAX_LENGTH. The layout should be rebalanced then.
+    """
+    if below is None and above is None:
+        rank = RANK_START
+    elif above is None:
+        rank = rank_after(below) if below else RANK_START
+    elif above == "" or (below is not None and below >= above):
+        return None
+    elif below is None:
+        rank = rank_before(above)
+    else:
+        rank = midpoint(below, above)
+    return rank if len(rank) <= RANK_MAX_LENGTH else None
+
+
+def ranks_after(rank, count):
+    """count successive ranks above rank (None or "" for an empty layout)."""
+    ranks = []
+    for _ in range(count):
+        rank = rank_after(rank) if rank else RANK_START
+        ranks.append(rank)
+    return ranks
+
+
+def spaced_ranks(count):
+    """count increasing ranks spread over the lower half of the range, with room to insert between them."""
+    length = RANK_STEP_LENGTH
+    while RANK_BASE ** length < 2 * (count + 1) * RANK_BASE ** 2:
+        length += 1
+    step = RANK_BASE ** length // (2 * (count + 1))
+    return [int_to_rank(step * (index + 1), length) for index in range(count)]
+
+
+def moved_rank(ranks, position, target=None):
+    """
+    Rank of a shape moved to position among the sorted ranks of the other shapes, next to
+    ranks[target] for AFTER and BEFORE. Only the ranks around the target are looked at, so
+    ranks can be a window of the layout. None when there is no room or the target shares
+    its rank with another shape: rebalance and try again.
+    """
+    if position == FRONT:
+        return rank_between(ranks[-1] if ranks else None, None)
+    if position == BACK:
+        return rank_between(None, ranks[0] if ranks else None)
+
+    rank = ranks[target]
+    if (target > 0 and ranks[target - 1] == rank) or (target + 1 < len(ranks) and ranks[target + 1] == rank):
+        return None
+    if position == AFTER:
+        return rank_between(rank, ranks[target + 1] if target + 1 < len(ranks) else None)
+    return rank_between(ranks[target - 1] if target > 0 else None, rank)
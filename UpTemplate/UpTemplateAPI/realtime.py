@@ -0,0 +1,230 @@
+"""
+WebSocket endpoint carrying live shape updates between the editors of a template.
+
+    ws://<host>/ws/templates/<template_id>/?token=<access token>
+
+Clients send {"type": "shape.update", "layout": <id>, "id": <shape id>, "config": {...}}
+with camelCase transform / property fields. Updates are validated, rebuilt from the
+validated fields and forwarded right away to the other editors of the template, then
+merged per shape until the next flush, so a drag only hits the database once per
+REALTIME_FLUSH_INTERVAL. Updates of layouts of other templates are rejected.
+
+A flush that fails is logged and reported to every editor of the template with an
+{"type": "error", "layout": <id>, "ids": [shape ids], "errors": {...}} frame.
+"""
+import asyncio
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+from .models import Template, Layout
+from .serializers import ShapeLiveUpdateSerializer, dict_keys_snake_to_camel
+from .storage import get_shape_storage
+from .utils import camel_to_snake
+
+
+WEBSOCKET_PATH = re.compile(r"^/ws/templates/(?P<template_id>\d+)/?$")
+
+REALTIME_BROADCAST_BACKEND = getattr(settings, "REALTIME_BROADCAST_BACKEND", "UpTemplateAPI.realtime.InProcessBroadcast")
+REALTIME_FLUSH_INTERVAL = getattr(settings, "REALTIME_FLUSH_INTERVAL", 0.25)
+
+CLOSE_FORBIDDEN = 4403
+
+logger = logging.getLogger(__name__)
+
+
+def template_group(template_id):
+    return f"template-{template_id}"
+
+
+class InProcessBroadcast:
+    """
+    Fan-out between the connections of the current process.
+    Other backends (Redis pub/sub...) implement the same three coroutines.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    async def subscribe(self, group, queue):
+        self.groups.setdefault(group, set()).add(queue)
+
+    async def unsubscribe(self, group, queue):
+        queues = self.groups.get(group, set())
+        queues.discard(queue)
+        if not queues:
+            self.groups.pop(group, None)
+
+    async def publish(self, group, message, sender=None):
+        for queue in list(self.groups.get(group, ())):
+            if queue is not sender:
+                queue.put_nowait(message)
+
+
+_broadcast = None
+
+
+def get_broadcast():
+    global _broadcast
+    if _broadcast is None:
+        _broadcast = import_string(REALTIME_BROADCAST_BACKEND)()
+    return _broadcast
+
+
+def template_layout_ids(template_id):
+    return set(Layout.objects.filter(template=template_id).values_list("id", flat=True))
+
+
+def persist_shape_updates(template_id, layout_id, items):
+    layout = Layout.objects.filter(pk=layout_id, template=template_id).first()
+    if layout is None:
+        return
+    # Shapes deleted while being dragged are skipped instead of failing the batch
+    get_shape_storage(layout).update(layout, items, ShapeLiveUpdateSerializer, ignore_unknown=True)
+
+
+class ShapeUpdateCoalescer:
+    """Merges the updates of a template per shape and persists them at most once per flush interval."""
+
+    def __init__(self, template_id):
+        self.template_id = template_id
+        self.connections = 0
+        self.pending = {}
+        self.flush_task = None
+
+    def add(self, layout_id, shape_id, fields):
+        self.pending.setdefault((layout_id, shape_id), {}).update(fields)
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(REALTIME_FLUSH_INTERVAL)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        items_by_layout = {}
+        for (layout_id, shape_id), fields in pending.items():
+            items_by_layout.setdefault(layout_id, []).append({"id": shape_id, **fields})
+
+        for layout_id, items in items_by_layout.items():
+            try:
+                await sync_to_async(persist_shape_updates)(self.template_id, layout_id, items)
+            except Exception:
+                # Not retried, a batch that failed once would fail every flush. Editors reload the shapes instead
+                logger.exception("Live updates of layout %s failed", layout_id)
+                await get_broadcast().publish(template_group(self.template_id), {
+                    "type": "error", "layout": layout_id, "ids": [item["id"] for item in items],
+                    "errors": {"non_field_errors": ["The updates of these shapes were not saved."]},
+                })
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+
+coalescers = {}
+
+
+def authenticate(scope, template_id):
+    token = parse_qs(scope.get("query_string", b"").decode()).get("token", [None])[0]
+    if not token:
+        return False
+    try:
+        user_id = AccessToken(token)["user_id"]
+    except (TokenError, KeyError):
+        return False
+    return User.objects.filter(pk=user_id, is_active=True).exists() and Template.objects.filter(pk=template_id).exists()
+
+
+def parse_shape_update(text):
+    """
+    Returns (message, validated fields, errors) of a shape.update message, the message
+    rebuilt from the validated fields so only those are forwarded to the other editors.
+    """
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return None, None, {"non_field_errors": ["Invalid JSON."]}
+
+    if not isinstance(message, dict) or message.get("type") != "shape.update" or not isinstance(message.get("config"), dict):
+        return None, None, {"type": ["Expected a shape.update message with a config."]}
+    if not isinstance(message.get("layout"), int):
+        return None, None, {"layout": ["A layout id is required."]}
+
+    serializer = ShapeLiveUpdateSerializer(data={**camel_to_snake(message["config"]), "id": message.get("id")})
+    if not serializer.is_valid():
+        return None, None, serializer.errors
+
+    fields = dict(serializer.validated_data)
+    shape_id = fields.pop("id")
+    message = {"type": "shape.update", "layout": message["layout"], "id": shape_id, "config": dict_keys_snake_to_camel(fields)}
+    return message, fields, None
+
+
+async def forward(queue, send):
+    while True:
+        message = await queue.get()
+        await send({"type": "websocket.send", "text": json.dumps(message)})
+
+
+async def websocket_application(scope, receive, send):
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+
+    match = WEBSOCKET_PATH.match(scope["path"])
+    if not match or not await sync_to_async(authenticate)(scope, match["template_id"]):
+        await send({"type": "websocket.close", "code": CLOSE_FORBIDDEN})
+        return
+
+    template_id = int(match["template_id"])
+    group = template_group(template_id)
+    broadcast = get_broadcast()
+    coalescer = coalescers.setdefault(template_id, ShapeUpdateCoalescer(template_id))
+    coalescer.connections += 1
+
+    # Layouts created after the connection are looked up on their first update
+    layout_ids = await sync_to_async(template_layout_ids)(template_id)
+
+    await send({"type": "websocket.accept"})
+    queue = asyncio.Queue()
+    await broadcast.subscribe(group, queue)
+    forward_task = asyncio.ensure_future(forward(queue, send))
+
+    try:
+        while True:
+            event = await receive()
+            if event["type"] == "websocket.disconnect":
+                break
+            if event["type"] != "websocket.receive" or event.get("text") is None:
+                continue
+
+            message, fields, errors = parse_shape_update(event["text"])
+            if errors:
+                queue.put_nowait({"type": "error", "errors": errors})
+                continue
+            if message["layout"] not in layout_ids:
+                layout_ids = await sync_to_async(template_layout_ids)(template_id)
+                if message["layout"] not in layout_ids:
+                    queue.put_nowait({"type": "error", "errors": {"layout": ["Unknown layout."]}})
+                    continue
+
+            await broadcast.publish(group, message, sender=queue)
+            coalescer.add(message["layout"], message["id"], fields)
+    finally:
+        forward_task.cancel()
+        await broadcast.unsubscribe(group, queue)
+        coalescer.connections -= 1
+        if coalescer.connections == 0:
+            coalescers.pop(template_id, None)
+            await coalescer.close()
@@ -1,16 +1,49 @@
 from rest_framework import serializers
+from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
-from .models import Template, Rectangle, Circle, Media, Shape, Layout, Text, MediaContent
+from .models import Template, Rectangle, Circle, Media, Shape, Layout, Text, MediaContent, UploadSession, ExportJob
 from django.shortcuts import get_object_or_404
 from django.contrib.contenttypes.models import ContentType
-from .utils import flatten_dict
-import re
+from .utils import flatten_dict, register_key_case, snake_to_camel_key
+from .images import image_dimensions, InvalidImage, MEDIA_RENDER_MAX_WIDTH
+from .blobs import acquire_blob, release_blob
+from .ranks import ORDER_POSITIONS, AFTER, BEFORE
+from django.db import transaction
+from django.urls import reverse
+import math
 
 
 
+class SparseFieldsMixin:
+    """
+    Accepts fields=[names] to serialize only these fields, e.g. from ?fields=id,name
+    or ?summary=1 on a listing. Unknown names are ignored.
+    """
+    summary_fields = None
 
-class UserSerializer(serializers.ModelSerializer):
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+    @classmethod
+    def requested_fields(cls, request):
+        """Field names asked for by the request, None for every field."""
+        if request.query_params.get('summary') in ('1', 'true') and cls.summary_fields is not None:
+            return cls.summary_fields
+        fields = request.query_params.get('fields')
+        if fields:
+            return [name.strip() for name in fields.split(',') if name.strip()]
+        return None
+
+
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    summary_fields = ['username']
 
     class Meta:
         model = User
@@ -68,8 +101,8 @@ class MediaSerializer(serializers.ModelSerializer):
     
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        media_content = int(representation["media_content"])
-        media = MediaContentSerializer(instance=MediaContent.objects.get(pk=media_content))
+        # media_content is joined in by prefetch_shape_objects / select_related
+        media = MediaContentSerializer(instance=instance.media_content)
         representation["media_content"] = media.data
         return representation
 
@@ -92,16 +125,53 @@ class TextSerializer(serializers.ModelSerializer):
 
 
 
+def prefetch_shape_objects(shapes):
+    """
+    Load the concrete object of every shape with one in_bulk query per content type.
+    Returns a map (content_type_id, shape_id) -> concrete instance.
+    """
+    ids_by_content_type = {}
+    for shape in shapes:
+        ids_by_content_type.setdefault(shape.content_type_id, set()).add(shape.shape_id)
+
+    shape_objects = {}
+    for content_type_id, ids in ids_by_content_type.items():
+        model_data = CLASSNAME_TO_MODELS.get(CONTENT_TYPE_TO_CLASSNAME.get(str(content_type_id)))
+        if not model_data:
+            continue
+
+        queryset = model_data["model"].objects.all()
+        if model_data["model"] is Media:
+            queryset = queryset.select_related("media_content")
+
+        for pk, instance in queryset.in_bulk(ids).items():
+            shape_objects[(content_type_id, pk)] = instance
+
+    return shape_objects
+
+
+class ShapeListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        shapes = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        shape_objects = self.context.setdefault("shape_objects", {})
+        missing_shapes = [shape for shape in shapes if (shape.content_type_id, shape.shape_id) not in shape_objects]
+        shape_objects.update(prefetch_shape_objects(missing_shapes))
+        return super().to_representation(shapes)
+
+
 class ShapeSerializer(serializers.ModelSerializer):
     object = serializers.SerializerMethodField()
 
     class Meta:
         model = Shape
         fields = '__all__'
+        list_serializer_class = ShapeListSerializer
         
         extra_kwargs = {
             'shape_id': {'write_only': True},
             'layout': {'write_only': True},
+            'z_rank': {'read_only': True},
         }
     
 
@@ -114,23 +184,16 @@ class ShapeSerializer(serializers.ModelSerializer):
         
 
     def get_object(self, obj):
-        content_type = obj.content_type
-
-        if content_type.model == 'rectangle':
-            serializer = RectangleSerializer(Rectangle.objects.get(pk=obj.shape_id))
-
-        elif content_type.model == 'circle':
-            serializer = CircleSerializer(Circle.objects.get(pk=obj.shape_id))
+        model_data = CLASSNAME_TO_MODELS.get(CONTENT_TYPE_TO_CLASSNAME.get(str(obj.content_type_id)))
+        if not model_data:
+            return {}
 
-        elif content_type.model == 'media':
-            serializer = MediaSerializer(Media.objects.get(pk=obj.shape_id))
+        shape_objects = self.context.get("shape_objects", {})
+        instance = shape_objects.get((obj.content_type_id, obj.shape_id))
+        if instance is None:
+            instance = model_data["model"].objects.get(pk=obj.shape_id)
 
-        elif content_type.model == 'text':
-            serializer = TextSerializer(Text.objects.get(pk=obj.shape_id))
-        else:
-            serializer = None
-
-        return serializer.data if serializer else {}
+        return model_data["serializer"](instance).data
     
 
     def to_representation(self, instance):
@@ -152,12 +215,99 @@ class ShapeSerializer(serializers.ModelSerializer):
         return res
 
 
+class ShapeBulkSerializer(serializers.ModelSerializer):
+    """Validates the Shape columns of a bulk payload, layout and concrete object are set by the caller."""
+
+    class Meta:
+        model = Shape
+        exclude = ['layout', 'content_type', 'shape_id', 'z_rank']
+
+
+TRANSFORM_FIELDS = ['x', 'y', 'scale_x', 'scale_y', 'rotation', 'offset_x', 'offset_y']
+
+
+class ShapeTransformSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    x = serializers.FloatField(required=False)
+    y = serializers.FloatField(required=False)
+    scale_x = serializers.FloatField(required=False)
+    scale_y = serializers.FloatField(required=False)
+    rotation = serializers.FloatField(required=False)
+    offset_x = serializers.FloatField(required=False)
+    offset_y = serializers.FloatField(required=False)
+
+
+PROPERTY_FIELDS = [
+    'fill', 'stroke', 'stroke_width', 'opacity',
+    'shadow_color', 'shadow_blurr', 'shadow_offset_x', 'shadow_offset_y', 'shadow_opacity'
+]
+
+
+class ShapeLiveUpdateSerializer(serializers.ModelSerializer):
+    """Transform and property updates sent over the realtime connection."""
+    id = serializers.IntegerField()
+
+    class Meta:
+        model = Shape
+        fields = ['id'] + TRANSFORM_FIELDS + PROPERTY_FIELDS
+
+
+class ShapeOrderSerializer(serializers.Serializer):
+    """Z-order move: to the front or back of the layout, or right after / before the shape target."""
+    position = serializers.ChoiceField(choices=ORDER_POSITIONS)
+    target = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if attrs['position'] in (AFTER, BEFORE) and 'target' not in attrs:
+            raise serializers.ValidationError({'target': [f"Required to move a shape {attrs['position']} another."]})
+        return attrs
+
+
+LEFT, CENTER, RIGHT, TOP, MIDDLE, BOTTOM = "left", "center", "right", "top", "middle", "bottom"
+ALIGN_EDGES = [LEFT, CENTER, RIGHT, TOP, MIDDLE, BOTTOM]
+HORIZONTAL, VERTICAL = "horizontal", "vertical"
+DISTRIBUTE_AXES = [HORIZONTAL, VERTICAL]
+ALIGN, DISTRIBUTE, TRANSFORM = "align", "distribute", "transform"
+ARRANGE_OPERATIONS = [ALIGN, DISTRIBUTE, TRANSFORM]
+
+
+class ShapeArrangeSerializer(serializers.Serializer):
+    """
+    Layout arrange operation on the shapes ids, see geometry.py:
+    align to an edge of the selection, distribute along an axis, or scale then rotate
+    around an origin (the center of the selection unless both origin_x and origin_y are given).
+    """
+    shapes = serializers.ListField(child=serializers.IntegerField(), min_length=1)
+    operation = serializers.ChoiceField(choices=ARRANGE_OPERATIONS)
+    edge = serializers.ChoiceField(choices=ALIGN_EDGES, required=False)
+    axis = serializers.ChoiceField(choices=DISTRIBUTE_AXES, required=False)
+    scale_x = serializers.FloatField(required=False, default=1)
+    scale_y = serializers.FloatField(required=False, default=1)
+    rotation = serializers.FloatField(required=False, default=0)
+    origin_x = serializers.FloatField(required=False)
+    origin_y = serializers.FloatField(required=False)
+
+    def validate(self, attrs):
+        if attrs['operation'] == ALIGN and 'edge' not in attrs:
+            raise serializers.ValidationError({'edge': ["Required to align shapes."]})
+        if attrs['operation'] == DISTRIBUTE and 'axis' not in attrs:
+            raise serializers.ValidationError({'axis': ["Required to distribute shapes."]})
+        for name in ('scale_x', 'scale_y', 'rotation', 'origin_x', 'origin_y'):
+            if name in attrs and not math.isfinite(attrs[name]):
+                raise serializers.ValidationError({name: ["Expected a finite number."]})
+        for name in ('scale_x', 'scale_y'):
+            if attrs[name] == 0:
+                raise serializers.ValidationError({name: ["Scales cannot be zero."]})
+        attrs['shapes'] = list(dict.fromkeys(attrs['shapes']))
+        return attrs
+
+
 def snake_to_camel(string):
-    return re.sub(r'_([a-zA-Z])', lambda x: x.group(1).upper(), string) if string != "_id" else string
+    return snake_to_camel_key(string)
 
 
 def dict_keys_snake_to_camel(d):    
-    return {snake_to_camel(k): v for k, v in d.items()}
+    return {snake_to_camel_key(k): v for k, v in d.items()}
 
 
 def format_complex_fields(representation, content_type):
@@ -170,19 +320,42 @@ def format_complex_fields(representation, content_type):
 
 
 class LayoutSerializer(serializers.ModelSerializer):
+    # Shape ids bottom first, read from the z-order ranks; writing it reorders the whole layout
+    drawing_index_list = serializers.ListField(child=serializers.IntegerField(), required=False)
 
     class Meta:
         model = Layout
-        fields = '__all__'
+        exclude = ['storage', 'shapes_document']
     
 
     def to_representation(self, instance):
+        # storage imports this module
+        from .storage import get_shape_storage
+
         representation = super().to_representation(instance)
-        representation['shapes'] = ShapeSerializer(instance=Shape.objects.filter(layout=representation['id']), many=True).data
+        representation['shapes'] = get_shape_storage(instance).representations(instance, self.context)
+        representation['drawing_index_list'] = [shape['config']['_id'] for shape in representation['shapes']]
         return representation
 
-class TemplateSerializer(serializers.ModelSerializer):
+
+    def create(self, validated_data):
+        # A new layout has no shape to order
+        validated_data.pop('drawing_index_list', None)
+        return super().create(validated_data)
+
+
+    def update(self, instance, validated_data):
+        from .storage import get_shape_storage
+
+        drawing_index_list = validated_data.pop('drawing_index_list', None)
+        instance = super().update(instance, validated_data)
+        if drawing_index_list is not None:
+            get_shape_storage(instance).set_order(instance, drawing_index_list)
+        return instance
+
+class TemplateSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     layouts = LayoutSerializer(many=True, read_only=True)
+    summary_fields = ['id', 'name', 'width', 'height']
 
     def __init__(self, *args, **kwargs):
         super(TemplateSerializer, self).__init__(*args, **kwargs)
@@ -216,12 +389,90 @@ class MediaContentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = MediaContent
-        fields = '__all__'
+        exclude = ['blob']
+
+    def validate(self, attrs):
+        # The dimensions come from the uploaded image header, not from the client
+        if attrs.get('content'):
+            try:
+                attrs['original_width'], attrs['original_height'] = image_dimensions(attrs['content'])
+            except InvalidImage:
+                raise serializers.ValidationError({"content": ["Upload a valid image."]})
+        return attrs
+
+    def store_content(self, validated_data):
+        # Uploads are stored once per content, the row points at the shared blob file
+        if validated_data.get('content'):
+            blob = acquire_blob(validated_data['content'])
+            validated_data.update(blob=blob, content=blob.file.name)
+        return validated_data
+
+    def create(self, validated_data):
+        with transaction.atomic():
+            return super().create(self.store_content(validated_data))
+
+    def update(self, instance, validated_data):
+        previous_blob_id = instance.blob_id
+        with transaction.atomic():
+            instance = super().update(instance, self.store_content(validated_data))
+            if 'content' in validated_data and instance.blob_id != previous_blob_id:
+                release_blob(previous_blob_id)
+        return instance
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
         return representation
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    offset = serializers.IntegerField(source='received', read_only=True)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'size', 'sha256', 'offset', 'layout', 'width', 'height', 'alt']
+        read_only_fields = ['id']
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    """
+    Exports templates=[ids] as whole templates, every layout of template=id separately,
+    or the whole library of the user when neither is given.
+    """
+    templates = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, write_only=True)
+    template = serializers.IntegerField(required=False, write_only=True)
+    width = serializers.IntegerField(required=False, allow_null=True, min_value=1, max_value=MEDIA_RENDER_MAX_WIDTH)
+    total = serializers.SerializerMethodField()
+    artifact = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExportJob
+        fields = [
+            'id', 'fmt', 'width', 'templates', 'template', 'status', 'total', 'completed',
+            'artifact', 'error', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = ['id', 'status', 'completed', 'error', 'created_at', 'started_at', 'finished_at']
+
+    def validate(self, attrs):
+        if 'templates' in attrs and 'template' in attrs:
+            raise serializers.ValidationError({"template": ["Give either templates or template."]})
+        return attrs
+
+    def get_total(self, job):
+        return len(job.targets)
+
+    def get_artifact(self, job):
+        if job.status != ExportJob.DONE or not job.artifact:
+            return None
+        url = reverse('export-job-artifact', kwargs={'pk': job.id})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+register_key_case(
+    [field.name for model in (Shape, Rectangle, Circle, Text, Media, MediaContent) for field in model._meta.concrete_fields]
+    + ['shadow_offset', 'type']
+)
+
 SHAPE_MODEL_LIST = ['circle', 'rectangle', 'text', 'media']
 CONTENT_TYPE = {content_type.model:content_type.id for content_type in ContentType.objects.filter(model__in=SHAPE_MODEL_LIST)}
 
@@ -265,3 +516,6 @@ CONTENT_TYPE_TO_TYPE = {
     str(CONTENT_TYPE["media"]): "v-image",
     str(CONTENT_TYPE["text"]): "v-text"
 }
+
+# Representation type (v-rect, ...) -> shape class name (Rect, ...)
+TYPE_TO_CLASSNAME = {shape_type: CONTENT_TYPE_TO_CLASSNAME[content_type] for content_type, shape_type in CONTENT_TYPE_TO_TYPE.items()}
@@ -0,0 +1,164 @@
+"""
+Media file delivery.
+
+Files are answered with strong validators and long lived cache headers (blob
+files are named after their content, so they never change), single byte
+ranges, and either handed to the front proxy (MEDIA_SENDFILE = "x-accel-redirect"
+for nginx, "x-sendfile" for Apache / lighttpd) or streamed by a FileResponse,
+which the WSGI server turns into sendfile() for whole files.
+"""
+import mimetypes
+import os
+import re
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+
+RANGE = re.compile(r"^bytes=(?P<start>\d*)-(?P<end>\d*)$")
+IMMUTABLE_PREFIXES = ("blobs/",)
+# Compressed files are served as what they are, not decoded by the client, as FileResponse does
+ENCODED_CONTENT_TYPES = {
+    "br": "application/x-brotli",
+    "bzip2": "application/x-bzip",
+    "compress": "application/x-compress",
+    "gzip": "application/gzip",
+    "xz": "application/x-xz",
+}
+
+
+class RangeFile:
+    """Reads at most length bytes of a file from start. Has no fileno, so servers do not sendfile past the range."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """(start, end) of a single byte range, None to send the whole file, False when it cannot be satisfied."""
+    match = RANGE.match(header.strip()) if header else None
+    if not match or not (match["start"] or match["end"]):
+        # Multiple or malformed ranges: the whole file is a valid answer
+        return None
+
+    if not match["start"]:
+        suffix = int(match["end"])
+        if suffix == 0:
+            return False
+        return max(0, size - suffix), size - 1
+
+    start = int(match["start"])
+    if match["end"] and int(match["end"]) < start:
+        # Invalid range, ignored
+        return None
+    end = min(int(match["end"]), size - 1) if match["end"] else size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def media_etag(name, stat):
+    if name.startswith(IMMUTABLE_PREFIXES):
+        # blobs/ab/cd/<sha256>.<ext>
+        return quote_etag(os.path.splitext(os.path.basename(name))[0])
+    return quote_etag(f"{stat.st_size:x}-{stat.st_mtime_ns:x}")
+
+
+def cache_control(name):
+    if name.startswith(IMMUTABLE_PREFIXES):
+        return "public, max-age=31536000, immutable"
+    return f"public, max-age={getattr(settings, 'MEDIA_CACHE_MAX_AGE', 3600)}"
+
+
+def set_headers(response, headers):
+    for header, value in headers.items():
+        response.headers[header] = value
+
+
+def sendfile_response(name, path):
+    mode = getattr(settings, "MEDIA_SENDFILE", None)
+    if mode == "x-accel-redirect":
+        response = HttpResponse()
+        response.headers["X-Accel-Redirect"] = getattr(settings, "MEDIA_ACCEL_REDIRECT_PREFIX", "/protected-media/") + name
+        return response
+    if mode == "x-sendfile":
+        response = HttpResponse()
+        response.headers["X-Sendfile"] = path
+        return response
+    return None
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(str(settings.MEDIA_ROOT), path)
+    except SuspiciousFileOperation:
+        raise Http404("Not found.")
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404("Not found.")
+    if not os.path.isfile(full_path):
+        raise Http404("Not found.")
+
+    name = path.replace(os.sep, "/")
+    etag = media_etag(name, stat)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    validators = {
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": cache_control(name),
+        "Accept-Ranges": "bytes",
+    }
+    if not_modified is not None:
+        set_headers(not_modified, validators)
+        return not_modified
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = ENCODED_CONTENT_TYPES.get(encoding, content_type) or "application/octet-stream"
+
+    # The proxy reads the file and answers ranges itself
+    response = sendfile_response(name, full_path)
+    if response is not None:
+        response.headers["Content-Type"] = content_type
+        set_headers(response, validators)
+        return response
+
+    byte_range = None
+    if request.headers.get("If-Range", etag) == etag:
+        byte_range = parse_range(request.headers.get("Range"), stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response.headers["Content-Range"] = f"bytes */{stat.st_size}"
+        set_headers(response, validators)
+        return response
+
+    file = open(full_path, "rb")
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), content_type=content_type, status=206)
+        response.headers["Content-Length"] = str(end - start + 1)
+        response.headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    set_headers(response, validators)
+    return response
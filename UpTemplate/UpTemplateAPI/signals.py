@@ -0,0 +1,150 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.contrib.contenttypes.models import ContentType
+from .models import Template, Layout, Shape, Rectangle, Circle, Text, Media, MediaContent, TemplateChange
+from .cache import bump_template_version
+from .blobs import release_blob
+from .snapping import boxes_changed
+from contextlib import contextmanager
+import functools
+import threading
+
+
+_state = threading.local()
+
+
+@contextmanager
+def muted_receivers():
+    """Silence the receivers below, for callers that touch the template themselves once done."""
+    _state.muted = True
+    try:
+        yield
+    finally:
+        _state.muted = False
+
+
+def unless_muted(receiver_function):
+    @functools.wraps(receiver_function)
+    def wrapper(*args, **kwargs):
+        if not getattr(_state, "muted", False):
+            receiver_function(*args, **kwargs)
+    return wrapper
+
+
+def bump_template_version_on_commit(template_id):
+    # Bumped once the write is visible: a read in between renders the old rows under the old version
+    transaction.on_commit(lambda: bump_template_version(template_id))
+
+
+def touch_template(template_id, target=None, action=None, object_ids=(), layout_id=None):
+    """
+    Bump the revision stamp and the document cache version of a template,
+    and append the given changes to its change log under the new revision.
+    """
+    if template_id is None:
+        return
+
+    # No savepoint: a failed touch fails the write it belongs to
+    with transaction.atomic(savepoint=False):
+        # Locked until the changes are logged, a concurrent touch waits and takes the next revision
+        revision = Template.objects.select_for_update().filter(pk=template_id).values_list("revision", flat=True).first()
+        if revision is not None:
+            revision += 1
+            Template.objects.filter(pk=template_id).update(revision=revision, updated_at=timezone.now())
+        if revision is not None and target and action and object_ids:
+            TemplateChange.objects.bulk_create([
+                TemplateChange(template_id=template_id, revision=revision, target=target, action=action,
+                               object_id=object_id, layout_id=layout_id)
+                for object_id in object_ids
+            ])
+    bump_template_version_on_commit(template_id)
+
+
+def get_action(instance, created=False, **kwargs):
+    """Change action of a post_save / post_delete signal, None for deletes cascading from a parent."""
+    if kwargs["signal"] is post_save:
+        return TemplateChange.CREATE if created else TemplateChange.UPDATE
+
+    origin = kwargs.get("origin")
+    if origin is None or origin is instance or getattr(origin, "model", None) is type(instance):
+        return TemplateChange.DELETE
+    return None
+
+
+def touch_shapes(shapes):
+    for shape_id, layout_id, template_id in shapes.values_list("_id", "layout_id", "layout__template_id"):
+        touch_template(template_id, TemplateChange.SHAPE, TemplateChange.UPDATE, [shape_id], layout_id)
+
+
+@receiver([post_save, post_delete], sender=Template)
+@unless_muted
+def template_changed(sender, instance, created=False, **kwargs):
+    if kwargs["signal"] is post_save and not created:
+        touch_template(instance.id, TemplateChange.TEMPLATE, TemplateChange.UPDATE, [instance.id])
+    else:
+        bump_template_version_on_commit(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Layout)
+@unless_muted
+def layout_changed(sender, instance, **kwargs):
+    action = get_action(instance, **kwargs)
+    touch_template(instance.template_id, TemplateChange.LAYOUT, action, [instance.id], instance.id)
+
+
+@receiver([post_save, post_delete], sender=Shape)
+@unless_muted
+def shape_changed(sender, instance, **kwargs):
+    action = get_action(instance, **kwargs)
+    template_id = Layout.objects.filter(pk=instance.layout_id).values_list("template_id", flat=True).first()
+    touch_template(template_id, TemplateChange.SHAPE, action, [instance.pk], instance.layout_id)
+
+
+@receiver([post_save, post_delete], sender=Rectangle)
+@receiver([post_save, post_delete], sender=Circle)
+@receiver([post_save, post_delete], sender=Text)
+@receiver([post_save, post_delete], sender=Media)
+@unless_muted
+def shape_object_changed(sender, instance, **kwargs):
+    content_type = ContentType.objects.get_for_model(sender)
+    touch_shapes(Shape.objects.filter(content_type=content_type, shape_id=instance.id))
+
+
+@receiver(post_save, sender=Shape)
+def shape_saved(sender, instance, **kwargs):
+    # Not muted, the spatial index must follow every write. spatial reads the content types on import
+    from .spatial import index_shapes
+    index_shapes([instance.pk])
+
+
+@receiver(post_save, sender=Rectangle)
+@receiver(post_save, sender=Circle)
+@receiver(post_save, sender=Text)
+@receiver(post_save, sender=Media)
+def shape_object_saved(sender, instance, **kwargs):
+    from .spatial import index_shapes
+    content_type = ContentType.objects.get_for_model(sender)
+    index_shapes(Shape.objects.filter(content_type=content_type, shape_id=instance.id).values_list("_id", flat=True))
+
+
+@receiver(post_delete, sender=Shape)
+@unless_muted
+def shape_deleted(sender, instance, **kwargs):
+    # Muted deletes drop the boxes of their whole layouts instead
+    boxes_changed({instance.layout_id: {instance.pk: None}})
+
+
+@receiver([post_save, post_delete], sender=MediaContent)
+@unless_muted
+def media_content_changed(sender, instance, **kwargs):
+    content_type = ContentType.objects.get_for_model(Media)
+    medias = Media.objects.filter(media_content=instance.id).values("id")
+    touch_shapes(Shape.objects.filter(content_type=content_type, shape_id__in=medias))
+
+
+@receiver(post_delete, sender=MediaContent)
+def media_content_deleted(sender, instance, **kwargs):
+    # Not muted, blob references must stay exact
+    release_blob(instance.blob_id)
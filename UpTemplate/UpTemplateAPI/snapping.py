@@ -0,0 +1,162 @@
+"""
+Snapping guides.
+
+An EdgeIndex keeps the left, center and right edges of the shape boxes of a
+layout in one sorted list, and their top, middle and bottom edges in another,
+as (coordinate, shape id, edge) tuples. The snap candidates of a dragged box are
+the edges within the tolerance of its own, two binary searches per edge of the
+box: O(log n + k) for k candidates instead of a scan of every shape.
+
+The boxes are the spatial index boxes (see spatial.py), the bounds the editor
+draws its selection with. Indexes are kept per process for the last
+SNAP_INDEX_LAYOUTS layouts read, stamped with a version:
+
+- row stored layouts: the layout boxes version of the shared cache, bumped once
+  the writes to their boxes are committed. The process that wrote them moves
+  the edges of the changed shapes in place; the others see a newer version and
+  rebuild on their next read.
+- document stored layouts: the revision of their document, rebuilt when it changes.
+
+The layout boxes versions live in the TEMPLATE_DOCUMENT_CACHE cache, which must be
+shared by the workers (Redis, Memcached): with a per process backend such as
+LocMemCache a worker never sees the bumps of the others and snaps to stale edges.
+"""
+import bisect
+import math
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+from .cache import bump_layout_boxes_version
+
+
+SNAP_INDEX_LAYOUTS = getattr(settings, "SNAP_INDEX_LAYOUTS", 128)
+SNAP_DEFAULT_TOLERANCE = getattr(settings, "SNAP_DEFAULT_TOLERANCE", 5)
+SNAP_MAX_TOLERANCE = getattr(settings, "SNAP_MAX_TOLERANCE", 100)
+
+# Edge names by axis, in the order of edge_coordinates
+AXIS_EDGES = (("left", "center", "right"), ("top", "middle", "bottom"))
+
+
+def edge_coordinates(box, axis):
+    start, end = box[axis], box[axis + 2]
+    return start, (start + end) / 2, end
+
+
+def candidate_order(candidate):
+    return abs(candidate["offset"]), candidate["shape"], candidate["edge"], candidate["targetEdge"]
+
+
+class EdgeIndex:
+    """Sorted edges of the boxes {shape id: (x0, y0, x1, y1)} of a layout, see the module docstring."""
+
+    def __init__(self, boxes, version):
+        self.version = version
+        self.boxes = dict(boxes)
+        self.edges = tuple(
+            sorted(
+                (coordinate, shape_id, edge)
+                for shape_id, box in self.boxes.items()
+                for edge, coordinate in enumerate(edge_coordinates(box, axis))
+            )
+            for axis in (0, 1)
+        )
+
+
+    def __len__(self):
+        return len(self.boxes)
+
+
+    def remove(self, shape_id):
+        box = self.boxes.pop(shape_id, None)
+        if box is None:
+            return
+        for axis, edges in enumerate(self.edges):
+            for edge, coordinate in enumerate(edge_coordinates(box, axis)):
+                index = bisect.bisect_left(edges, (coordinate, shape_id, edge))
+                if index < len(edges) and edges[index] == (coordinate, shape_id, edge):
+                    del edges[index]
+
+
+    def update(self, boxes):
+        """Apply {shape id: box, or None once deleted}."""
+        for shape_id, box in boxes.items():
+            self.remove(shape_id)
+            if box is not None:
+                self.boxes[shape_id] = tuple(box)
+                for axis, edges in enumerate(self.edges):
+                    for edge, coordinate in enumerate(edge_coordinates(box, axis)):
+                        bisect.insort(edges, (coordinate, shape_id, edge))
+
+
+    def candidates(self, box, tolerance, exclude=()):
+        """
+        {"x": [...], "y": [...]} edges of other shapes within tolerance of the edges of box, nearest first:
+        {"edge": edge of box, "shape": id, "targetEdge": its edge, "position": its coordinate, "offset": position - edge}.
+        """
+        exclude = set(exclude)
+        result = {}
+        for axis, edges in enumerate(self.edges):
+            candidates = []
+            for edge, value in enumerate(edge_coordinates(box, axis)):
+                start = bisect.bisect_left(edges, (value - tolerance,))
+                end = bisect.bisect_right(edges, (value + tolerance, math.inf))
+                candidates.extend(
+                    {
+                        "edge": AXIS_EDGES[axis][edge], "shape": shape_id, "targetEdge": AXIS_EDGES[axis][target_edge],
+                        "position": coordinate, "offset": coordinate - value,
+                    }
+                    for coordinate, shape_id, target_edge in edges[start:end] if shape_id not in exclude
+                )
+            candidates.sort(key=candidate_order)
+            result["xy"[axis]] = candidates
+        return result
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def snap_candidates(layout_id, version, load_boxes, box, tolerance, exclude=()):
+    """
+    EdgeIndex.candidates from the index of the layout at version, built from
+    load_boxes() when the process has no index of that version.
+    """
+    with _lock:
+        index = _indexes.get(layout_id)
+        if index is not None and index.version == version:
+            _indexes.move_to_end(layout_id)
+            return index.candidates(box, tolerance, exclude)
+
+    # Built outside the lock, version was read before the boxes so a concurrent write only costs a rebuild
+    index = EdgeIndex(load_boxes(), version)
+    with _lock:
+        _indexes[layout_id] = index
+        _indexes.move_to_end(layout_id)
+        while len(_indexes) > SNAP_INDEX_LAYOUTS:
+            _indexes.popitem(last=False)
+        return index.candidates(box, tolerance, exclude)
+
+
+def apply_box_changes(changes):
+    for layout_id, boxes in changes.items():
+        version = bump_layout_boxes_version(layout_id)
+        with _lock:
+            index = _indexes.get(layout_id)
+            if index is None:
+                continue
+            if boxes is not None and index.version == version - 1:
+                index.update(boxes)
+                index.version = version
+            else:
+                # Written by another process in between, the counter was lost, or dropped
+                del _indexes[layout_id]
+
+
+def boxes_changed(changes):
+    """
+    Record {layout id: {shape id: box, or None once deleted}} of row stored shapes, applied on commit.
+    None instead of the boxes of a layout drops its indexes, for writes that do not list them.
+    """
+    if changes:
+        transaction.on_commit(lambda: apply_box_changes(changes))
@@ -0,0 +1,240 @@
+"""
+Spatial index of the shapes of a layout.
+
+Bounding boxes follow the Konva transform model the exports are drawn with: the
+local box of the shape (Rect and Image from their top left corner, Circle around
+its center, Text estimated from its font size), grown by half the stroke width,
+through translate(x, y) rotate(rotation) scale(scaleX, scaleY) translate(-offsetX, -offsetY).
+
+Row stored shapes have one ShapeBox row in a hierarchical grid: the box goes to
+the finest level whose cells, SPATIAL_CELL_SIZE * 2 ** level canvas units wide,
+are as large as the box, in the cell holding its top left corner. A box at level
+L overlapping a query starts less than one cell before it, so a query reads one
+(layout, level, cell_x, cell_y) index range per level. Boxes larger than the
+coarsest cells have no level and are read by every query.
+
+The box also keeps the local box, so transform updates move it without reading
+the concrete rows. Writes reindex the shapes they touch, and hand the boxes to the
+snapping indexes (see snapping.py); the index_shapes command rebuilds everything.
+Document stored layouts are read whole anyway, their shapes are filtered in memory.
+"""
+import math
+from django.conf import settings
+from django.db.models import Q
+from .encoders import encode_shape_rows, SHAPE_ROW_COLUMNS
+from .models import Shape, ShapeBox
+from .serializers import CONTENT_TYPE_TO_TYPE, TYPE_TO_CLASSNAME
+from .snapping import boxes_changed
+from .utils import snake_to_camel_key
+
+
+SPATIAL_CELL_SIZE = getattr(settings, "SPATIAL_CELL_SIZE", 512)
+SPATIAL_LEVELS = getattr(settings, "SPATIAL_LEVELS", 8)
+
+# Average glyph advance in font sizes, the browser measures text, the server estimates it
+TEXT_ADVANCE = 0.6
+
+# Shape columns the box depends on, besides the concrete object
+SHAPE_BOX_FIELDS = ['x', 'y', 'offset_x', 'offset_y', 'scale_x', 'scale_y', 'rotation', 'stroke', 'stroke_width']
+PLACEMENT_FIELDS = ['level', 'cell_x', 'cell_y', 'x0', 'y0', 'x1', 'y1']
+
+
+# Affine transforms are (a, b, c, d, e, f): x' = a x + b y + c, y' = d x + e y + f, as Pillow takes them
+
+def shape_matrix(config):
+    """Transform from the shape coordinates to the layout ones."""
+    angle = math.radians(config.get("rotation") or 0)
+    cos, sin = math.cos(angle), math.sin(angle)
+    scale_x, scale_y = config.get("scaleX", 1), config.get("scaleY", 1)
+    offset_x, offset_y = config.get("offsetX") or 0, config.get("offsetY") or 0
+    a, b, d, e = cos * scale_x, -sin * scale_y, sin * scale_x, cos * scale_y
+    return (a, b, (config.get("x") or 0) - a * offset_x - b * offset_y, d, e, (config.get("y") or 0) - d * offset_x - e * offset_y)
+
+
+def multiply(m, n):
+    """m applied after n."""
+    a, b, c, d, e, f = m
+    g, h, i, j, k, l = n
+    return (a * g + b * j, a * h + b * k, a * i + b * l + c, d * g + e * j, d * h + e * k, d * i + e * l + f)
+
+
+def invert(m):
+    a, b, c, d, e, f = m
+    det = a * e - b * d
+    return (e / det, -b / det, (b * f - e * c) / det, -d / det, a / det, (d * c - a * f) / det)
+
+
+def apply(m, x, y):
+    return m[0] * x + m[1] * y + m[2], m[3] * x + m[4] * y + m[5]
+
+
+def scaling(m):
+    """Average length a unit of the source takes once transformed."""
+    return math.sqrt(abs(m[0] * m[4] - m[1] * m[3]))
+
+
+# Boxes are (x0, y0, x1, y1), x0 <= x1 and y0 <= y1
+
+def parse_box(value):
+    """Box of an "x0,y0,x1,y1" query parameter, ValueError when malformed."""
+    coordinates = [float(part) for part in value.split(",")]
+    if len(coordinates) != 4 or not all(map(math.isfinite, coordinates)):
+        raise ValueError("Expected x0,y0,x1,y1.")
+    x0, y0, x1, y1 = coordinates
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def local_box(shape_type, config):
+    """Box of a shape in its own coordinates, without the stroke."""
+    if shape_type == "Circle":
+        radius = abs(config.get("radius") or 0)
+        return -radius, -radius, radius, radius
+    if shape_type == "Text":
+        font_size = config.get("fontSize") or 12
+        lines = str(config.get("text") or "").split("\n")
+        return 0, 0, max(map(len, lines)) * font_size * TEXT_ADVANCE, len(lines) * font_size
+
+    width, height = config.get("width") or 0, config.get("height") or 0
+    return min(0, width), min(0, height), max(0, width), max(0, height)
+
+
+def stroke_margin(config):
+    return (config.get("strokeWidth") or 0) / 2 if config.get("stroke") else 0
+
+
+def world_box(local, config):
+    """Box in layout coordinates of the local box of a shape with the given config."""
+    margin = stroke_margin(config)
+    x0, y0, x1, y1 = local[0] - margin, local[1] - margin, local[2] + margin, local[3] + margin
+    matrix = shape_matrix(config)
+    points = [apply(matrix, x, y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+    xs, ys = [x for x, _ in points], [y for _, y in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def shape_box(shape):
+    """Box of a shape representation in layout coordinates."""
+    return world_box(local_box(TYPE_TO_CLASSNAME.get(shape["type"]), shape["config"]), shape["config"])
+
+
+def overlaps(box, other):
+    return box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]
+
+
+def contains_point(shape, x, y):
+    """Whether the point of the layout falls on the shape, stroke included."""
+    config = shape["config"]
+    matrix = shape_matrix(config)
+    if matrix[0] * matrix[4] - matrix[1] * matrix[3] == 0:
+        return False
+    local_x, local_y = apply(invert(matrix), x, y)
+
+    shape_type = TYPE_TO_CLASSNAME.get(shape["type"])
+    margin = stroke_margin(config)
+    if shape_type == "Circle":
+        return math.hypot(local_x, local_y) <= abs(config.get("radius") or 0) + margin
+    x0, y0, x1, y1 = local_box(shape_type, config)
+    return x0 - margin <= local_x <= x1 + margin and y0 - margin <= local_y <= y1 + margin
+
+
+def place(box):
+    """(level, cell_x, cell_y) of a box, level None past the coarsest cells."""
+    extent = max(box[2] - box[0], box[3] - box[1])
+    for level in range(SPATIAL_LEVELS):
+        size = SPATIAL_CELL_SIZE * 2 ** level
+        if extent <= size:
+            return level, math.floor(box[0] / size), math.floor(box[1] / size)
+    return None, 0, 0
+
+
+def set_box(shape_box_row, local, config):
+    box = world_box(local, config)
+    shape_box_row.level, shape_box_row.cell_x, shape_box_row.cell_y = place(box)
+    shape_box_row.x0, shape_box_row.y0, shape_box_row.x1, shape_box_row.y1 = box
+    return shape_box_row
+
+
+def new_box(shape_id, layout_id, shape_type, config):
+    local = local_box(shape_type, config)
+    return set_box(ShapeBox(
+        shape_id=shape_id, layout_id=layout_id,
+        local_x0=local[0], local_y0=local[1], local_x1=local[2], local_y1=local[3]
+    ), local, config)
+
+
+def transform_config(shape):
+    """Config keys of the SHAPE_BOX_FIELDS of a Shape instance."""
+    return {snake_to_camel_key(name): getattr(shape, name) for name in SHAPE_BOX_FIELDS}
+
+
+def boxes_written(boxes):
+    changes = {}
+    for box in boxes:
+        changes.setdefault(box.layout_id, {})[box.shape_id] = (box.x0, box.y0, box.x1, box.y1)
+    boxes_changed(changes)
+
+
+def index_shapes(shape_ids):
+    """Rebuild the boxes of row stored shapes, reading their concrete rows."""
+    shape_ids = list(shape_ids)
+    if not shape_ids:
+        return
+    rows = list(Shape.objects.filter(pk__in=shape_ids).values_list(*SHAPE_ROW_COLUMNS))
+    ShapeBox.objects.filter(shape__in=shape_ids).delete()
+    boxes_written(ShapeBox.objects.bulk_create([
+        new_box(shape["config"]["_id"], layout_id, TYPE_TO_CLASSNAME.get(shape["type"]), shape["config"])
+        for layout_id, shape in encode_shape_rows(rows)
+    ]))
+
+
+def index_new_shapes(shapes, objects):
+    """Boxes of just created Shape instances and their concrete objects, in one INSERT."""
+    boxes_written(ShapeBox.objects.bulk_create([
+        new_box(shape.pk, shape.layout_id, TYPE_TO_CLASSNAME.get(CONTENT_TYPE_TO_TYPE[str(shape.content_type_id)]), {
+            **{snake_to_camel_key(field.name): field.value_from_object(obj) for field in obj._meta.concrete_fields},
+            **transform_config(shape),
+        })
+        for shape, obj in zip(shapes, objects)
+    ]))
+
+
+def with_boxes(queryset, fields):
+    """Shapes loaded with the fields move_boxes needs, besides fields."""
+    return queryset.select_related("box").only(*fields, *SHAPE_BOX_FIELDS, "box")
+
+
+def move_boxes(shapes):
+    """Update the boxes of shapes loaded by with_boxes after their transform changed."""
+    moved, missing = [], []
+    for shape in shapes:
+        try:
+            box = shape.box
+        except ShapeBox.DoesNotExist:
+            missing.append(shape.pk)
+            continue
+        moved.append(set_box(box, (box.local_x0, box.local_y0, box.local_x1, box.local_y1), transform_config(shape)))
+
+    if moved:
+        ShapeBox.objects.bulk_update(moved, PLACEMENT_FIELDS)
+        boxes_written(moved)
+    # Shapes created before the index
+    index_shapes(missing)
+
+
+def index_layouts(layout_ids):
+    """Rebuild the index of every row stored shape of the layouts."""
+    index_shapes(Shape.objects.filter(layout__in=layout_ids).values_list("_id", flat=True))
+
+
+def shapes_in_box(layout_id, box):
+    """Ids of the row stored shapes of a layout whose box overlaps box, as a subquery."""
+    x0, y0, x1, y1 = box
+    cells = Q(level__isnull=True)
+    for level in range(SPATIAL_LEVELS):
+        size = SPATIAL_CELL_SIZE * 2 ** level
+        cells |= Q(
+            level=level,
+            cell_x__range=(math.floor((x0 - size) / size), math.floor(x1 / size)),
+            cell_y__range=(math.floor((y0 - size) / size), math.floor(y1 / size)),
+        )
+    return ShapeBox.objects.filter(cells, layout=layout_id, x0__lte=x1, x1__gte=x0, y0__lte=y1, y1__gte=y0).values("shape")
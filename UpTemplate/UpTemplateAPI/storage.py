@@ -0,0 +1,594 @@
+"""
+Where the shapes of a layout live.
+
+RowShapeStorage keeps one Shape row per shape plus a row in the concrete table
+(Rectangle, Circle, Text, Media) joined through content_type / shape_id.
+
+DocumentShapeStorage keeps all the shapes of a layout in Layout.shapes_document:
+
+    {"version": 1, "revision": 12, "next_id": 43, "shapes": [
+        {"_id": 1, "type": "Rect", "x": 0.0, ..., "object": {"width": 10.0, "height": 20.0}},
+        ...
+    ]}
+
+so a whole layout is read with its own row. Both storages return the exact
+{"type": ..., "config": ...} representation of ShapeSerializer, in z-order:
+by Shape.z_rank then id, from the (layout, z_rank) index for rows, and the
+order records are kept in for documents.
+"""
+from django.db import transaction
+from .geometry import Selection, arrange_selection
+from .encoders import encode_shapes, encode_shape_rows, SHAPE_ROW_COLUMNS
+from .pagination import KeyedList
+from .bulk import bulk_create_shapes, bulk_update_shapes, validate_shape_payloads, validate_shape_updates
+from .cache import get_layout_boxes_version
+from .models import Layout, Shape, ShapeBox, MediaContent, TemplateChange
+from .ranks import BACK, AFTER, BEFORE, moved_rank, ranks_after, spaced_ranks
+from .serializers import (
+    ShapeSerializer, ShapeTransformSerializer, ShapeBulkSerializer,
+    CLASSNAME_TO_MODELS, CONTENT_TYPE_TO_CLASSNAME, prefetch_shape_objects
+)
+from .signals import touch_template, bump_template_version_on_commit, muted_receivers
+from .snapping import boxes_changed, snap_candidates
+from .spatial import contains_point, index_shapes, overlaps, shape_box, shapes_in_box
+from .utils import flattern_to_nested
+
+
+DOCUMENT_VERSION = 1
+
+SHAPE_COLUMNS = [
+    field for field in Shape._meta.concrete_fields
+    if field.name not in ('_id', 'layout', 'content_type', 'shape_id')
+]
+
+
+Z_ORDER = ['z_rank', '_id']
+
+
+def z_order_key(record):
+    return (record.get('z_rank', ''), record['_id'])
+
+
+def object_fields(model):
+    return [field for field in model._meta.concrete_fields if field.name != 'id']
+
+
+def unknown_shape_errors(layout, shape_ids):
+    return {"id": [f"Unknown shape {shape_id} in layout {layout.id}." for shape_id in sorted(shape_ids)]}
+
+
+class RowShapeStorage:
+
+    def shapes(self, layout, bbox=None):
+        shapes = Shape.objects.filter(layout=layout.id)
+        return shapes if bbox is None else shapes.filter(pk__in=shapes_in_box(layout.id, bbox))
+
+
+    def representations(self, layout, context=None, bbox=None):
+        """Representations in z-order, of the shapes overlapping bbox when given."""
+        # Encoded by load_template_tree when the whole template is read
+        shapes = getattr(layout, 'loaded_shapes', None) if bbox is None else None
+        if shapes is None:
+            shapes = encode_shapes(self.shapes(layout, bbox).order_by(*Z_ORDER))
+        return shapes
+
+
+    def paginate(self, layout, paginate, bbox=None):
+        """Representations of the page paginate(source) picks, source being keyed by _id."""
+        page = paginate(self.shapes(layout, bbox).values_list(*SHAPE_ROW_COLUMNS))
+        return [representation for _, representation in encode_shape_rows(page)]
+
+
+    def hit_test(self, layout, x, y):
+        """Representations of the shapes under the point, topmost first."""
+        shapes = encode_shapes(self.shapes(layout, (x, y, x, y)).order_by(*Z_ORDER))
+        return [shape for shape in reversed(shapes) if contains_point(shape, x, y)]
+
+
+    def snap(self, layout, box, tolerance, exclude=()):
+        """Snapping guide candidates of box among the shapes of the layout, see snapping.py."""
+        def load_boxes():
+            return {row[0]: row[1:] for row in ShapeBox.objects.filter(layout=layout.id).values_list("shape", "x0", "y0", "x1", "y1")}
+
+        return snap_candidates(layout.id, get_layout_boxes_version(layout.id), load_boxes, box, tolerance, exclude)
+
+
+    def get(self, layout, shape_id):
+        shapes = encode_shapes(Shape.objects.filter(layout=layout.id, pk=shape_id))
+        return shapes[0] if shapes else None
+
+
+    def create(self, layout, items):
+        shapes, errors = bulk_create_shapes(layout, items)
+        if errors:
+            return None, errors
+        return ShapeSerializer(instance=shapes, many=True).data, None
+
+
+    def update(self, layout, items, serializer_class=ShapeTransformSerializer, ignore_unknown=False):
+        return bulk_update_shapes(layout, items, serializer_class, ignore_unknown)
+
+
+    def arrange(self, layout, shape_ids, **options):
+        """Align, distribute or transform the shapes together (see geometry.py), returns (transform updates, errors)."""
+        with transaction.atomic():
+            selection = Selection.from_rows(layout.id, shape_ids)
+            unknown_ids = set(shape_ids) - set(selection.ids)
+            if unknown_ids:
+                return None, unknown_shape_errors(layout, unknown_ids)
+
+            updates = arrange_selection(selection, **options)
+            _, errors = bulk_update_shapes(layout, updates)
+        return (None, errors) if errors else (updates, None)
+
+
+    def replace(self, layout, shape_id, data):
+        shape_instance = Shape.objects.filter(layout=layout.id, pk=shape_id).first()
+        if shape_instance is None:
+            return None, unknown_shape_errors(layout, [shape_id])
+
+        fields = [field.name for field in shape_instance.content_object._meta.fields if field.name != "id"]
+
+        snake_case_data = flattern_to_nested(data, fields, "updated_object")
+        nested_object_data = snake_case_data.pop('updated_object')
+        nested_serializer = CLASSNAME_TO_MODELS[CONTENT_TYPE_TO_CLASSNAME[str(shape_instance.content_type_id)]]["serializer"]
+
+        updated_nested_object = nested_serializer(shape_instance.content_object, data=nested_object_data)
+        if updated_nested_object.is_valid():
+            updated_nested_object.save()
+
+        serializer = ShapeSerializer(instance=shape_instance, data=snake_case_data)
+        if not serializer.is_valid():
+            return None, serializer.errors
+
+        serializer.save()
+        return serializer.data, None
+
+
+    def rank_window(self, shapes, position, target_rank):
+        """The sorted ranks moved_rank needs: the top or bottom one, or the target one and its neighbours."""
+        if position not in (AFTER, BEFORE):
+            rank = shapes.order_by('z_rank' if position == BACK else '-z_rank').values_list('z_rank', flat=True).first()
+            return [] if rank is None else [rank]
+
+        below = shapes.filter(z_rank__lt=target_rank).order_by('-z_rank').values_list('z_rank', flat=True).first()
+        above = shapes.filter(z_rank__gt=target_rank).order_by('z_rank').values_list('z_rank', flat=True).first()
+        # Twice when another shape has the same rank
+        tied = shapes.filter(z_rank=target_rank).count() > 1
+        return [rank for rank in [below, target_rank] if rank is not None] + ([target_rank] if tied else []) + ([above] if above is not None else [])
+
+
+    def rebalance(self, layout):
+        """Respace the ranks of a layout keeping its order, returns the shape ids."""
+        shapes = list(Shape.objects.filter(layout=layout.id).order_by(*Z_ORDER).only('_id', 'z_rank'))
+        for shape, rank in zip(shapes, spaced_ranks(len(shapes))):
+            shape.z_rank = rank
+        Shape.objects.bulk_update(shapes, ['z_rank'])
+        return [shape.pk for shape in shapes]
+
+
+    def reorder(self, layout, shape_id, position, target=None):
+        """
+        Move a shape in the z-order, rewriting its rank only unless the layout has to be rebalanced.
+        Returns (representation, None) or (None, errors).
+        """
+        with transaction.atomic():
+            # Serializes the moves in a layout, which could pick the same rank
+            list(Layout.objects.select_for_update().filter(pk=layout.id).values_list('pk', flat=True))
+            shapes = Shape.objects.filter(layout=layout.id)
+            if not shapes.filter(pk=shape_id).exists():
+                return None, unknown_shape_errors(layout, [shape_id])
+            others = shapes.exclude(pk=shape_id)
+
+            updated = [shape_id]
+            for _ in range(2):
+                target_rank = None
+                if position in (AFTER, BEFORE):
+                    target_rank = others.filter(pk=target).values_list('z_rank', flat=True).first()
+                    if target_rank is None:
+                        return None, {"target": [f"Unknown shape {target} in layout {layout.id}."]}
+
+                window = self.rank_window(others, position, target_rank)
+                rank = moved_rank(window, position, window.index(target_rank) if target_rank is not None else None)
+                if rank is not None:
+                    break
+                updated = self.rebalance(layout)
+
+            shapes.filter(pk=shape_id).update(z_rank=rank)
+            # update bypasses the post_save receivers
+            touch_template(layout.template_id, TemplateChange.SHAPE, TemplateChange.UPDATE, updated, layout.id)
+        return self.get(layout, shape_id), None
+
+
+    def set_order(self, layout, shape_ids):
+        """Rank every shape of a layout: shape_ids bottom first, then the shapes they leave out in their current order."""
+        with transaction.atomic():
+            current = list(Shape.objects.filter(layout=layout.id).order_by(*Z_ORDER).values_list('_id', flat=True))
+            position = {shape_id: index for index, shape_id in enumerate(dict.fromkeys(shape_ids))}
+            ordered = sorted(current, key=lambda shape_id: position.get(shape_id, len(position)))
+            Shape.objects.bulk_update(
+                [Shape(_id=shape_id, z_rank=rank) for shape_id, rank in zip(ordered, spaced_ranks(len(ordered)))],
+                ['z_rank']
+            )
+            if ordered:
+                touch_template(layout.template_id, TemplateChange.SHAPE, TemplateChange.UPDATE, ordered, layout.id)
+
+
+    def delete(self, layout, shape_id):
+        shape = Shape.objects.filter(layout=layout.id, pk=shape_id).first()
+        if shape is None:
+            return False
+
+        with transaction.atomic():
+            content_object = shape.content_object
+            shape.delete()
+            if content_object is not None:
+                content_object.delete()
+        return True
+
+
+    def export_records(self, layout):
+        """Document records of the shapes of a layout, in z-order."""
+        shapes = list(Shape.objects.filter(layout=layout.id).order_by(*Z_ORDER))
+        shape_objects = prefetch_shape_objects(shapes)
+
+        records = []
+        for shape in shapes:
+            classname = CONTENT_TYPE_TO_CLASSNAME.get(str(shape.content_type_id))
+            obj = shape_objects.get((shape.content_type_id, shape.shape_id))
+            if obj is None:
+                continue
+
+            record = {"_id": shape.pk, "type": classname}
+            record.update({field.name: field.value_from_object(shape) for field in SHAPE_COLUMNS})
+            record["object"] = {field.name: field.value_from_object(obj) for field in object_fields(type(obj))}
+            records.append(record)
+        return records
+
+
+    def import_records(self, layout, records):
+        """Insert document records as rows, returns {record id: Shape id}."""
+        indexes_by_type = {}
+        for index, record in enumerate(records):
+            indexes_by_type.setdefault(record["type"], []).append(index)
+
+        shapes = [None] * len(records)
+        for classname, indexes in indexes_by_type.items():
+            model_data = CLASSNAME_TO_MODELS[classname]
+            model = model_data["model"]
+            objects = model.objects.bulk_create([
+                model(**{field.attname: records[index]["object"].get(field.name) for field in object_fields(model)})
+                for index in indexes
+            ])
+            for index, obj in zip(indexes, objects):
+                shapes[index] = Shape(
+                    layout_id=layout.id,
+                    content_type_id=model_data["content_type"],
+                    shape_id=obj.id,
+                    **{field.name: records[index][field.name] for field in SHAPE_COLUMNS if field.name in records[index]}
+                )
+
+        shapes = Shape.objects.bulk_create(shapes)
+        index_shapes([shape.pk for shape in shapes])
+        return {record["_id"]: shape.pk for record, shape in zip(records, shapes)}
+
+
+    def clear(self, layout):
+        ids_by_content_type = {}
+        for content_type_id, shape_id in Shape.objects.filter(layout=layout.id).values_list("content_type_id", "shape_id"):
+            ids_by_content_type.setdefault(content_type_id, []).append(shape_id)
+
+        Shape.objects.filter(layout=layout.id).delete()
+        for content_type_id, ids in ids_by_content_type.items():
+            model_data = CLASSNAME_TO_MODELS.get(CONTENT_TYPE_TO_CLASSNAME.get(str(content_type_id)))
+            if model_data:
+                model_data["model"].objects.filter(pk__in=ids).delete()
+
+
+class DocumentShapeStorage:
+
+    @staticmethod
+    def empty_document():
+        return {"version": DOCUMENT_VERSION, "revision": 0, "next_id": 1, "shapes": []}
+
+
+    @staticmethod
+    def object_record(object_data):
+        # Related objects (Media.media_content) are stored by id
+        return {name: value.pk if hasattr(value, 'pk') else value for name, value in object_data.items()}
+
+
+    @classmethod
+    def record_from_validated(cls, shape_id, shape_type, object_data, shape_data):
+        record = {"_id": shape_id, "type": shape_type}
+        record.update({field.name: field.to_python(field.get_default()) for field in SHAPE_COLUMNS})
+        record.update(shape_data)
+        record["object"] = cls.object_record(object_data)
+        return record
+
+
+    @staticmethod
+    def hydrate(records, media_contents):
+        """Unsaved Shape and concrete instances of the records, keyed the way ShapeSerializer expects."""
+        shapes, shape_objects = [], {}
+        for record in records:
+            model_data = CLASSNAME_TO_MODELS[record["type"]]
+            model = model_data["model"]
+            obj = model(id=record["_id"], **{
+                field.attname: record["object"].get(field.name) for field in object_fields(model)
+            })
+            if "media_content" in record["object"]:
+                obj.media_content = media_contents.get(record["object"]["media_content"])
+                if obj.media_content is None:
+                    # The media content was deleted, as the Media row would have been
+                    continue
+
+            shapes.append(Shape(
+                _id=record["_id"],
+                content_type_id=model_data["content_type"],
+                shape_id=record["_id"],
+                **{field.name: record[field.name] for field in SHAPE_COLUMNS if field.name in record}
+            ))
+            shape_objects[(model_data["content_type"], record["_id"])] = obj
+        return shapes, shape_objects
+
+
+    @staticmethod
+    def media_content_ids(records):
+        return {record["object"]["media_content"] for record in records if "media_content" in record["object"]}
+
+
+    def records(self, layout):
+        return (layout.shapes_document or self.empty_document())["shapes"]
+
+
+    def representations(self, layout, context=None, records=None, bbox=None):
+        records = records if records is not None else self.records(layout)
+        media_contents = (context or {}).get("media_contents")
+        if media_contents is None:
+            media_content_ids = self.media_content_ids(records)
+            media_contents = MediaContent.objects.in_bulk(media_content_ids) if media_content_ids else {}
+
+        shapes, shape_objects = self.hydrate(records, media_contents)
+        shapes = ShapeSerializer(instance=shapes, many=True, context={"shape_objects": shape_objects}).data
+        return shapes if bbox is None else [shape for shape in shapes if overlaps(shape_box(shape), bbox)]
+
+
+    def paginate(self, layout, paginate, bbox=None):
+        records = self.records(layout)
+        if bbox is not None:
+            shape_ids = {shape["config"]["_id"] for shape in self.representations(layout, records=records, bbox=bbox)}
+            records = [record for record in records if record["_id"] in shape_ids]
+        page = paginate(KeyedList(records))
+        return self.representations(layout, records=page)
+
+
+    def hit_test(self, layout, x, y):
+        return [shape for shape in reversed(self.representations(layout)) if contains_point(shape, x, y)]
+
+
+    def snap(self, layout, box, tolerance, exclude=()):
+        def load_boxes():
+            return {shape["config"]["_id"]: shape_box(shape) for shape in self.representations(layout)}
+
+        version = ("document", (layout.shapes_document or self.empty_document())["revision"])
+        return snap_candidates(layout.id, version, load_boxes, box, tolerance, exclude)
+
+
+    def get(self, layout, shape_id):
+        records = [record for record in self.records(layout) if record["_id"] == shape_id]
+        representations = self.representations(layout, records=records) if records else []
+        return representations[0] if representations else None
+
+
+    def write(self, layout, change):
+        """Run change(document) on the locked layout document and save it. change returns (result, errors)."""
+        with transaction.atomic():
+            locked = Layout.objects.select_for_update().get(pk=layout.id)
+            document = locked.shapes_document or self.empty_document()
+            result, errors = change(document)
+            if errors:
+                return None, errors
+
+            document["revision"] += 1
+            locked.shapes_document = document
+            # Layout.save touches the template and logs a layout update
+            locked.save(update_fields=['shapes_document'])
+            layout.shapes_document = document
+        return result, None
+
+
+    def create(self, layout, items):
+        validated, errors = validate_shape_payloads(items)
+        if errors:
+            return None, errors
+
+        def change(document):
+            records = []
+            top_rank = document["shapes"][-1].get("z_rank", "") if document["shapes"] else None
+            for (shape_type, object_data, shape_data), rank in zip(validated, ranks_after(top_rank, len(validated))):
+                records.append(self.record_from_validated(document["next_id"], shape_type, object_data, shape_data))
+                records[-1]["z_rank"] = rank
+                document["next_id"] += 1
+            document["shapes"].extend(records)
+            return records, None
+
+        records, errors = self.write(layout, change)
+        if errors:
+            return None, errors
+        return self.representations(layout, records=records), None
+
+
+    def update(self, layout, items, serializer_class=ShapeTransformSerializer, ignore_unknown=False):
+        updates, _, errors = validate_shape_updates(items, serializer_class)
+        if errors:
+            return None, errors
+
+        def change(document):
+            records = {record["_id"]: record for record in document["shapes"]}
+            unknown_ids = updates.keys() - records.keys()
+            if unknown_ids and not ignore_unknown:
+                return None, unknown_shape_errors(layout, unknown_ids)
+
+            for shape_id, fields in updates.items():
+                if shape_id in records:
+                    records[shape_id].update(fields)
+            return [shape_id for shape_id in updates if shape_id not in unknown_ids], None
+
+        return self.write(layout, change)
+
+
+    def arrange(self, layout, shape_ids, **options):
+        def change(document):
+            records = {record["_id"]: record for record in document["shapes"]}
+            unknown_ids = set(shape_ids) - records.keys()
+            if unknown_ids:
+                return None, unknown_shape_errors(layout, unknown_ids)
+
+            updates = arrange_selection(Selection.from_records([records[shape_id] for shape_id in shape_ids]), **options)
+            for update in updates:
+                records[update["id"]].update({name: value for name, value in update.items() if name != "id"})
+            return updates, None
+
+        return self.write(layout, change)
+
+
+    def replace(self, layout, shape_id, data):
+        def change(document):
+            record = next((record for record in document["shapes"] if record["_id"] == shape_id), None)
+            if record is None:
+                return None, unknown_shape_errors(layout, [shape_id])
+
+            model_data = CLASSNAME_TO_MODELS[record["type"]]
+            nested = flattern_to_nested(data, model_data["fields"], "updated_object")
+            object_serializer = model_data["serializer"](data=nested.pop("updated_object"), partial=True)
+            # Invalid object fields are ignored, as with shape rows
+            if object_serializer.is_valid():
+                record["object"].update(self.object_record(object_serializer.validated_data))
+
+            shape_serializer = ShapeBulkSerializer(data=nested, partial=True)
+            if not shape_serializer.is_valid():
+                return None, shape_serializer.errors
+            record.update(shape_serializer.validated_data)
+            return record, None
+
+        record, errors = self.write(layout, change)
+        if errors:
+            return None, errors
+        return self.representations(layout, records=[record])[0], None
+
+
+    def reorder(self, layout, shape_id, position, target=None):
+        def change(document):
+            record = next((record for record in document["shapes"] if record["_id"] == shape_id), None)
+            if record is None:
+                return None, unknown_shape_errors(layout, [shape_id])
+            others = [other for other in document["shapes"] if other is not record]
+
+            for _ in range(2):
+                target_index = None
+                if position in (AFTER, BEFORE):
+                    target_index = next((index for index, other in enumerate(others) if other["_id"] == target), None)
+                    if target_index is None:
+                        return None, {"target": [f"Unknown shape {target} in layout {layout.id}."]}
+
+                rank = moved_rank([other.get("z_rank", "") for other in others], position, target_index)
+                if rank is not None:
+                    break
+                for other, spaced in zip(others, spaced_ranks(len(others))):
+                    other["z_rank"] = spaced
+
+            record["z_rank"] = rank
+            document["shapes"].sort(key=z_order_key)
+            return record, None
+
+        record, errors = self.write(layout, change)
+        if errors:
+            return None, errors
+        return self.representations(layout, records=[record])[0], None
+
+
+    def set_order(self, layout, shape_ids):
+        def change(document):
+            position = {shape_id: index for index, shape_id in enumerate(dict.fromkeys(shape_ids))}
+            document["shapes"].sort(key=lambda record: position.get(record["_id"], len(position)))
+            for record, rank in zip(document["shapes"], spaced_ranks(len(document["shapes"]))):
+                record["z_rank"] = rank
+            return None, None
+
+        self.write(layout, change)
+
+
+    def delete(self, layout, shape_id):
+        def change(document):
+            shapes = [record for record in document["shapes"] if record["_id"] != shape_id]
+            if len(shapes) == len(document["shapes"]):
+                return False, {"id": ["Unknown shape."]}
+            document["shapes"] = shapes
+            return True, None
+
+        deleted, errors = self.write(layout, change)
+        return bool(deleted) and not errors
+
+
+STORAGES = {
+    Layout.ROWS: RowShapeStorage(),
+    Layout.DOCUMENT: DocumentShapeStorage(),
+}
+
+
+def get_shape_storage(layout):
+    return STORAGES[layout.storage]
+
+
+def convert_layout_storage(layout, storage):
+    """
+    Move the shapes of a layout to another storage. Shape ids are kept when moving to a
+    document and reassigned when moving to rows, z-order ranks are kept.
+    """
+    if layout.storage == storage:
+        return False
+
+    with transaction.atomic():
+        layout = Layout.objects.select_for_update().get(pk=layout.id)
+        if storage == Layout.DOCUMENT:
+            records = STORAGES[Layout.ROWS].export_records(layout)
+            document = DocumentShapeStorage.empty_document()
+            document["shapes"] = records
+            document["next_id"] = max([record["_id"] for record in records], default=0) + 1
+            with muted_receivers():
+                STORAGES[Layout.ROWS].clear(layout)
+            boxes_changed({layout.id: None})
+            layout.shapes_document = document
+        else:
+            records = (layout.shapes_document or DocumentShapeStorage.empty_document())["shapes"]
+            with muted_receivers():
+                STORAGES[Layout.ROWS].import_records(layout, records)
+            layout.shapes_document = None
+
+        layout.storage = storage
+        with muted_receivers():
+            layout.save(update_fields=['storage', 'shapes_document'])
+        touch_template(layout.template_id, TemplateChange.LAYOUT, TemplateChange.UPDATE, [layout.id], layout.id)
+    return True
+
+
+def delete_layout(layout):
+    """Delete a layout and its shapes, recorded as one layout change instead of a change per shape."""
+    layout_id = layout.id
+    with transaction.atomic():
+        with muted_receivers():
+            layout.delete()
+        boxes_changed({layout_id: None})
+        touch_template(layout.template_id, TemplateChange.LAYOUT, TemplateChange.DELETE, [layout_id], layout_id)
+
+
+def delete_template(template):
+    """Delete a template with its layouts and shapes, its change log goes with it."""
+    template_id = template.id
+    layout_ids = list(Layout.objects.filter(template=template_id).values_list("id", flat=True))
+    with transaction.atomic():
+        with muted_receivers():
+            template.delete()
+        boxes_changed(dict.fromkeys(layout_ids))
+        bump_template_version_on_commit(template_id)
@@ -4,11 +4,49 @@ from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
-from .models import Template, TemplateShapeRelation
-from .serializers import TemplateSerializer
+from .models import Template, Layout, Shape, Rectangle, Circle, Text, Media, MediaContent, TemplateChange
+from .serializers import TemplateSerializer, LayoutSerializer, CLASSNAME_TO_MODELS
 from django.contrib.contenttypes.models import ContentType
 from django.core import management
-from .utils import ordered_dict_to_dict
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from .utils import ordered_dict_to_dict, camel_to_snake, camel_to_snake_list, snake_to_camel_list
+from .serializers import dict_keys_snake_to_camel, ShapeSerializer
+from .encoders import encode_shapes
+from .benchmarks import regex_snake_to_camel, regex_camel_to_snake, sample_shape_representations, scan_candidates
+from .cache import get_template_cache, get_template_version, bump_layout_boxes_version
+from . import snapping
+from .changes import compact_changes
+from .realtime import websocket_application
+from .storage import convert_layout_storage, get_shape_storage
+from asgiref.testing import ApplicationCommunicator
+from asgiref.sync import sync_to_async
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from .images import DerivativeCache
+from .medias import content_digest
+from .exports import ExportError, font_path, rasterize
+from .blobs import acquire_blob, collect_blobs, adopt_legacy_media
+from .uploads import UploadError, collect_sessions, part_path, write_chunk
+from .models import MediaBlob, UploadSession, ExportJob, ShapeBox
+from .jobs import schedule_jobs, collect_jobs, run_job
+from .ranks import rank_between, spaced_ranks
+from .clones import clone_layout
+from .bulk import bulk_create_shapes
+from .spatial import overlaps, shape_box
+from django.core.files.storage import default_storage
+from PIL import Image
+from unittest import mock
+import hashlib
+import uuid
+import io
+import json
+import os
+import tempfile
+import zipfile
+from datetime import timedelta
+from django.utils import timezone
 
 
 # Create your tests here.
@@ -176,7 +214,2022 @@ class ShapeTests(APITestBase):
         response = client.put(url, data, **self.bearer_token)
         print(response.data)
         self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
-        
 
-    
 
+def create_layout_shapes(layout, user, count):
+    for index in range(count):
+        rectangle = Rectangle.objects.create(width=10, height=20)
+        circle = Circle.objects.create(radius=5)
+        text = Text.objects.create(font_family="Arial", font_size=12, text=f"text {index}")
+        media_content = MediaContent.objects.create(user=user)
+        media = Media.objects.create(width=30, height=40, media_content=media_content)
+
+        for classname, obj in (("Rect", rectangle), ("Circle", circle), ("Text", text), ("Image", media)):
+            Shape.objects.create(layout=layout, content_type_id=CLASSNAME_TO_MODELS[classname]["content_type"], shape_id=obj.id)
+
+
+class ShapeQueryCountTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="query_count", password="query_count")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="query count")
+        self.layout = Layout.objects.create(template=self.template)
+
+
+    def count_data_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/api/templates/{self.template.id}/data/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), response
+
+
+    def test_data_query_count_is_constant(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_layout_shapes(self.layout, self.user, 2)
+        small_count, response = self.count_data_queries()
+        self.assertEqual(len(response.data["layouts"][0]["shapes"]), 8)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_layout_shapes(self.layout, self.user, 20)
+        large_count, response = self.count_data_queries()
+        self.assertEqual(len(response.data["layouts"][0]["shapes"]), 88)
+
+        self.assertEqual(small_count, large_count)
+
+
+    def test_data_image_shape_contains_media_content(self):
+        create_layout_shapes(self.layout, self.user, 1)
+        _, response = self.count_data_queries()
+
+        images = [shape for shape in response.data["layouts"][0]["shapes"] if shape["type"] == "v-image"]
+        self.assertEqual(len(images), 1)
+        self.assertEqual(images[0]["config"]["mediaContent"]["user"], self.user.id)
+
+
+class TemplateTreeTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="template_tree", password="template_tree")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="template tree")
+
+
+    def test_data_query_count_is_constant_across_layouts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_layout_shapes(Layout.objects.create(template=self.template), self.user, 1)
+        with CaptureQueriesContext(connection) as small_context:
+            self.client.get(f"/api/templates/{self.template.id}/data/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(5):
+                create_layout_shapes(Layout.objects.create(template=self.template), self.user, 3)
+        with CaptureQueriesContext(connection) as large_context:
+            response = self.client.get(f"/api/templates/{self.template.id}/data/")
+
+        self.assertEqual(len(response.data["layouts"]), 6)
+        self.assertEqual(len(small_context.captured_queries), len(large_context.captured_queries))
+
+
+    def test_data_matches_per_layout_serialization(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                create_layout_shapes(Layout.objects.create(template=self.template), self.user, 2)
+
+        response = self.client.get(f"/api/templates/{self.template.id}/data/")
+        expected = LayoutSerializer(instance=Layout.objects.filter(template=self.template), many=True).data
+        self.assertEqual(response.data["layouts"], expected)
+
+
+class TemplateDocumentCacheTests(APITestCase):
+
+    def setUp(self):
+        get_template_cache().clear()
+        self.user = User.objects.create_user(username="document_cache", password="document_cache")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="document cache")
+        self.layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(self.layout, self.user, 1)
+        self.url = f"/api/templates/{self.template.id}/data/"
+
+
+    def get_rect_config(self, response):
+        return next(shape["config"] for shape in response.data["layouts"][0]["shapes"] if shape["type"] == "v-rect")
+
+
+    def test_cache_hit_skips_orm(self):
+        first_response = self.client.get(self.url)
+
+        with self.assertNumQueries(0):
+            second_response = self.client.get(self.url)
+
+        self.assertEqual(first_response.data, second_response.data)
+
+
+    def test_shape_update_invalidates_document(self):
+        rect_config = self.get_rect_config(self.client.get(self.url))
+
+        url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/{rect_config['_id']}/"
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(url, {"x": 42, "width": 99, "draggable": True}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        rect_config = self.get_rect_config(self.client.get(self.url))
+        self.assertEqual(rect_config["x"], 42)
+        self.assertEqual(rect_config["width"], 99)
+
+
+    def test_rectangle_create_invalidates_document(self):
+        self.client.get(self.url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/rectangles/", {"width": 5, "height": 5, "layout": self.layout.id}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data["layouts"][0]["shapes"]), 5)
+
+
+    def test_layout_update_invalidates_document(self):
+        shape_ids = self.client.get(self.url).data["layouts"][0]["drawing_index_list"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f"/api/templates/{self.template.id}/layouts/{self.layout.id}/", {"drawing_index_list": shape_ids[::-1]}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.data["layouts"][0]["drawing_index_list"], shape_ids[::-1])
+
+
+    def test_version_bumped_on_commit(self):
+        version = get_template_version(self.template.id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                Shape.objects.filter(layout=self.layout).first().save()
+                self.assertEqual(get_template_version(self.template.id), version)
+            self.assertEqual(get_template_version(self.template.id), version)
+
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(get_template_version(self.template.id), version)
+
+
+class ConditionalRequestTests(APITestCase):
+
+    def setUp(self):
+        get_template_cache().clear()
+        self.user = User.objects.create_user(username="conditional", password="conditional")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="conditional")
+        self.layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(self.layout, self.user, 1)
+        self.shape = Shape.objects.filter(layout=self.layout).first()
+        self.data_url = f"/api/templates/{self.template.id}/data/"
+        self.shape_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/{self.shape.pk}/"
+
+
+    def test_data_not_modified(self):
+        response = self.client.get(self.data_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("Last-Modified", response)
+
+        response = self.client.get(self.data_url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+    def test_data_etag_changes_on_shape_write(self):
+        etag = self.client.get(self.data_url)["ETag"]
+
+        self.shape.x = 10
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shape.save()
+
+        response = self.client.get(self.data_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+    def test_mine_not_modified(self):
+        etag = self.client.get("/api/templates/mine/")["ETag"]
+
+        response = self.client.get("/api/templates/mine/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Template.objects.create(user=self.user, name="another")
+        response = self.client.get("/api/templates/mine/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+    def test_shape_update_if_match(self):
+        etag = self.client.get(self.shape_url)["ETag"]
+
+        response = self.client.put(self.shape_url, {"x": 1, "draggable": True}, format="json", HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+        response = self.client.put(self.shape_url, {"x": 2, "draggable": True}, format="json", HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.shape.refresh_from_db()
+        self.assertEqual(self.shape.x, 1)
+
+
+def bulk_shape_payload(user, count):
+    media_content = MediaContent.objects.create(user=user)
+    payload = []
+    for index in range(count):
+        payload += [
+            {"type": "Rect", "x": index, "y": 1, "width": 10, "height": 20, "fill": "red", "draggable": True},
+            {"type": "Circle", "x": index, "radius": 5, "shadowOffsetX": 2},
+            {"type": "Text", "x": index, "fontFamily": "Arial", "fontSize": 12, "text": f"text {index}"},
+            {"type": "Image", "x": index, "width": 30, "height": 40, "mediaContent": media_content.id},
+        ]
+    return payload
+
+
+class BulkShapeCreateTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="bulk_create", password="bulk_create")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="bulk create")
+        self.layout = Layout.objects.create(template=self.template)
+        self.url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/bulk/"
+
+
+    def test_bulk_create_keeps_input_order(self):
+        payload = bulk_shape_payload(self.user, 3)
+        response = self.client.post(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([shape["type"] for shape in response.data], ["v-rect", "v-circle", "v-text", "v-image"] * 3)
+        self.assertEqual([shape["config"]["x"] for shape in response.data], [index for index in range(3) for _ in range(4)])
+        self.assertEqual(response.data[0]["config"]["fill"], "red")
+        self.assertEqual(response.data[1]["config"]["shadowOffset"], {"x": 2, "y": 0})
+        self.assertEqual(Shape.objects.filter(layout=self.layout).count(), 12)
+
+
+    def test_bulk_create_query_count_does_not_grow_per_shape(self):
+        payload = [item for item in bulk_shape_payload(self.user, 50) if item["type"] != "Image"]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # Only the database batch size splits the INSERTs
+        self.assertLess(len(context.captured_queries), len(payload) // 5)
+
+
+    def test_bulk_create_is_atomic_on_validation_error(self):
+        payload = [
+            {"type": "Rect", "width": 10, "height": 20},
+            {"type": "Circle"},
+            {"type": "Hexagon"},
+        ]
+        response = self.client.post(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn("radius", response.data[1])
+        self.assertIn("type", response.data[2])
+        self.assertEqual(Shape.objects.filter(layout=self.layout).count(), 0)
+
+
+class ShapeTransformTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="transform", password="transform")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="transform")
+        self.layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(self.layout, self.user, 5)
+        self.shapes = list(Shape.objects.filter(layout=self.layout))
+        self.url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/transform/"
+
+
+    def test_transform_updates_selection(self):
+        payload = [{"id": shape.pk, "x": index, "scaleX": 2, "rotation": 45} for index, shape in enumerate(self.shapes)]
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"updated": [shape.pk for shape in self.shapes]})
+        self.assertLess(len(context.captured_queries), 10)
+
+        for index, shape in enumerate(Shape.objects.filter(layout=self.layout)):
+            self.assertEqual((shape.x, shape.scale_x, shape.scale_y, shape.rotation), (index, 2, 1, 45))
+
+
+    def test_transform_rejects_shapes_of_other_layouts(self):
+        other_layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(other_layout, self.user, 1)
+        other_shape = Shape.objects.filter(layout=other_layout).first()
+
+        payload = [{"id": self.shapes[0].pk, "x": 99}, {"id": other_shape.pk, "x": 99}]
+        response = self.client.patch(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotEqual(Shape.objects.get(pk=self.shapes[0].pk).x, 99)
+
+
+class ChangeFeedTests(APITestCase):
+
+    def setUp(self):
+        get_template_cache().clear()
+        self.user = User.objects.create_user(username="change_feed", password="change_feed")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="change feed")
+        self.layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(self.layout, self.user, 1)
+        self.revision = self.client.get(f"/api/templates/{self.template.id}/data/").data["revision"]
+        self.url = f"/api/templates/{self.template.id}/changes/"
+
+
+    def get_changes(self, since):
+        response = self.client.get(self.url, {"since": since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+
+    def test_no_changes_since_current_revision(self):
+        feed = self.get_changes(self.revision)
+        self.assertEqual(feed, {"revision": self.revision, "reload": False, "changes": []})
+
+
+    def test_shape_create_update_delete(self):
+        rect, circle, text, image = Shape.objects.filter(layout=self.layout)
+        rect.x = 12
+        rect.save()
+        circle_object = Circle.objects.get(pk=circle.shape_id)
+        circle_object.radius = 30
+        circle_object.save()
+        text_id = text.pk
+        text.delete()
+        bulk_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/bulk/"
+        created = self.client.post(bulk_url, [{"type": "Rect", "width": 1, "height": 1}], format="json").data[0]
+
+        feed = self.get_changes(self.revision)
+        changes = {(change["target"], change["id"]): change for change in feed["changes"]}
+
+        self.assertFalse(feed["reload"])
+        self.assertGreater(feed["revision"], self.revision)
+        self.assertEqual(len(changes), 4)
+        self.assertEqual(changes[("shape", rect.pk)]["object"]["config"]["x"], 12)
+        self.assertEqual(changes[("shape", circle.pk)]["object"]["config"]["radius"], 30)
+        self.assertEqual(changes[("shape", text_id)]["action"], "delete")
+        self.assertEqual(changes[("shape", created["config"]["_id"])]["action"], "create")
+
+        self.assertEqual(self.get_changes(feed["revision"])["changes"], [])
+
+
+    def test_layout_delete_does_not_log_cascaded_shapes(self):
+        self.layout.delete()
+
+        feed = self.get_changes(self.revision)
+        self.assertEqual([(change["target"], change["action"]) for change in feed["changes"]], [("layout", "delete")])
+
+
+    def test_delete_views_query_count_is_constant(self):
+        def count_delete_queries(url):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.delete(url)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            return len(context.captured_queries)
+
+        large_layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(large_layout, self.user, 10)
+        revision = Template.objects.get(pk=self.template.id).revision
+        small_count = count_delete_queries(f"/api/templates/{self.template.id}/layouts/{self.layout.id}/")
+        large_count = count_delete_queries(f"/api/templates/{self.template.id}/layouts/{large_layout.id}/")
+        self.assertEqual(small_count, large_count)
+
+        feed = self.get_changes(revision)
+        self.assertEqual(
+            [(change["target"], change["action"], change["id"]) for change in feed["changes"]],
+            [("layout", "delete", self.layout.id), ("layout", "delete", large_layout.id)]
+        )
+
+        small_template = Template.objects.create(user=self.user, name="small")
+        create_layout_shapes(Layout.objects.create(template=small_template), self.user, 1)
+        large_template = Template.objects.create(user=self.user, name="large")
+        for _ in range(2):
+            create_layout_shapes(Layout.objects.create(template=large_template), self.user, 10)
+        self.assertEqual(
+            count_delete_queries(f"/api/templates/{small_template.id}/"), count_delete_queries(f"/api/templates/{large_template.id}/")
+        )
+        self.assertFalse(Shape.objects.filter(layout__template=large_template.id).exists())
+
+
+    def test_reload_once_compacted(self):
+        for x in range(5):
+            shape = Shape.objects.filter(layout=self.layout).first()
+            shape.x = x
+            shape.save()
+
+        compact_changes(self.template.id, keep=2)
+
+        self.assertTrue(self.get_changes(self.revision)["reload"])
+        self.template.refresh_from_db()
+        self.assertFalse(self.get_changes(self.template.compacted_revision)["reload"])
+
+
+class RealtimeTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="realtime", password="realtime")
+        self.template = Template.objects.create(user=self.user, name="realtime")
+        self.layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(self.layout, self.user, 1)
+        self.shape = Shape.objects.filter(layout=self.layout).first()
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+
+    async def connect(self, token=None):
+        communicator = ApplicationCommunicator(websocket_application, {
+            "type": "websocket",
+            "path": f"/ws/templates/{self.template.id}/",
+            "query_string": f"token={token or self.token}".encode(),
+        })
+        await communicator.send_input({"type": "websocket.connect"})
+        return communicator, await communicator.receive_output(timeout=5)
+
+
+    def shape_update(self, x):
+        return {"type": "websocket.receive", "text": json.dumps({
+            "type": "shape.update", "layout": self.layout.id, "id": self.shape.pk, "config": {"x": x, "strokeWidth": 3}
+        })}
+
+
+    async def test_updates_are_broadcast_and_coalesced(self):
+        editor, accepted = await self.connect()
+        viewer, _ = await self.connect()
+        self.assertEqual(accepted["type"], "websocket.accept")
+
+        for x in range(20):
+            await editor.send_input(self.shape_update(x))
+
+        for x in range(20):
+            message = json.loads((await viewer.receive_output(timeout=5))["text"])
+            self.assertEqual(message["config"]["x"], x)
+        self.assertTrue(await editor.receive_nothing())
+
+        await editor.send_input({"type": "websocket.disconnect", "code": 1000})
+        await viewer.send_input({"type": "websocket.disconnect", "code": 1000})
+        await editor.wait(timeout=5)
+        await viewer.wait(timeout=5)
+
+        shape = await sync_to_async(Shape.objects.get)(pk=self.shape.pk)
+        self.assertEqual((shape.x, shape.stroke_width), (19, 3))
+        changes = await sync_to_async(TemplateChange.objects.filter(
+            template=self.template, target=TemplateChange.SHAPE, action=TemplateChange.UPDATE, object_id=self.shape.pk
+        ).count)()
+        self.assertEqual(changes, 1)
+
+
+    async def test_broadcasts_validated_fields_of_template_layouts(self):
+        other_layout = await sync_to_async(Layout.objects.create)(
+            template=await sync_to_async(Template.objects.create)(user=self.user, name="other")
+        )
+        editor, _ = await self.connect()
+        viewer, _ = await self.connect()
+
+        await editor.send_input({"type": "websocket.receive", "text": json.dumps({
+            "type": "shape.update", "layout": other_layout.id, "id": self.shape.pk, "config": {"x": 1}
+        })})
+        error = json.loads((await editor.receive_output(timeout=5))["text"])
+        self.assertEqual(error["errors"], {"layout": ["Unknown layout."]})
+
+        await editor.send_input({"type": "websocket.receive", "text": json.dumps({
+            "type": "shape.update", "layout": self.layout.id, "id": self.shape.pk, "config": {"x": 5, "html": "<script>"}, "extra": 1
+        })})
+        message = json.loads((await viewer.receive_output(timeout=5))["text"])
+        self.assertEqual(message, {"type": "shape.update", "layout": self.layout.id, "id": self.shape.pk, "config": {"x": 5}})
+        self.assertTrue(await viewer.receive_nothing())
+
+        await editor.send_input({"type": "websocket.disconnect", "code": 1000})
+        await viewer.send_input({"type": "websocket.disconnect", "code": 1000})
+        await editor.wait(timeout=5)
+        await viewer.wait(timeout=5)
+
+
+    async def test_failed_flush_is_reported(self):
+        editor, _ = await self.connect()
+        with mock.patch("UpTemplateAPI.realtime.persist_shape_updates", side_effect=DatabaseError("locked")):
+            await editor.send_input(self.shape_update(7))
+            with self.assertLogs("UpTemplateAPI.realtime", level="ERROR"):
+                error = json.loads((await editor.receive_output(timeout=5))["text"])
+
+        self.assertEqual((error["type"], error["layout"], error["ids"]), ("error", self.layout.id, [self.shape.pk]))
+        await editor.send_input({"type": "websocket.disconnect", "code": 1000})
+        await editor.wait(timeout=5)
+
+
+    async def test_rejects_invalid_token(self):
+        _, response = await self.connect(token="invalid")
+        self.assertEqual(response["type"], "websocket.close")
+
+
+class DocumentStorageTests(APITestCase):
+
+    def setUp(self):
+        get_template_cache().clear()
+        self.user = User.objects.create_user(username="document_storage", password="document_storage")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="document storage")
+        self.layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(self.layout, self.user, 2)
+        self.data_url = f"/api/templates/{self.template.id}/data/"
+        self.shapes_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/"
+
+
+    def convert(self, storage):
+        convert_layout_storage(self.layout, storage)
+        self.layout.refresh_from_db()
+
+
+    def test_document_renders_like_rows(self):
+        rows_data = self.client.get(self.data_url).data
+        with self.captureOnCommitCallbacks(execute=True):
+            get_shape_storage(self.layout).set_order(self.layout, [shape.pk for shape in Shape.objects.filter(layout=self.layout)][::-1])
+        expected_layouts = self.client.get(self.data_url).data["layouts"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.convert(Layout.DOCUMENT)
+
+        self.assertEqual(Shape.objects.filter(layout=self.layout).count(), 0)
+        with self.assertNumQueries(3):
+            document_data = self.client.get(self.data_url).data
+        self.assertEqual(document_data["layouts"], expected_layouts)
+        self.assertEqual(len(rows_data["layouts"][0]["shapes"]), 8)
+
+
+    def test_round_trip_keeps_z_order(self):
+        get_shape_storage(self.layout).set_order(self.layout, [shape.pk for shape in Shape.objects.filter(layout=self.layout)][::-1])
+        expected_shapes = self.client.get(self.data_url).data["layouts"][0]["shapes"]
+
+        self.convert(Layout.DOCUMENT)
+        self.convert(Layout.ROWS)
+
+        shapes = self.client.get(self.data_url).data["layouts"][0]["shapes"]
+        strip_ids = lambda shapes: [{**shape, "config": {**shape["config"], "_id": None}} for shape in shapes]
+        self.assertEqual(strip_ids(shapes), strip_ids(expected_shapes))
+        self.assertEqual([shape["type"] for shape in shapes[:4]], ["v-image", "v-text", "v-circle", "v-rect"])
+
+
+    def test_shape_endpoints_on_document(self):
+        self.convert(Layout.DOCUMENT)
+
+        response = self.client.post(self.shapes_url, {"type": "Rect", "width": 5, "height": 6, "draggable": True}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        shape_id = response.data["config"]["_id"]
+        self.assertEqual(shape_id, 9)
+
+        response = self.client.put(f"{self.shapes_url}{shape_id}/", {"x": 7, "width": 50, "draggable": True}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.patch(f"{self.shapes_url}transform/", [{"id": shape_id, "rotation": 90}], format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        config = self.client.get(f"{self.shapes_url}{shape_id}/").data["config"]
+        self.assertEqual((config["x"], config["width"], config["height"], config["rotation"]), (7, 50, 6, 90))
+        self.assertEqual(len(self.client.get(self.shapes_url).data), 9)
+
+        response = self.client.delete(f"{self.shapes_url}{shape_id}/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.client.get(self.data_url).data["layouts"][0]["shapes"]), 8)
+
+
+class KeyCaseTests(TestCase):
+
+    def test_tables_match_regex(self):
+        snake_shapes = sample_shape_representations(4) + [{"_id": 1, "unknown_key_x": 2, "a": 3}]
+        camel_shapes = [regex_snake_to_camel(shape) for shape in snake_shapes]
+
+        self.assertEqual([dict_keys_snake_to_camel(shape) for shape in snake_shapes], camel_shapes)
+        self.assertEqual(snake_to_camel_list(snake_shapes), camel_shapes)
+        self.assertEqual([camel_to_snake(shape) for shape in camel_shapes], [regex_camel_to_snake(shape) for shape in camel_shapes])
+        self.assertEqual(camel_to_snake_list(camel_shapes + ["raw"]), [regex_camel_to_snake(shape) for shape in camel_shapes] + ["raw"])
+
+
+class ShapeEncoderTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="encoder", password="encoder")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="encoder")
+        self.layout = Layout.objects.create(template=self.template)
+        self.shapes_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/"
+
+
+    def test_encoder_matches_serializer(self):
+        self.client.post(f"{self.shapes_url}bulk/", bulk_shape_payload(self.user, 3), format="json")
+        MediaContent.objects.filter(user=self.user).update(content="src/some image.png")
+        shapes = Shape.objects.filter(layout=self.layout)
+
+        expected = ShapeSerializer(instance=shapes, many=True).data
+        self.assertEqual(json.dumps(encode_shapes(shapes)), json.dumps(expected))
+        self.assertEqual(json.dumps(self.client.get(self.shapes_url).data), json.dumps(expected))
+
+        shape = shapes.last()
+        self.assertEqual(self.client.get(f"{self.shapes_url}{shape.pk}/").data, ShapeSerializer(instance=shape).data)
+
+
+class ListingPaginationTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="listing", password="listing")
+        self.client.force_authenticate(user=self.user)
+        self.templates = [Template.objects.create(user=self.user, name=f"listing {i}") for i in range(5)]
+        self.layout = Layout.objects.create(template=self.templates[0])
+        self.shapes_url = f"/api/templates/{self.templates[0].id}/layouts/{self.layout.id}/shapes/"
+
+
+    def walk(self, url):
+        """Follow the next links from url, returns the pages."""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data["results"])
+            url = response.data["next"]
+        return pages
+
+
+    def test_mine_pages_cover_every_template(self):
+        pages = self.walk("/api/templates/mine/?page_size=2")
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([template["id"] for page in pages for template in page], [template.id for template in self.templates])
+
+        # Without pagination parameters the listing stays a plain list
+        self.assertEqual(len(self.client.get("/api/templates/mine/").data), 5)
+
+
+    def test_mine_summary_and_fields(self):
+        summary = self.client.get("/api/templates/mine/?summary=1").data
+        self.assertEqual(summary[0], {"id": self.templates[0].id, "name": "listing 0", "width": 800.0, "height": 600.0})
+
+        response = self.client.get("/api/templates/mine/?fields=id,name&page_size=1")
+        self.assertEqual(response.data["results"], [{"id": self.templates[0].id, "name": "listing 0"}])
+        self.assertNotEqual(response["ETag"], self.client.get("/api/templates/mine/").headers["ETag"])
+
+
+    def test_user_list_pages(self):
+        User.objects.create_user(username="listing 2", password="listing")
+        pages = self.walk("/api/users/?page_size=1&summary=1")
+        self.assertEqual([page[0] for page in pages], [{"username": user.username} for user in User.objects.order_by("id")])
+
+
+    def test_shape_pages_for_both_storages(self):
+        self.client.post(f"{self.shapes_url}bulk/", bulk_shape_payload(self.user, 2), format="json")
+        # Pages follow the z-order, shapes of the same rank by id
+        shape_ids = list(Shape.objects.filter(layout=self.layout).order_by("_id").values_list("_id", flat=True))
+        get_shape_storage(self.layout).set_order(self.layout, shape_ids[::-1])
+        Shape.objects.filter(pk__in=shape_ids[2:5]).update(z_rank="")
+        expected = self.client.get(self.shapes_url).data
+        self.assertEqual([shape["config"]["_id"] for shape in expected], sorted(shape_ids[2:5]) + shape_ids[5:][::-1] + shape_ids[:2][::-1])
+
+        pages = self.walk(f"{self.shapes_url}?page_size=3")
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual([shape for page in pages for shape in page], expected)
+
+        convert_layout_storage(self.layout, Layout.DOCUMENT)
+        pages = self.walk(f"{self.shapes_url}?page_size=3")
+        self.assertEqual([shape for page in pages for shape in page], expected)
+
+        last_page = self.client.get(f"{self.shapes_url}?page_size=3").data
+        previous = self.client.get(self.client.get(last_page["next"]).data["previous"]).data
+        self.assertEqual(previous["results"], pages[0])
+
+
+class TemplateMediasTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="medias", password="medias")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="medias")
+        self.layout = Layout.objects.create(template=self.template)
+        self.url = f"/api/templates/{self.template.id}/medias/"
+
+
+    def add_images(self, layout, media_content, count):
+        payload = [{"type": "Image", "width": 30, "height": 40, "mediaContent": media_content.id}] * count
+        response = self.client.post(f"/api/templates/{self.template.id}/layouts/{layout.id}/shapes/bulk/", payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+    def test_medias_are_deduplicated_in_constant_queries(self):
+        shared = MediaContent.objects.create(user=self.user)
+        self.add_images(self.layout, shared, 3)
+        create_layout_shapes(self.layout, self.user, 1)
+        with CaptureQueriesContext(connection) as small_context:
+            small = self.client.get(self.url).data
+
+        for _ in range(4):
+            create_layout_shapes(self.layout, self.user, 2)
+        document_layout = Layout.objects.create(template=self.template)
+        self.add_images(document_layout, shared, 1)
+        convert_layout_storage(document_layout, Layout.DOCUMENT)
+        with CaptureQueriesContext(connection) as large_context:
+            large = self.client.get(self.url).data
+
+        self.assertEqual([media["id"] for media in small], sorted(MediaContent.objects.filter(user=self.user).values_list("id", flat=True))[:2])
+        self.assertEqual(len(large), 10)
+        self.assertEqual(len({media["id"] for media in large}), 10)
+        self.assertEqual(len(small_context.captured_queries), len(large_context.captured_queries))
+
+
+    def test_manifest_describes_files(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            content = b"not really a png" * 100
+            media_content = MediaContent.objects.create(
+                user=self.user, content=SimpleUploadedFile("logo.png", content), original_width=64, original_height=32
+            )
+            self.add_images(self.layout, media_content, 2)
+
+            response = self.client.get(f"{self.url}manifest/")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["medias"], [{
+                "id": media_content.id,
+                "url": media_content.content.url,
+                "size": len(content),
+                "width": 64,
+                "height": 32,
+                "sha256": hashlib.sha256(content).hexdigest(),
+            }])
+
+            response = self.client.get(f"{self.url}manifest/", HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+    def test_digest_follows_files_replaced_under_the_same_name(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            media_content = MediaContent.objects.create(user=self.user, content=SimpleUploadedFile("logo.png", b"first"))
+            self.assertEqual(content_digest(media_content), (5, hashlib.sha256(b"first").hexdigest()))
+
+            with open(media_content.content.path, "wb") as file:
+                file.write(b"replaced")
+            self.assertEqual(content_digest(media_content), (8, hashlib.sha256(b"replaced").hexdigest()))
+
+
+def image_file(name, size, fmt="PNG"):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "red").save(buffer, format=fmt)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class MediaRenderTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="render", password="render")
+        self.client.force_authenticate(user=self.user)
+        self.layout = Layout.objects.create(template=Template.objects.create(user=self.user, name="render"))
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name, MEDIA_DERIVATIVES_ROOT=os.path.join(media_root.name, "derivatives"))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.derivatives_root = os.path.join(media_root.name, "derivatives")
+
+
+    def upload(self, file):
+        return self.client.post("/api/medias/", {
+            "content": file, "layout": self.layout.id, "width": 10, "height": 10, "original_width": 1, "original_height": 1
+        }, format="multipart")
+
+
+    def test_upload_reads_dimensions_from_header(self):
+        response = self.upload(image_file("photo.png", (64, 32)))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        media_content = MediaContent.objects.get(pk=response.data["config"]["mediaContent"]["id"])
+        self.assertEqual((media_content.original_width, media_content.original_height), (64, 32))
+
+        response = self.upload(SimpleUploadedFile("photo.png", b"not an image"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_render_resizes_and_caches(self):
+        media_id = self.upload(image_file("photo.jpg", (400, 200), "JPEG")).data["config"]["mediaContent"]["id"]
+        url = f"/api/medias/{media_id}/render/"
+
+        response = self.client.get(url, {"w": 100, "fmt": "webp"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        with Image.open(io.BytesIO(b"".join(response.streaming_content))) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (100, 50)))
+
+        cached = [name for _, _, names in os.walk(self.derivatives_root) for name in names]
+        self.assertEqual(len(cached), 1)
+        response = self.client.get(url, {"w": 100, "fmt": "webp"}, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Never enlarged, the source format is kept by default
+        response = self.client.get(url, {"w": 1000})
+        with Image.open(io.BytesIO(b"".join(response.streaming_content))) as image:
+            self.assertEqual((image.format, image.size), ("JPEG", (400, 200)))
+
+        self.assertEqual(self.client.get(url, {"w": 0}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {"fmt": "bmp"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_decompression_bombs_are_invalid(self):
+        media_id = self.upload(image_file("photo.png", (64, 32))).data["config"]["mediaContent"]["id"]
+        # Pillow refuses images over twice the limit
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 100):
+            self.assertEqual(self.upload(image_file("bomb.png", (64, 32))).status_code, status.HTTP_400_BAD_REQUEST)
+            for params in ({}, {"fmt": "png"}):
+                response = self.client.get(f"/api/medias/{media_id}/render/", params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = DerivativeCache(self.derivatives_root, max_bytes=2500)
+        for index, key in enumerate(["aa1", "bb2", "cc3"]):
+            path = cache.put(key, "png", lambda file: file.write(b"x" * 1000))
+            os.utime(path, (index, index))
+        self.assertIsNone(cache.get("aa1", "png"))
+        self.assertIsNotNone(cache.get("bb2", "png"))
+
+        os.utime(cache.path("bb2", "png"), (10, 10))
+        cache.put("dd4", "png", lambda file: file.write(b"x" * 1000))
+        self.assertIsNone(cache.get("cc3", "png"))
+        self.assertIsNotNone(cache.get("bb2", "png"))
+        self.assertLessEqual(cache.scan_size(), 2500)
+
+
+    def test_cache_renders_again_files_evicted_before_being_opened(self):
+        cache = DerivativeCache(self.derivatives_root, max_bytes=2500)
+        cache.put("ee5", "png", lambda file: file.write(b"old"))
+        # Evicted by another request once looked up
+        lookup = cache.get
+        cache.get = lambda key, fmt: os.unlink(lookup(key, fmt)) or cache.path(key, fmt)
+
+        with cache.open("ee5", "png", lambda file: file.write(b"new")) as file:
+            self.assertEqual(file.read(), b"new")
+
+
+class MediaBlobTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="blobs", password="blobs")
+        self.client.force_authenticate(user=self.user)
+        self.layout = Layout.objects.create(template=Template.objects.create(user=self.user, name="blobs"))
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media_root = media_root.name
+
+
+    def stored_files(self):
+        return sorted(os.path.relpath(os.path.join(directory, name), self.media_root)
+                      for directory, _, names in os.walk(self.media_root) for name in names)
+
+
+    def upload(self, file):
+        response = self.client.post("/api/medias/", {"content": file, "layout": self.layout.id, "width": 10, "height": 10}, format="multipart")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return MediaContent.objects.get(pk=response.data["config"]["mediaContent"]["id"])
+
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload(image_file("logo.png", (8, 8)))
+        second = self.upload(image_file("other name.png", (8, 8)))
+        other = self.upload(image_file("big.png", (16, 8)))
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.content.name, second.content.name)
+        self.assertNotEqual(first.blob_id, other.blob_id)
+        self.assertEqual(len(self.stored_files()), 2)
+        self.assertEqual(MediaBlob.objects.get(pk=first.blob_id).references, 2)
+        self.assertNotIn("blob", self.client.get(f"/api/medias/{first.id}/").data)
+
+        first.delete()
+        self.assertEqual(collect_blobs(), 0)
+        second.delete()
+        self.assertEqual(MediaBlob.objects.get(pk=second.blob_id).references, 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(collect_blobs(), 1)
+        self.assertEqual(self.stored_files(), [other.content.name])
+
+
+    def test_blob_collected_while_acquired_is_stored_again(self):
+        self.upload(image_file("logo.png", (8, 8))).delete()
+        collected = []
+
+        def collect_then_count(name):
+            # Runs between the lookup of the blob and the count of the new reference
+            if not collected:
+                with self.captureOnCommitCallbacks(execute=True):
+                    collected.append(collect_blobs())
+            return F(name)
+
+        with mock.patch("UpTemplateAPI.blobs.F", side_effect=collect_then_count):
+            media_content = self.upload(image_file("logo.png", (8, 8)))
+
+        self.assertEqual(collected, [1])
+        self.assertEqual(MediaBlob.objects.get(pk=media_content.blob_id).references, 1)
+        self.assertEqual(self.stored_files(), [media_content.content.name])
+
+
+    def test_files_left_by_rolled_back_uploads_are_collected(self):
+        kept = self.upload(image_file("logo.png", (8, 8)))
+        # The blob file is written, then the transaction creating its row rolls back
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            acquire_blob(image_file("big.png", (16, 8)))
+            raise DatabaseError
+        self.assertFalse(MediaBlob.objects.exclude(pk=kept.blob_id).exists())
+        self.assertEqual(len(self.stored_files()), 2)
+
+        self.assertEqual(collect_blobs(), 0)
+        self.assertEqual(collect_blobs(max_age=-60), 1)
+        self.assertEqual(self.stored_files(), [kept.content.name])
+
+
+    def test_legacy_uploads_are_adopted(self):
+        content = image_file("legacy.png", (8, 8)).read()
+        legacy = [MediaContent.objects.create(user=self.user, content=SimpleUploadedFile("legacy.png", content)) for _ in range(2)]
+        self.assertEqual(len(self.stored_files()), 2)
+
+        self.assertEqual(adopt_legacy_media(), 2)
+        legacy = [MediaContent.objects.get(pk=media_content.pk) for media_content in legacy]
+        self.assertEqual({media_content.blob.sha256 for media_content in legacy}, {hashlib.sha256(content).hexdigest()})
+        self.assertEqual(self.stored_files(), [legacy[0].content.name])
+        self.assertEqual(legacy[0].blob.references, 2)
+
+
+class ChunkedUploadTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="uploads", password="uploads")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="uploads")
+        self.layout = Layout.objects.create(template=self.template)
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name, UPLOAD_SESSIONS_ROOT=os.path.join(media_root.name, "sessions"))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.content = image_file("photo.png", (300, 200)).read()
+        self.url = "/api/uploads/"
+
+
+    def start(self, **overrides):
+        response = self.client.post(self.url, {
+            "filename": "photo.png", "size": len(self.content), "sha256": hashlib.sha256(self.content).hexdigest(),
+            "layout": self.layout.id, "width": 30, "height": 20, **overrides
+        }, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data["id"]
+
+
+    def put_chunk(self, session_id, start, end):
+        return self.client.generic(
+            "PUT", f"{self.url}{session_id}/", self.content[start:end], content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end - 1}/{len(self.content)}"
+        )
+
+
+    def test_chunked_upload_creates_the_image_shape(self):
+        session_id = self.start()
+        middle = len(self.content) // 2
+
+        self.assertEqual(self.put_chunk(session_id, 0, 100).data["offset"], 100)
+        # Out of order chunks are refused with the offset to resume from
+        response = self.put_chunk(session_id, middle, len(self.content))
+        self.assertEqual((response.status_code, response.data), (status.HTTP_409_CONFLICT, {"offset": 100}))
+        self.assertEqual(self.client.post(f"{self.url}{session_id}/finalize/").status_code, status.HTTP_409_CONFLICT)
+
+        self.assertEqual(self.client.get(f"{self.url}{session_id}/").data["offset"], 100)
+        self.put_chunk(session_id, 100, middle)
+        self.put_chunk(session_id, middle, len(self.content))
+
+        response = self.client.post(f"{self.url}{session_id}/finalize/")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data["type"], response.data["config"]["width"]), ("v-image", 30.0))
+        media_content = MediaContent.objects.get(pk=response.data["config"]["mediaContent"]["id"])
+        self.assertEqual((media_content.original_width, media_content.original_height), (300, 200))
+        self.assertEqual(media_content.blob.sha256, hashlib.sha256(self.content).hexdigest())
+        with media_content.content.open("rb") as stored:
+            self.assertEqual(stored.read(), self.content)
+
+        self.assertFalse(UploadSession.objects.filter(pk=session_id).exists())
+        self.assertFalse(os.path.exists(part_path(session_id)))
+        self.assertEqual(len(self.client.get(f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/").data), 1)
+
+
+    def test_chunk_written_concurrently_is_refused(self):
+        session_id, put_chunk = self.start(), self.put_chunk
+
+        class ConcurrentStream(io.BytesIO):
+            # Another request writes the same chunk while this one is streamed
+            def read(self, size=-1):
+                if not UploadSession.objects.filter(pk=session_id, received=100).exists():
+                    put_chunk(session_id, 0, 100)
+                return super().read(size)
+
+        with self.assertRaises(UploadError) as raised:
+            write_chunk(session_id, self.user, f"bytes 0-99/{len(self.content)}", 100, ConcurrentStream(self.content[:100]))
+        self.assertEqual((raised.exception.status_code, raised.exception.errors), (status.HTTP_409_CONFLICT, {"offset": 100}))
+        self.assertEqual(UploadSession.objects.get(pk=session_id).received, 100)
+
+
+    def test_unknown_session_ids(self):
+        url = f"{self.url}not-a-uuid/"
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.generic("PUT", url, b"x", HTTP_CONTENT_RANGE="bytes 0-0/1").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.post(f"{url}finalize/").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_finalize_rejects_a_wrong_hash(self):
+        session_id = self.start(sha256="0" * 64)
+        self.put_chunk(session_id, 0, len(self.content))
+
+        response = self.client.post(f"{self.url}{session_id}/finalize/")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("sha256", response.data)
+        self.assertEqual(MediaContent.objects.count(), 0)
+
+
+    def test_abandoned_sessions_are_collected(self):
+        abandoned, active = self.start(), self.start()
+        UploadSession.objects.filter(pk=abandoned).update(updated_at=UploadSession.objects.get(pk=abandoned).updated_at.replace(year=2000))
+
+        self.assertEqual(collect_sessions(), 1)
+        self.assertFalse(os.path.exists(part_path(abandoned)))
+        self.assertTrue(os.path.exists(part_path(active)))
+        self.assertEqual(self.client.delete(f"{self.url}{active}/").status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(os.path.exists(part_path(active)))
+
+
+class MediaServingTests(APITestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.content = bytes(range(256)) * 40
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        self.name = default_storage.save(f"blobs/{self.sha256[:2]}/{self.sha256[2:4]}/{self.sha256}.png", io.BytesIO(self.content))
+        self.url = f"/media/{self.name}"
+
+
+    def test_whole_file_with_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response["ETag"], f'"{self.sha256}"')
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=100-199")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), self.content[100:200])
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(self.content)}")
+        self.assertEqual(response["Content-Length"], "100")
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-10")
+        self.assertEqual(b"".join(response.streaming_content), self.content[-10:])
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10000-")
+        self.assertEqual(b"".join(response.streaming_content), self.content[10000:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.content)}-")
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.content)}")
+
+        # Invalid ranges are ignored
+        response = self.client.get(self.url, HTTP_RANGE="bytes=5-3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+
+        # A stale If-Range gets the whole file
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+    def test_compressed_files_are_not_encoded(self):
+        name = default_storage.save("src/archive.tar.gz", io.BytesIO(self.content))
+        response = self.client.get(f"/media/{name}", HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertNotIn("Content-Encoding", response)
+
+
+    def test_sendfile_offload(self):
+        with override_settings(MEDIA_SENDFILE="x-accel-redirect"):
+            response = self.client.get(self.url)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.name}")
+        self.assertEqual(response.content, b"")
+
+        with override_settings(MEDIA_SENDFILE="x-sendfile"):
+            response = self.client.get(self.url)
+        self.assertEqual(response["X-Sendfile"], default_storage.path(self.name))
+
+
+    def test_paths_outside_media_root(self):
+        self.assertEqual(self.client.get("/media/../settings.py").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get("/media/blobs/").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get("/media/missing.png").status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TemplateExportTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="export", password="export")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="poster", width=200, height=100)
+        self.layout = Layout.objects.create(template=self.template)
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name, MEDIA_DERIVATIVES_ROOT=os.path.join(media_root.name, "derivatives"))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        shapes, _ = get_shape_storage(self.layout).create(self.layout, [
+            {"type": "Rect", "x": 20, "y": 10, "width": 60, "height": 40, "fill": "#ff0000", "stroke_width": 0, "draggable": True},
+            {"type": "Circle", "x": 150, "y": 50, "radius": 30, "fill": "#0000ff", "stroke_width": 0, "opacity": 0.5, "draggable": True},
+            {"type": "Text", "x": 5, "y": 80, "text": "a < b", "font_family": "sans", "font_size": 12, "draggable": True},
+        ])
+        self.rect_id, self.circle_id, self.text_id = [shape["config"]["_id"] for shape in shapes]
+        self.url = f"/api/templates/{self.template.id}/export/"
+
+
+    def add_image(self, size=(8, 8)):
+        response = self.client.post("/api/medias/", {
+            "content": image_file("photo.png", size), "layout": self.layout.id, "width": 20, "height": 20
+        }, format="multipart")
+        return response.data["config"]["mediaContent"]["content"]
+
+
+    def test_svg_follows_drawing_order_and_transforms(self):
+        get_shape_storage(self.layout).reorder(self.layout, self.circle_id, "before", self.rect_id)
+        Shape.objects.filter(pk=self.rect_id).update(rotation=90, scale_x=2, offset_x=5)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+        svg = b"".join(response.streaming_content).decode()
+
+        # Bottom first
+        self.assertLess(svg.index("<circle"), svg.index("<rect"))
+        self.assertLess(svg.index("<rect"), svg.index("<text"))
+        # translate(20, 10) rotate(90) scale(2, 1) translate(-5, 0)
+        self.assertIn('<g transform="matrix(0 2 -1 0 20 0)"><rect width="60" height="40"', svg)
+        self.assertIn('<g opacity="0.5">', svg)
+        self.assertIn(">a &lt; b</tspan>", svg)
+
+
+    def test_svg_links_images(self):
+        content = self.add_image()
+        svg = b"".join(self.client.get(self.url).streaming_content).decode()
+        self.assertIn(f'<image width="20" height="20" href="http://testserver{content}" preserveAspectRatio="none"/>', svg)
+
+
+    def test_export_is_cached_by_revision(self):
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        shape_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/{self.rect_id}/"
+        self.assertEqual(self.client.put(shape_url, {"fill": "#00ff00", "draggable": True}, format="json").status_code, status.HTTP_200_OK)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn('fill="#00ff00"', b"".join(response.streaming_content).decode())
+
+
+    def test_png_export(self):
+        Shape.objects.filter(pk=self.rect_id).update(shadow_color="black", shadow_opacity=1, shadow_offset_x=0, shadow_offset_y=20)
+        self.add_image()
+        response = self.client.get(self.url, {"fmt": "png", "w": 100})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with Image.open(io.BytesIO(b"".join(response.streaming_content))) as image:
+            self.assertEqual((image.format, image.size), ("PNG", (100, 50)))
+            image = image.convert("RGBA")
+            self.assertEqual(image.getpixel((25, 15)), (255, 0, 0, 255))
+            # The shadow shows below the rect
+            self.assertEqual(image.getpixel((25, 32)), (0, 0, 0, 255))
+            # Half transparent circle
+            red, green, blue, alpha = image.getpixel((75, 25))
+            self.assertEqual((red, green, blue), (0, 0, 255))
+            self.assertAlmostEqual(alpha, 128, delta=2)
+            self.assertEqual(image.getpixel((95, 2))[3], 0)
+            self.assertEqual(image.getpixel((5, 5)), (255, 0, 0, 255))
+
+        self.assertEqual(self.client.get(self.url, {"fmt": "gif"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {"fmt": "png", "w": 0}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {"layout": self.layout.id + 1}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_png_export_limits(self):
+        Template.objects.filter(pk=self.template.id).update(width=0)
+        response = self.client.get(self.url, {"fmt": "png"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("template", response.data)
+
+        Template.objects.filter(pk=self.template.id).update(width=10, height=10 ** 9)
+        response = self.client.get(self.url, {"fmt": "png", "w": 10})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("w", response.data)
+        with self.assertRaises(ExportError):
+            rasterize(Template.objects.get(pk=self.template.id), [], 10)
+
+
+    def test_png_export_skips_decompression_bombs(self):
+        self.add_image((400, 400))
+        # Over twice the limit the source raises DecompressionBombError, the canvas stays under it
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 40000):
+            response = self.client.get(self.url, {"fmt": "png", "w": 100})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+    def test_huge_text_is_rejected(self):
+        Text.objects.filter(pk=Shape.objects.get(pk=self.text_id).shape_id).update(font_size=500, text="line\n" * 2000)
+        response = self.client.get(self.url, {"fmt": "png", "w": 100})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("text", response.data)
+
+
+    def test_fonts_are_looked_up_by_family(self):
+        with override_settings(EXPORT_FONTS_ROOT="/fonts", EXPORT_FONTS={"Open Sans": "OpenSans-Regular.ttf"}):
+            self.assertEqual(font_path("open sans"), "/fonts/OpenSans-Regular.ttf")
+            self.assertIsNone(font_path("/fonts/OpenSans-Regular.ttf"))
+            self.assertIsNone(font_path("../../etc/passwd"))
+
+
+@override_settings(EXPORT_JOBS_EAGER=True)
+class ExportJobTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="jobs", password="jobs")
+        self.client.force_authenticate(user=self.user)
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(
+            MEDIA_ROOT=os.path.join(media_root.name, "media"), MEDIA_DERIVATIVES_ROOT=os.path.join(media_root.name, "derivatives"),
+            EXPORT_ARTIFACTS_ROOT=os.path.join(media_root.name, "artifacts")
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.templates = [Template.objects.create(user=self.user, name=name, width=40, height=20) for name in ("First one", "Second")]
+        self.layouts = [Layout.objects.create(template=self.templates[0]) for _ in range(2)]
+        get_shape_storage(self.layouts[0]).create(self.layouts[0], [
+            {"type": "Rect", "width": 10, "height": 10, "fill": "red", "draggable": True}
+        ])
+
+
+    def start(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/jobs/", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        return self.client.get(f"/api/jobs/{response.data['id']}/").data
+
+
+    def artifact_names(self, job):
+        response = self.client.get(job["artifact"])
+        self.assertEqual(response["Content-Type"], "application/zip")
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            return sorted(archive.namelist()), archive
+
+
+    def test_unknown_job_ids(self):
+        for url in ("/api/jobs/not-a-uuid/", "/api/jobs/not-a-uuid/artifact/", f"/api/jobs/{uuid.uuid4()}/"):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_library_export(self):
+        job = self.start({"fmt": "svg"})
+        self.assertEqual((job["status"], job["total"], job["completed"]), ("done", 2, 2))
+
+        names, archive = self.artifact_names(job)
+        self.assertEqual(names, [f"first-one-{self.templates[0].id}.svg", f"second-{self.templates[1].id}.svg"])
+
+        # Only served to its owner by the job endpoint
+        artifact = ExportJob.objects.get(pk=job["id"]).artifact
+        self.assertFalse(default_storage.exists(artifact.name))
+        self.assertEqual(self.client.get(f"/media/{artifact.name}").status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=User.objects.create_user(username="other"))
+        self.assertEqual(self.client.get(job["artifact"]).status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_layouts_export(self):
+        job = self.start({"fmt": "png", "width": 80, "template": self.templates[0].id})
+        names, _ = self.artifact_names(job)
+        self.assertEqual(names, [f"first-one-{self.templates[0].id}/layout-{layout.id}.png" for layout in self.layouts])
+
+        response = self.client.post("/api/jobs/", {"templates": [self.templates[0].id, 999]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        other = Template.objects.create(user=User.objects.create_user(username="other"), name="other")
+        response = self.client.post("/api/jobs/", {"template": other.id}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_per_user_limit(self):
+        other = User.objects.create_user(username="other")
+        targets = [[self.templates[0].id, None]]
+        ExportJob.objects.create(user=self.user, targets=targets, status=ExportJob.RUNNING, started_at=timezone.now())
+        ExportJob.objects.create(user=self.user, targets=targets, status=ExportJob.RUNNING, started_at=timezone.now())
+        waiting = ExportJob.objects.create(user=self.user, targets=targets)
+        other_job = ExportJob.objects.create(user=other, targets=targets)
+
+        schedule_jobs()
+        waiting.refresh_from_db()
+        other_job.refresh_from_db()
+        self.assertEqual(waiting.status, ExportJob.QUEUED)
+        self.assertEqual(other_job.status, ExportJob.DONE)
+
+        # Running jobs that stopped reporting progress give their slot back
+        ExportJob.objects.filter(status=ExportJob.RUNNING).update(updated_at=timezone.now() - timedelta(days=1))
+        schedule_jobs()
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, ExportJob.DONE)
+        self.assertEqual(ExportJob.objects.filter(status=ExportJob.FAILED).count(), 2)
+
+
+    def test_claimed_jobs_are_not_stalled_before_they_start(self):
+        # Claimed, still waiting in the queue of the executor
+        claimed = ExportJob.objects.create(user=self.user, targets=[[self.templates[0].id, None]], status=ExportJob.RUNNING)
+        ExportJob.objects.filter(pk=claimed.pk).update(updated_at=timezone.now() - timedelta(hours=2))
+
+        schedule_jobs()
+        claimed.refresh_from_db()
+        self.assertEqual((claimed.status, claimed.started_at), (ExportJob.RUNNING, None))
+
+        run_job(claimed.pk)
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, ExportJob.DONE)
+        self.assertIsNotNone(claimed.started_at)
+
+        lost = ExportJob.objects.create(user=self.user, targets=[[self.templates[0].id, None]], status=ExportJob.RUNNING)
+        ExportJob.objects.filter(pk=lost.pk).update(updated_at=timezone.now() - timedelta(days=2))
+        schedule_jobs()
+        lost.refresh_from_db()
+        self.assertEqual(lost.status, ExportJob.FAILED)
+
+
+    def test_collect_jobs(self):
+        job = ExportJob.objects.get(pk=self.start({})["id"])
+        self.assertTrue(job.artifact.storage.exists(job.artifact.name))
+        self.assertEqual(collect_jobs(max_age=60), 0)
+
+        ExportJob.objects.filter(pk=job.pk).update(finished_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(collect_jobs(max_age=60), 1)
+        self.assertFalse(job.artifact.storage.exists(job.artifact.name))
+
+
+class CloneTests(APITestCase):
+
+    def setUp(self):
+        get_template_cache().clear()
+        self.user = User.objects.create_user(username="clone", password="clone")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=User.objects.create_user(username="author"), name="source", width=300)
+        self.media_content = MediaContent.objects.create(user=self.user, content="src/clone.png")
+
+        self.layouts = [Layout.objects.create(template=self.template) for _ in range(2)]
+        for layout in self.layouts:
+            shapes, _ = get_shape_storage(layout).create(layout, [
+                {"type": "Rect", "x": 1, "width": 10, "height": 20, "fill": "red", "draggable": True},
+                {"type": "Circle", "radius": 5, "shadow_offset_x": 2, "draggable": True},
+                {"type": "Text", "font_family": "Arial", "font_size": 12, "text": "text", "draggable": True},
+                {"type": "Image", "width": 30, "height": 40, "media_content": self.media_content.id, "draggable": True},
+            ])
+            get_shape_storage(layout).set_order(layout, [shape["config"]["_id"] for shape in shapes][::-1])
+        convert_layout_storage(self.layouts[1], Layout.DOCUMENT)
+
+
+    def document(self, template_id):
+        return self.client.get(f"/api/templates/{template_id}/data/").data
+
+
+    def without_ids(self, layouts):
+        return [
+            [{**shape, "config": {key: value for key, value in shape["config"].items() if key != "_id"}} for shape in layout["shapes"]]
+            for layout in layouts
+        ]
+
+
+    def test_clone_template(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(f"/api/templates/{self.template.id}/clone/", {"name": "copy"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertLess(len(queries), 25)
+
+        copy = Template.objects.get(pk=response.data["id"])
+        self.assertEqual((copy.user, copy.name, copy.width), (self.user, "copy", 300))
+        source, cloned = self.document(self.template.id), self.document(copy.id)
+        self.assertEqual(self.without_ids(cloned["layouts"]), self.without_ids(source["layouts"]))
+
+        rows_layout = cloned["layouts"][0]
+        self.assertEqual([shape["type"] for shape in rows_layout["shapes"]], ["v-image", "v-text", "v-circle", "v-rect"])
+        self.assertTrue(set(rows_layout["drawing_index_list"]).isdisjoint(source["layouts"][0]["drawing_index_list"]))
+        # Documents keep their own shape ids
+        self.assertEqual(cloned["layouts"][1]["drawing_index_list"], source["layouts"][1]["drawing_index_list"])
+
+        # Concrete rows are copied, the uploaded media is shared
+        self.assertEqual(Rectangle.objects.count(), 2)
+        self.assertEqual(Media.objects.filter(media_content=self.media_content).count(), 2)
+        self.assertEqual(MediaContent.objects.count(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/templates/{copy.id}/")
+        self.assertEqual(self.without_ids(self.document(self.template.id)["layouts"]), self.without_ids(source["layouts"]))
+
+
+    def test_clone_layout(self):
+        revision = Template.objects.get(pk=self.template.id).revision
+        response = self.client.post(f"/api/templates/{self.template.id}/layouts/{self.layouts[0].id}/clone/")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["template"], self.template.id)
+        self.assertEqual([shape["type"] for shape in response.data["shapes"]], ["v-image", "v-text", "v-circle", "v-rect"])
+        self.assertEqual(Template.objects.get(pk=self.template.id).revision, revision + 1)
+
+        response = self.client.post(f"/api/templates/{self.template.id + 1}/layouts/{self.layouts[0].id}/clone/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ZOrderTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="z_order", password="z_order")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="z order")
+        self.layout = Layout.objects.create(template=self.template)
+        shapes, _ = get_shape_storage(self.layout).create(self.layout, [
+            {"type": "Rect", "width": 10, "height": 10, "draggable": True} for _ in range(4)
+        ])
+        self.shape_ids = [shape["config"]["_id"] for shape in shapes]
+        self.shapes_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/"
+
+
+    def order(self):
+        return [shape["config"]["_id"] for shape in self.client.get(self.shapes_url).data]
+
+
+    def move(self, shape_id, position, target=None):
+        data = {"position": position} if target is None else {"position": position, "target": target}
+        return self.client.post(f"{self.shapes_url}{shape_id}/order/", data, format="json")
+
+
+    def test_rank_between(self):
+        self.assertEqual(rank_between(None, None), "i")
+        self.assertIsNone(rank_between(None, ""))
+        ranks = spaced_ranks(50)
+        self.assertEqual(ranks, sorted(ranks))
+        for _ in range(100):
+            rank = rank_between(ranks[0], ranks[1])
+            self.assertTrue(ranks[0] < rank < ranks[1] and not rank.endswith("0"))
+            ranks.insert(1, rank)
+
+
+    def test_created_shapes_stack_on_top(self):
+        self.assertEqual(self.order(), self.shape_ids)
+        response = self.client.post(self.shapes_url, {"type": "Circle", "radius": 5, "draggable": True}, format="json")
+        self.assertEqual(self.order(), self.shape_ids + [response.data["config"]["_id"]])
+
+
+    def test_moves_rewrite_one_rank(self):
+        a, b, c, d = self.shape_ids
+        for shape_id, position, target, expected in [
+            (a, "front", None, [b, c, d, a]),
+            (d, "back", None, [d, b, c, a]),
+            (a, "after", d, [d, a, b, c]),
+            (c, "before", b, [d, a, c, b]),
+        ]:
+            ranks = dict(Shape.objects.filter(layout=self.layout).values_list("_id", "z_rank"))
+            response = self.move(shape_id, position, target)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["config"]["_id"], shape_id)
+            self.assertEqual(self.order(), expected)
+
+            moved_ranks = dict(Shape.objects.filter(layout=self.layout).values_list("_id", "z_rank"))
+            self.assertEqual({shape_id for shape_id in ranks if ranks[shape_id] != moved_ranks[shape_id]}, {shape_id})
+
+
+    def test_invalid_moves(self):
+        self.assertEqual(self.move(self.shape_ids[0], "after").status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.move(self.shape_ids[0], "sideways").status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.move(self.shape_ids[0], "after", self.shape_ids[0]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.move(self.shape_ids[0], "after", 999).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_repeated_moves_rebalance(self):
+        # Always right after the first shape, ranks get longer until the layout is rebalanced
+        for shape_id in self.shape_ids[2:] * 100:
+            get_shape_storage(self.layout).reorder(self.layout, shape_id, "before", self.shape_ids[1])
+        self.assertEqual(self.order(), [self.shape_ids[0], self.shape_ids[2], self.shape_ids[3], self.shape_ids[1]])
+        self.assertLessEqual(max(len(rank) for rank in Shape.objects.values_list("z_rank", flat=True)), 32)
+
+
+    def test_unranked_shapes_are_rebalanced(self):
+        layout = Layout.objects.create(template=self.template, drawing_index_list=[])
+        create_layout_shapes(layout, self.user, 1)
+        shape_ids = list(Shape.objects.filter(layout=layout).order_by("_id").values_list("_id", flat=True))
+
+        get_shape_storage(layout).reorder(layout, shape_ids[0], "after", shape_ids[1])
+        self.assertEqual(
+            list(Shape.objects.filter(layout=layout).order_by("z_rank", "_id").values_list("_id", flat=True)),
+            [shape_ids[1], shape_ids[0], *shape_ids[2:]]
+        )
+
+
+    def test_rank_shapes_command(self):
+        layout = Layout.objects.create(template=self.template)
+        create_layout_shapes(layout, self.user, 1)
+        shape_ids = list(Shape.objects.filter(layout=layout).order_by("_id").values_list("_id", flat=True))
+        layout.drawing_index_list = shape_ids[::-1]
+        layout.save()
+
+        management.call_command("rank_shapes", stdout=io.StringIO())
+        layout_data = self.client.get(f"/api/templates/{self.template.id}/layouts/{layout.id}/").data
+        self.assertEqual(layout_data["drawing_index_list"], shape_ids[::-1])
+        self.assertEqual(self.order(), self.shape_ids)
+
+
+    def test_document_storage(self):
+        convert_layout_storage(self.layout, Layout.DOCUMENT)
+        a, b, c, d = self.shape_ids
+
+        self.assertEqual(self.move(b, "front").status_code, status.HTTP_200_OK)
+        self.assertEqual(self.move(d, "after", a).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.order(), [a, d, c, b])
+
+        convert_layout_storage(Layout.objects.get(pk=self.layout.id), Layout.ROWS)
+        self.assertEqual([shape["type"] for shape in self.client.get(self.shapes_url).data], ["v-rect"] * 4)
+        self.assertEqual(
+            list(Shape.objects.filter(layout=self.layout).order_by("z_rank", "_id").values_list("_id", flat=True)),
+            self.order()
+        )
+
+
+class SpatialIndexTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="spatial", password="spatial")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="spatial")
+        self.layout = Layout.objects.create(template=self.template)
+
+        # A 20 x 20 grid of rects 300 units apart, then a background, a rotated bar, a circle and a text
+        payloads = [
+            {"type": "Rect", "x": 300 * column, "y": 300 * row, "width": 100, "height": 50, "draggable": True}
+            for row in range(20) for column in range(20)
+        ] + [
+            {"type": "Rect", "x": -10, "y": -10, "width": 200000, "height": 200000, "stroke_width": 0, "draggable": True},
+            {"type": "Rect", "x": 1000, "y": 1000, "width": 2000, "height": 10, "rotation": 45, "draggable": True},
+            {"type": "Circle", "x": 5000, "y": 5000, "radius": 100, "stroke_width": 0, "draggable": True},
+            {"type": "Text", "x": 2000, "y": 4000, "text": "label\nsecond line", "font_family": "sans", "font_size": 20, "draggable": True},
+        ]
+        shapes, errors = get_shape_storage(self.layout).create(self.layout, payloads)
+        self.assertIsNone(errors)
+        self.shapes = shapes
+        self.background_id, self.bar_id, self.circle_id, self.text_id = [shape["config"]["_id"] for shape in shapes[-4:]]
+        self.shapes_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/"
+
+
+    def query(self, box):
+        response = self.client.get(self.shapes_url, {"bbox": ",".join(map(str, box))})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [shape["config"]["_id"] for shape in response.data]
+
+
+    def expected(self, box):
+        shapes = self.client.get(self.shapes_url).data
+        return [shape["config"]["_id"] for shape in shapes if overlaps(shape_box(shape), box)]
+
+
+    def hit(self, x, y):
+        response = self.client.get(f"{self.shapes_url}hit/", {"x": x, "y": y})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [shape["config"]["_id"] for shape in response.data]
+
+
+    def test_bbox_matches_a_scan(self):
+        boxes = [(0, 0, 50, 50), (250, 250, 320, 310), (1500, 1500, 1600, 1600), (4950, 4950, 4960, 4960),
+                 (2000, 4010, 2010, 4020), (-500, -500, -400, -400), (0, 0, 6000, 6000), (3000, 100, 5000, 120)]
+        for box in boxes:
+            self.assertEqual(self.query(box), self.expected(box), box)
+
+        self.assertEqual(self.query((250, 250, 320, 310)), [self.shapes[21]["config"]["_id"], self.background_id])
+        self.assertEqual(self.query((-500, -500, -400, -400)), [])
+
+
+    def test_bbox_follows_updates(self):
+        moved_id = self.shapes[0]["config"]["_id"]
+        response = self.client.patch(f"{self.shapes_url}transform/", [{"id": moved_id, "x": -1000, "y": -1000}], format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.query((-1000, -1000, -990, -990)), [moved_id])
+        self.assertNotIn(moved_id, self.query((0, 0, 50, 50)))
+
+        response = self.client.put(f"{self.shapes_url}{moved_id}/", {"width": 5000, "draggable": True}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.query((3000, -980, 3010, -970)), [moved_id])
+
+        self.client.delete(f"{self.shapes_url}{moved_id}/")
+        self.assertEqual(self.query((-1000, -1000, -990, -990)), [])
+
+
+    def test_hit_test(self):
+        # Topmost first, the background last
+        self.assertEqual(self.hit(5000, 5050), [self.circle_id, self.background_id])
+        # Inside the box of the circle, outside the circle
+        self.assertEqual(self.hit(5090, 5090), [self.background_id])
+        # Along the rotated bar, far from its corners
+        self.assertEqual(self.hit(1700, 1710), [self.bar_id, self.background_id])
+        self.assertEqual(self.hit(1700, 1600), [self.background_id])
+        self.assertEqual(self.hit(-100, -100), [])
+
+        self.assertEqual(self.client.get(f"{self.shapes_url}hit/", {"x": "a"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.shapes_url, {"bbox": "1,2,3"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_document_layout(self):
+        box = (1500, 1500, 2600, 2600)
+        expected = self.query(box)
+        convert_layout_storage(self.layout, Layout.DOCUMENT)
+        self.assertEqual(self.query(box), expected)
+        self.assertEqual(self.hit(5000, 5050), [self.circle_id, self.background_id])
+
+        convert_layout_storage(Layout.objects.get(pk=self.layout.id), Layout.ROWS)
+        self.assertEqual(ShapeBox.objects.filter(layout=self.layout).count(), len(self.shapes))
+        self.assertEqual(self.query(box), self.expected(box))
+
+
+    def test_clone_and_rebuild(self):
+        response = self.client.post(f"/api/templates/{self.template.id}/layouts/{self.layout.id}/clone/")
+        copy_url = f"/api/templates/{self.template.id}/layouts/{response.data['id']}/shapes/"
+        box = (1500, 1500, 2600, 2600)
+        self.assertEqual(len(self.client.get(copy_url, {"bbox": "1500,1500,2600,2600"}).data), len(self.query(box)))
+
+        expected = self.query(box)
+        ShapeBox.objects.all().delete()
+        management.call_command("index_shapes", stdout=io.StringIO())
+        self.assertEqual(self.query(box), expected)
+
+
+class ArrangeTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="arrange", password="arrange")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="arrange")
+        self.layout = Layout.objects.create(template=self.template)
+
+        payloads = [
+            {"type": "Rect", "x": 10, "y": 40, "width": 100, "height": 50, "stroke_width": 0, "draggable": True},
+            {"type": "Circle", "x": 400, "y": 100, "radius": 20, "stroke_width": 0, "draggable": True},
+            {"type": "Rect", "x": 200, "y": 0, "width": 40, "height": 40, "rotation": 90, "stroke_width": 0, "draggable": True},
+            {"type": "Text", "x": 600, "y": 10, "text": "abc", "font_family": "sans", "font_size": 10, "stroke_width": 0, "draggable": True},
+        ]
+        shapes, errors = get_shape_storage(self.layout).create(self.layout, payloads)
+        self.assertIsNone(errors)
+        self.ids = [shape["config"]["_id"] for shape in shapes]
+        self.layout_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/"
+
+
+    def arrange(self, **data):
+        response = self.client.post(f"{self.layout_url}arrange/", {"shapes": self.ids, **data}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data
+
+
+    def boxes(self):
+        shapes = {shape["config"]["_id"]: shape for shape in self.client.get(f"{self.layout_url}shapes/").data}
+        return [shape_box(shapes[shape_id]) for shape_id in self.ids]
+
+
+    def assertBoxesEqual(self, boxes, expected):
+        for box, expected_box in zip(boxes, expected):
+            for value, expected_value in zip(box, expected_box):
+                self.assertAlmostEqual(value, expected_value, places=6)
+
+
+    def test_align(self):
+        before = self.boxes()
+        data = self.arrange(operation="align", edge="left")
+        self.assertEqual(data["updated"], self.ids)
+        self.assertEqual(set(data["transforms"][0]), {"id", "x", "y", "offsetX", "offsetY", "scaleX", "scaleY", "rotation"})
+        self.assertEqual([box[0] for box in self.boxes()], [10] * 4)
+        self.assertEqual([box[1] for box in self.boxes()], [box[1] for box in before])
+
+        self.arrange(operation="align", edge="bottom")
+        self.assertBoxesEqual([box[3:] for box in self.boxes()], [(120,)] * 4)
+
+        self.arrange(operation="align", edge="center")
+        centers = [(box[0] + box[2]) / 2 for box in self.boxes()]
+        self.assertBoxesEqual([(center,) for center in centers], [(centers[0],)] * 4)
+
+
+    def test_distribute(self):
+        before = self.boxes()
+        self.arrange(operation="distribute", axis="horizontal")
+        boxes = sorted(self.boxes())
+        self.assertAlmostEqual(boxes[0][0], min(box[0] for box in before))
+        self.assertAlmostEqual(boxes[-1][2], max(box[2] for box in before))
+        gaps = [after[0] - previous[2] for previous, after in zip(boxes, boxes[1:])]
+        self.assertBoxesEqual([gaps], [[gaps[0]] * 3])
+        # Only the x axis moved
+        self.assertEqual(sorted(box[1] for box in self.boxes()), sorted(box[1] for box in before))
+
+
+    def test_group_transform(self):
+        before = self.boxes()
+        self.arrange(operation="transform", scale_x=2, scale_y=2, origin_x=0, origin_y=0)
+        self.assertBoxesEqual(self.boxes(), [[value * 2 for value in box] for box in before])
+
+        # A quarter turn around the origin sends (x, y) to (-y, x)
+        self.arrange(operation="transform", rotation=90, originX=0, originY=0)
+        self.assertBoxesEqual(self.boxes(), [(-2 * box[3], 2 * box[0], -2 * box[1], 2 * box[2]) for box in before])
+
+        # Undone around the center of the selection by default
+        center = self.boxes()
+        self.arrange(operation="transform", rotation=-90)
+        self.arrange(operation="transform", rotation=90)
+        self.assertBoxesEqual(self.boxes(), center)
+
+
+    def test_one_bulk_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.arrange(operation="align", edge="top")
+        updates = [query["sql"] for query in queries.captured_queries if query["sql"].startswith('UPDATE "UpTemplateAPI_shape"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual([box[1] for box in self.boxes()], [0] * 4)
+        # The spatial index follows
+        shapes_url = f"{self.layout_url}shapes/"
+        self.assertEqual(len(self.client.get(shapes_url, {"bbox": "0,-5,1000,-1"}).data), 0)
+
+
+    def test_document_layout(self):
+        copy = clone_layout(self.layout)
+        convert_layout_storage(copy, Layout.DOCUMENT)
+        copy_url = f"/api/templates/{self.template.id}/layouts/{copy.id}/"
+        copy_ids = [shape["config"]["_id"] for shape in self.client.get(f"{copy_url}shapes/").data]
+
+        for operation in [
+            {"operation": "transform", "scale_x": 0.5, "scale_y": 3, "rotation": 30},
+            {"operation": "distribute", "axis": "vertical"},
+            {"operation": "align", "edge": "right"},
+        ]:
+            expected = self.arrange(**operation)
+            response = self.client.post(f"{copy_url}arrange/", {"shapes": copy_ids, **operation}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["updated"], copy_ids)
+            self.assertBoxesEqual(
+                [[update[name] for name in ("x", "y", "scaleX", "scaleY", "rotation")] for update in response.data["transforms"]],
+                [[update[name] for name in ("x", "y", "scaleX", "scaleY", "rotation")] for update in expected["transforms"]],
+            )
+
+        shapes = self.client.get(f"{copy_url}shapes/").data
+        self.assertBoxesEqual([shape_box(shape) for shape in shapes], self.boxes())
+
+
+    def test_invalid(self):
+        url = f"{self.layout_url}arrange/"
+        self.assertEqual(self.client.post(url, {"shapes": self.ids, "operation": "align"}, format="json").status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, {"shapes": [], "operation": "distribute", "axis": "vertical"}, format="json").status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, {"shapes": self.ids, "operation": "transform", "scaleX": 0}, format="json").status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, {"shapes": [*self.ids, 99999], "operation": "align", "edge": "top"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("id", response.data)
+
+
+class SnappingTests(APITestCase):
+
+    def setUp(self):
+        # Box versions live in the cache, indexes of rolled back layouts must not be reused
+        get_template_cache().clear()
+        self.user = User.objects.create_user(username="snapping", password="snapping")
+        self.client.force_authenticate(user=self.user)
+        self.template = Template.objects.create(user=self.user, name="snapping")
+        self.layout = Layout.objects.create(template=self.template)
+
+        # Rects of 40 x 20 on a 100 units grid, and a circle centered on (500, 500)
+        payloads = [
+            {"type": "Rect", "x": 100 * column, "y": 100 * row, "width": 40, "height": 20, "stroke_width": 0, "draggable": True}
+            for row in range(5) for column in range(5)
+        ] + [{"type": "Circle", "x": 500, "y": 500, "radius": 30, "stroke_width": 0, "draggable": True}]
+        shapes, errors = get_shape_storage(self.layout).create(self.layout, payloads)
+        self.assertIsNone(errors)
+        self.ids = [shape["config"]["_id"] for shape in shapes]
+        self.shapes_url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/"
+
+
+    def snap(self, box, **params):
+        response = self.client.get(f"{self.shapes_url}snap/", {"box": ",".join(map(str, box)), **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data
+
+
+    def scan(self, box, tolerance=5, exclude=()):
+        shapes = self.client.get(self.shapes_url).data
+        return scan_candidates({shape["config"]["_id"]: shape_box(shape) for shape in shapes}, box, tolerance, exclude)
+
+
+    def test_candidates(self):
+        # The left edge of the box 2 units right of the left edges of the second column
+        candidates = self.snap((102, 250, 112, 260), tolerance=3)
+        self.assertEqual(
+            [(candidate["edge"], candidate["targetEdge"], candidate["offset"]) for candidate in candidates["x"]],
+            [("left", "left", -2)] * 5
+        )
+        self.assertEqual([candidate["shape"] for candidate in candidates["x"]], self.ids[1:25:5])
+        self.assertEqual(candidates["y"], [])
+
+        # Nearest first, the dragged shapes left out
+        candidates = self.snap((468, 400, 528, 430), tolerance=3, exclude=",".join(map(str, self.ids[:24])))
+        self.assertEqual(
+            [(candidate["shape"], candidate["edge"], candidate["targetEdge"], candidate["position"]) for candidate in candidates["x"]],
+            [(self.ids[25], "center", "center", 500), (self.ids[25], "left", "left", 470), (self.ids[25], "right", "right", 530)]
+        )
+        self.assertEqual(candidates["y"], [{"edge": "top", "shape": self.ids[24], "targetEdge": "top", "position": 400, "offset": 0}])
+
+        for box in [(0, 0, 50, 50), (95, 195, 143, 222), (470, 470, 530, 530), (-1000, -1000, -900, -900)]:
+            self.assertEqual(self.snap(box, tolerance=7), self.scan(box, tolerance=7))
+
+
+    def test_follows_writes(self):
+        box = (297, 297, 340, 320)
+        self.assertEqual(self.snap(box), self.scan(box))
+        index = snapping._indexes[self.layout.id]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"{self.shapes_url}transform/", [{"id": self.ids[0], "x": 299, "y": 301}], format="json")
+        self.assertIn(self.ids[0], [candidate["shape"] for candidate in self.snap(box)["x"]])
+        self.assertEqual(self.snap(box), self.scan(box))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"{self.shapes_url}{self.ids[0]}/")
+            get_shape_storage(self.layout).create(self.layout, [{"type": "Rect", "x": 340, "y": 0, "width": 1, "height": 1, "draggable": True}])
+        self.assertNotIn(self.ids[0], [candidate["shape"] for candidate in self.snap(box)["x"]])
+        self.assertEqual(self.snap(box), self.scan(box))
+        # Moved in place rather than rebuilt
+        self.assertIs(snapping._indexes[self.layout.id], index)
+
+        # A write of another process bumps the version without touching this index
+        bump_layout_boxes_version(self.layout.id)
+        self.assertEqual(self.snap(box), self.scan(box))
+        self.assertIsNot(snapping._indexes[self.layout.id], index)
+
+
+    def test_document_layout(self):
+        box = (197, 95, 243, 110)
+        expected = self.snap(box)
+        convert_layout_storage(self.layout, Layout.DOCUMENT)
+        self.assertEqual(self.snap(box), expected)
+
+        self.client.patch(f"{self.shapes_url}transform/", [{"id": self.ids[7], "y": 2000}], format="json")
+        self.assertEqual(self.snap(box), self.scan(box))
+        self.assertNotEqual(self.snap(box), expected)
+
+
+    def test_invalid(self):
+        url = f"{self.shapes_url}snap/"
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {"box": "0,0,1,1", "tolerance": "1000"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {"box": "0,0,1,1", "tolerance": "nan"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {"box": "0,0,1,1", "exclude": "a"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+# Statements whose plans are checked, INSERTs and savepoints read no table
+EXPLAINED_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+
+
+def query_plan(sql, params):
+    """
+    Plan of a statement: the JSON plan nodes on PostgreSQL, with sequential scans only where no
+    index applies, the EXPLAIN QUERY PLAN details on SQLite.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            # Small tables are cheaper to scan, only a missing index should leave a sequential scan
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            nodes, plan = [cursor.fetchone()[0][0]["Plan"]], []
+            while nodes:
+                plan.append(nodes.pop())
+                nodes += plan[-1].get("Plans", [])
+            return plan
+
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [detail for *_, detail in cursor.fetchall()]
+
+
+def full_scans(sql, params):
+    """Tables (or their aliases) a statement reads whole."""
+    if connection.vendor == "postgresql":
+        return [node["Relation Name"] for node in query_plan(sql, params) if node["Node Type"] == "Seq Scan"]
+    # SQLite: "SCAN table" reads a table, "SCAN table USING [COVERING] INDEX" a whole index
+    return [
+        detail.split()[1] for detail in query_plan(sql, params)
+        if detail.startswith("SCAN ") and not detail.startswith(("SCAN CONSTANT ROW", "SCAN (subquery"))
+    ]
+
+
+def used_indexes(sql, params):
+    if connection.vendor == "postgresql":
+        return [node["Index Name"] for node in query_plan(sql, params) if "Index Name" in node]
+    return [detail.split(" INDEX ")[1].split()[0] for detail in query_plan(sql, params) if " INDEX " in detail]
+
+
+class QueryPlanTests(APITestCase):
+    """The hot endpoints must read every large table through an index, see full_scans."""
+
+    @classmethod
+    def setUpTestData(cls):
+        # 20 users with 5 templates of 2 layouts of 32 shapes each, every image with its own upload
+        for index in range(20):
+            user = User.objects.create_user(username=f"plans{index}", password="plans")
+            for template_index in range(5):
+                template = Template.objects.create(user=user, name=f"plans {template_index}")
+                for _ in range(2):
+                    layout = Layout.objects.create(template=template)
+                    media_contents = MediaContent.objects.bulk_create([MediaContent(user=user) for _ in range(8)])
+                    _, errors = bulk_create_shapes(layout, [
+                        [
+                            {"type": "Rect", "x": shape_index, "width": 10, "height": 20},
+                            {"type": "Circle", "x": shape_index, "radius": 5},
+                            {"type": "Text", "x": shape_index, "fontFamily": "Arial", "fontSize": 12, "text": "text"},
+                            {"type": "Image", "x": shape_index, "width": 30, "height": 40, "mediaContent": media_contents[shape_index // 4].id},
+                        ][shape_index % 4]
+                        for shape_index in range(32)
+                    ])
+                    assert not errors, errors
+        cls.user, cls.template, cls.layout = user, template, layout
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+
+    def setUp(self):
+        get_template_cache().clear()
+        self.client.force_authenticate(user=self.user)
+
+
+    def assertIndexed(self, request):
+        statements = []
+
+        def log(execute, sql, params, many, context):
+            if not many and sql.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(log):
+            response = request()
+        self.assertLess(response.status_code, 400)
+        self.assertTrue(statements)
+
+        scans = {sql: full_scans(sql, params) for sql, params in statements}
+        self.assertEqual({sql: tables for sql, tables in scans.items() if tables}, {})
+
+
+    def test_data(self):
+        self.assertIndexed(lambda: self.client.get(f"/api/templates/{self.template.id}/data/"))
+
+
+    def test_mine(self):
+        self.assertIndexed(lambda: self.client.get("/api/templates/mine/"))
+        self.assertIndexed(lambda: self.client.get("/api/templates/mine/", {"page_size": 2}))
+
+
+    def test_medias(self):
+        self.assertIndexed(lambda: self.client.get(f"/api/templates/{self.template.id}/medias/"))
+
+
+    def test_shape_pages(self):
+        url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/"
+        first_page = self.client.get(url, {"page_size": 2}).data
+        self.assertIndexed(lambda: self.client.get(url, {"page_size": 2}))
+        self.assertIndexed(lambda: self.client.get(first_page["next"]))
+
+
+    def test_shape_update(self):
+        shape = get_shape_storage(self.layout).representations(self.layout)[0]
+        url = f"/api/templates/{self.template.id}/layouts/{self.layout.id}/shapes/{shape['config']['_id']}/"
+        self.assertIndexed(lambda: self.client.put(url, {**shape["config"], "type": "Rect", "width": 50}, format="json"))
+
+
+    def test_generic_relation_lookup(self):
+        # Not a full scan on the content_type index alone either, every shape of the type would be read
+        index, = [index for index in Shape._meta.indexes if index.fields == ['content_type', 'shape_id']]
+        shape = Shape.objects.filter(layout=self.layout).first()
+        sql, params = Shape.objects.filter(content_type=shape.content_type_id, shape_id=shape.shape_id).values("_id").query.sql_with_params()
+        self.assertEqual(used_indexes(sql, params), [index.name])
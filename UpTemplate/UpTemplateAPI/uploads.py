@@ -0,0 +1,195 @@
+"""
+Chunked, resumable media uploads.
+
+    POST   /api/uploads/                  {filename, size, sha256, layout, width, height[, alt]}
+    PUT    /api/uploads/<id>/             raw bytes, Content-Range: bytes <start>-<end>/<size>
+    GET    /api/uploads/<id>/             {offset, ...}, where to resume from
+    POST   /api/uploads/<id>/finalize/    verify and create the media
+    DELETE /api/uploads/<id>/             abort
+
+Chunks are appended in order and streamed from the request to the session part
+file without being held in memory, nor a lock on the session: the session row is
+only locked once the chunk is written, to advance its offset. Concurrent writes of
+the same range leave the bytes of one of them, the hash is checked on finalize. Sessions left untouched for
+UPLOAD_SESSION_EXPIRY seconds are removed by the collect_upload_sessions command.
+"""
+import os
+import re
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from .blobs import acquire_blob, file_digest
+from .images import image_dimensions, InvalidImage
+from .models import UploadSession, MediaContent
+from .storage import get_shape_storage
+
+
+UPLOAD_CHUNK_MAX_BYTES = getattr(settings, "UPLOAD_CHUNK_MAX_BYTES", 8 * 1024 * 1024)
+UPLOAD_MAX_BYTES = getattr(settings, "UPLOAD_MAX_BYTES", 100 * 1024 * 1024)
+UPLOAD_SESSION_EXPIRY = getattr(settings, "UPLOAD_SESSION_EXPIRY", 24 * 60 * 60)
+
+STREAM_BLOCK_SIZE = 64 * 1024
+CONTENT_RANGE = re.compile(r"^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<size>\d+)$")
+
+
+class UploadError(Exception):
+    """Rejected upload step, carries the errors and the status code of the response."""
+
+    def __init__(self, errors, status_code=400):
+        super().__init__(errors)
+        self.errors = errors
+        self.status_code = status_code
+
+
+def get_sessions_root():
+    return str(getattr(settings, "UPLOAD_SESSIONS_ROOT", os.path.join(settings.MEDIA_ROOT, "uploads")))
+
+
+def part_path(session_id):
+    return os.path.join(get_sessions_root(), f"{session_id}.part")
+
+
+def start_session(user, validated_data):
+    if validated_data["size"] > UPLOAD_MAX_BYTES:
+        raise UploadError({"size": [f"Uploads are limited to {UPLOAD_MAX_BYTES} bytes."]})
+
+    session = UploadSession.objects.create(user=user, **validated_data)
+    os.makedirs(get_sessions_root(), exist_ok=True)
+    open(part_path(session.id), "wb").close()
+    return session
+
+
+def write_chunk(session_id, user, content_range, content_length, stream):
+    """
+    Write the chunk read from stream at the offset given by the Content-Range header, then
+    advance the offset of the session if it still matches, returns the session.
+    """
+    match = CONTENT_RANGE.match(content_range or "")
+    if not match:
+        raise UploadError({"Content-Range": ["Expected bytes <start>-<end>/<size>."]})
+    start, end, size = int(match["start"]), int(match["end"]), int(match["size"])
+    length = end - start + 1
+    if length <= 0 or length > UPLOAD_CHUNK_MAX_BYTES:
+        raise UploadError({"Content-Range": [f"Chunks hold 1 to {UPLOAD_CHUNK_MAX_BYTES} bytes."]})
+    if content_length is not None and content_length != length:
+        raise UploadError({"Content-Length": ["Does not match the Content-Range."]})
+
+    session = UploadSession.objects.filter(pk=session_id, user=user).first()
+    check_chunk(session, start, end, size)
+
+    written = 0
+    try:
+        with open(part_path(session.id), "r+b") as part:
+            part.seek(start)
+            while written < length:
+                block = stream.read(min(STREAM_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                part.write(block)
+                written += len(block)
+    except FileNotFoundError:
+        # Aborted or collected meanwhile
+        raise UploadError({"detail": "Not found."}, 404)
+
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().filter(pk=session_id, user=user).first()
+        # Checked again, another request may have written the chunk meanwhile
+        check_chunk(session, start, end, size)
+        # A short body keeps what was received, the client resumes from there
+        session.received = start + written
+        session.save(update_fields=["received", "updated_at"])
+    return session
+
+
+def check_chunk(session, start, end, size):
+    if session is None:
+        raise UploadError({"detail": "Not found."}, 404)
+    if size != session.size or end >= session.size:
+        raise UploadError({"Content-Range": [f"The upload holds {session.size} bytes."]}, 416)
+    if start != session.received:
+        # Chunks are appended in order, the client resumes from the returned offset
+        raise UploadError({"offset": session.received}, 409)
+
+
+def finalize_session(session_id, user):
+    """Verify the uploaded bytes and create the MediaContent and its Image shape, returns the shape representation."""
+    session = UploadSession.objects.select_related("layout").filter(pk=session_id, user=user).first()
+    if session is None:
+        raise UploadError({"detail": "Not found."}, 404)
+    if session.received != session.size:
+        raise UploadError({"offset": session.received, "size": [f"{session.size - session.received} bytes are missing."]}, 409)
+
+    path = part_path(session.id)
+    with open(path, "rb") as part:
+        file = File(part, name=session.filename)
+        size, sha256 = file_digest(file)
+        if sha256 != session.sha256.lower():
+            raise UploadError({"sha256": ["The uploaded bytes do not match the hash."]})
+        try:
+            original_width, original_height = image_dimensions(file)
+        except InvalidImage:
+            raise UploadError({"content": ["Upload a valid image."]})
+
+        with transaction.atomic():
+            # A concurrent finalize of the same session creates nothing
+            if not UploadSession.objects.select_for_update().filter(pk=session.pk).exists():
+                raise UploadError({"detail": "Not found."}, 404)
+            blob = acquire_blob(file, size, sha256)
+            media_content = MediaContent.objects.create(
+                user=user, blob=blob, content=blob.file.name, alt=session.alt,
+                original_width=original_width, original_height=original_height,
+            )
+            layout = session.layout
+            shapes, errors = get_shape_storage(layout).create(layout, [{
+                "type": "Image", "media_content": media_content.id, "width": session.width, "height": session.height
+            }])
+            if errors:
+                raise UploadError(errors[0])
+            session.delete()
+
+    os.unlink(path)
+    return shapes[0]
+
+
+def abort_session(session_id, user):
+    deleted, _ = UploadSession.objects.filter(pk=session_id, user=user).delete()
+    if deleted:
+        remove_part(session_id)
+    return bool(deleted)
+
+
+def remove_part(session_id):
+    try:
+        os.unlink(part_path(session_id))
+    except FileNotFoundError:
+        pass
+
+
+def collect_sessions(max_age=None):
+    """Delete the sessions untouched for max_age seconds and the part files left without a session."""
+    expired_before = timezone.now() - timedelta(seconds=UPLOAD_SESSION_EXPIRY if max_age is None else max_age)
+    expired = [str(session_id) for session_id in UploadSession.objects.filter(updated_at__lt=expired_before).values_list("id", flat=True)]
+    UploadSession.objects.filter(pk__in=expired).delete()
+    for session_id in expired:
+        remove_part(session_id)
+
+    root = get_sessions_root()
+    orphans = 0
+    if os.path.isdir(root):
+        part_ids = [name[:-len(".part")] for name in os.listdir(root) if name.endswith(".part") and is_session_id(name[:-len(".part")])]
+        live = {str(session_id) for session_id in UploadSession.objects.filter(pk__in=part_ids).values_list("id", flat=True)}
+        for session_id in part_ids:
+            if session_id not in live and os.path.getmtime(part_path(session_id)) < expired_before.timestamp():
+                remove_part(session_id)
+                orphans += 1
+    return len(expired) + orphans
+
+
+def is_session_id(value):
+    try:
+        return str(uuid.UUID(value)) == value
+    except ValueError:
+        return False
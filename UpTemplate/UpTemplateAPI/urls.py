@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .views import UserView, TemplateView, LayoutView, ShapeView, RectangleView, CircleView, MediaContentView
+from .views import UserView, TemplateView, LayoutView, ShapeView, RectangleView, CircleView, MediaContentView, UploadSessionView, ExportJobView
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_nested import routers
@@ -18,6 +18,8 @@ layout_router.register(r'shapes', ShapeView, basename="layout-shape")
 router.register(r'rectangles', RectangleView)
 router.register(r'circles', CircleView)
 router.register(r'medias', MediaContentView)
+router.register(r'uploads', UploadSessionView, basename='upload')
+router.register(r'jobs', ExportJobView, basename='export-job')
 
 
 urlpatterns = urlpatterns = router.urls + template_router.urls + layout_router.urls
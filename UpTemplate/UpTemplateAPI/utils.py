@@ -1,4 +1,5 @@
 from django.contrib.contenttypes.models import ContentType
+from functools import lru_cache
 import re
 
 
@@ -37,12 +38,72 @@ MODELS_TYPE_TO_FIELDS = {
 }
 
 
+CAMEL_TO_SNAKE_PATTERN = re.compile(r'(?<!^)(?=[A-Z])')
+SNAKE_TO_CAMEL_PATTERN = re.compile(r'_([a-zA-Z])')
+
+# Key translations of the model fields, filled by register_key_case
+CAMEL_TO_SNAKE_KEYS = {}
+SNAKE_TO_CAMEL_KEYS = {}
+
+KEY_CASE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=KEY_CASE_CACHE_SIZE)
+def convert_camel_to_snake(key):
+    return CAMEL_TO_SNAKE_PATTERN.sub('_', key).lower()
+
+
+@lru_cache(maxsize=KEY_CASE_CACHE_SIZE)
+def convert_snake_to_camel(key):
+    return SNAKE_TO_CAMEL_PATTERN.sub(lambda x: x.group(1).upper(), key) if key != "_id" else key
+
+
+def register_key_case(snake_keys):
+    for snake_key in snake_keys:
+        camel_key = convert_snake_to_camel(snake_key)
+        SNAKE_TO_CAMEL_KEYS[snake_key] = camel_key
+        CAMEL_TO_SNAKE_KEYS[camel_key] = convert_camel_to_snake(camel_key)
+        CAMEL_TO_SNAKE_KEYS[snake_key] = convert_camel_to_snake(snake_key)
+
+
+def camel_to_snake_key(key):
+    snake_key = CAMEL_TO_SNAKE_KEYS.get(key)
+    return snake_key if snake_key is not None else convert_camel_to_snake(key)
+
+
+def snake_to_camel_key(key):
+    camel_key = SNAKE_TO_CAMEL_KEYS.get(key)
+    return camel_key if camel_key is not None else convert_snake_to_camel(key)
+
+
 def camel_to_snake(dictionary):
-    snake_dict = {}
-    for key, value in dictionary.items():
-        snake_key = re.sub(r'(?<!^)(?=[A-Z])', '_', key).lower()
-        snake_dict[snake_key] = value
-    return snake_dict
+    return {camel_to_snake_key(key): value for key, value in dictionary.items()}
+
+
+def translate_keys(items, translate_key):
+    """Translates the keys of a whole list of dicts, resolving each distinct key once. Non-dict items are kept as is."""
+    translated = {}
+    result = []
+    for item in items:
+        if not isinstance(item, dict):
+            result.append(item)
+            continue
+        converted = {}
+        for key, value in item.items():
+            new_key = translated.get(key)
+            if new_key is None:
+                new_key = translated[key] = translate_key(key)
+            converted[new_key] = value
+        result.append(converted)
+    return result
+
+
+def camel_to_snake_list(items):
+    return translate_keys(items, camel_to_snake_key)
+
+
+def snake_to_camel_list(items):
+    return translate_keys(items, snake_to_camel_key)
 
 
 def flattern_to_nested(dictionary, fields, field_name):
@@ -4,17 +4,39 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import viewsets
 from django.contrib.auth.models import User
-from .models import Rectangle, Circle, Media, Shape, Template, Layout, Text, MediaContent
+from .models import Rectangle, Circle, Media, Shape, Template, Layout, Text, MediaContent, UploadSession, ExportJob
 from .serializers import (
     RectangleSerializer, CircleSerializer, MediaSerializer,
-    ShapeSerializer, TextSerializer, MediaContentSerializer,
-    UserSerializer, TemplateSerializer, LayoutSerializer, CLASSNAME_TO_MODELS, CONTENT_TYPE_TO_CLASSNAME
+    ShapeSerializer, ShapeOrderSerializer, ShapeArrangeSerializer, TextSerializer, MediaContentSerializer,
+    UserSerializer, TemplateSerializer, LayoutSerializer, UploadSessionSerializer, ExportJobSerializer,
+    CLASSNAME_TO_MODELS, CONTENT_TYPE_TO_CLASSNAME, dict_keys_snake_to_camel
 )
 from django.contrib.contenttypes.models import ContentType
 from rest_framework.exceptions import MethodNotAllowed
 from .utils import camel_to_snake, flattern_to_nested, clone_value_after_index
+from .loaders import load_template_tree
+from .storage import get_shape_storage, delete_layout, delete_template
+from .spatial import parse_box
+from .snapping import SNAP_DEFAULT_TOLERANCE, SNAP_MAX_TOLERANCE
+from .medias import template_media_contents, media_manifest
+from .images import get_derivative, source_format, InvalidImage, RENDER_FORMATS, MEDIA_RENDER_MAX_WIDTH
+from .conditional import make_etag
+from .exports import ExportError, export_template, png_size, EXPORT_FORMATS
+from django.http import FileResponse
+from django.db import transaction
+from .uploads import UploadError, start_session, write_chunk, finalize_session, abort_session
+from .jobs import JobError, start_job, schedule_jobs
+from .clones import clone_template, clone_layout
+from .pagination import KeysetPagination, ShapeKeysetPagination
+from .changes import build_change_feed
+from .cache import get_cached_template_document, set_cached_template_document
+from .conditional import (
+    conditional_response, set_validators, template_etag, template_list_etag, get_template_stamp
+)
 from rest_framework.decorators import action
+from django.shortcuts import get_object_or_404
 import json
+import math
 import traceback
 
 
@@ -23,12 +45,19 @@ class UserView(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [AllowAny]
+    pagination_class = KeysetPagination
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action == 'list':
+            kwargs.setdefault('fields', UserSerializer.requested_fields(self.request))
+        return super().get_serializer(*args, **kwargs)
 
 
 class TemplateView(viewsets.ModelViewSet):
     queryset = Template.objects.all()
     serializer_class = TemplateSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
 
     def create(self, request):
@@ -60,38 +89,156 @@ class TemplateView(viewsets.ModelViewSet):
         
         serializer.save() 
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+    def destroy(self, request, *args, **kwargs):
+        delete_template(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
         
     
 
     @action(detail=False, methods=['GET'])
     def mine(self, request):
-        return Response(TemplateSerializer(instance=Template.objects.filter(user=request.user) ,many=True).data)
+        templates = Template.objects.filter(user=request.user)
+        # Pages and field selections of the listing get their own validators
+        query = request.query_params.urlencode()
+        etag, last_modified = template_list_etag(templates, *([query] if query else []))
+        not_modified = conditional_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        fields = TemplateSerializer.requested_fields(request)
+        if fields is not None:
+            templates = templates.only(*[field.name for field in Template._meta.concrete_fields if field.name in fields])
+
+        page = self.paginate_queryset(templates)
+        data = TemplateSerializer(instance=templates if page is None else page, many=True, fields=fields).data
+        response = Response(data) if page is None else self.get_paginated_response(data)
+        return set_validators(response, etag, last_modified)
     
 
     @action(detail=True, methods=['GET'])
     def medias(self, request, pk=None):
-        images_shapes = Shape.objects.filter(layout__in=Layout.objects.filter(template=pk), content_type=3)
-        media_contents = [media.media_content for media in Media.objects.filter(pk__in=[image.shape_id for image in images_shapes])]
-        return Response(MediaContentSerializer(instance=media_contents, many=True).data, status=status.HTTP_200_OK)
+        template = get_template_stamp(pk)
+        etag = template_etag(template, "m")
+        not_modified = conditional_response(request, etag, template.updated_at)
+        if not_modified is not None:
+            return not_modified
+
+        media_contents = template_media_contents(pk)
+        return set_validators(Response(MediaContentSerializer(instance=media_contents, many=True).data, status=status.HTTP_200_OK), etag, template.updated_at)
+
+
+    @action(detail=True, methods=['GET'], url_path='medias/manifest')
+    def media_manifest(self, request, pk=None):
+        template = get_template_stamp(pk)
+        etag = template_etag(template, "mm")
+        not_modified = conditional_response(request, etag, template.updated_at)
+        if not_modified is not None:
+            return not_modified
+
+        manifest = media_manifest(template_media_contents(pk))
+        return set_validators(Response({"revision": template.revision, "medias": manifest}, status=status.HTTP_200_OK), etag, template.updated_at)
 
 
     @action(detail=True, methods=['GET'])
     def data(self, request, pk=None, *args, **kwargs):
-        template_serializer = TemplateSerializer(instance=Template.objects.get(pk=pk)).data
-        layouts = Layout.objects.filter(template=pk)
+        version, cached = get_cached_template_document(pk)
+        if cached is None:
+            template = Template.objects.get(pk=pk)
+            document, etag, last_modified = None, template_etag(template), template.updated_at
+        else:
+            document, etag, last_modified = cached
 
-        
-        layouts_data = LayoutSerializer(instance=layouts, many=True).data
+        # Answered from the revision stamp alone, before anything is serialized
+        not_modified = conditional_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        if document is None:
+            document = self.render_document(template)
+            set_cached_template_document(pk, version, (document, etag, last_modified))
+
+        return set_validators(Response(document), etag, last_modified)
+
+
+    @action(detail=True, methods=['GET'])
+    def export(self, request, pk=None):
+        template = get_object_or_404(Template, pk=pk)
+
+        fmt = request.query_params.get('fmt', 'svg')
+        if fmt not in EXPORT_FORMATS:
+            return Response({"fmt": [f"One of {', '.join(EXPORT_FORMATS)} is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        layout_id = request.query_params.get('layout')
+        if layout_id is not None:
+            if not layout_id.isdigit() or not Layout.objects.filter(pk=layout_id, template=template).exists():
+                return Response({"layout": ["A layout of the template is required."]}, status=status.HTTP_400_BAD_REQUEST)
+            layout_id = int(layout_id)
+
+        # SVG scales freely, only PNG has a pixel width
+        width = None
+        if fmt == 'png':
+            width = request.query_params.get('w')
+            if width is not None and (not width.isdigit() or not 0 < int(width) <= MEDIA_RENDER_MAX_WIDTH):
+                return Response({"w": [f"A width between 1 and {MEDIA_RENDER_MAX_WIDTH} is required."]}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                width, _ = png_size(template, int(width) if width is not None else None)
+            except ExportError as error:
+                return Response(error.errors, status=error.status_code)
+
+        etag = template_etag(template, "x", fmt, layout_id or "", width or "")
+        not_modified = conditional_response(request, etag, template.updated_at)
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            _, exported = export_template(template, fmt, layout_id, width, request.build_absolute_uri)
+        except ExportError as error:
+            return Response(error.errors, status=error.status_code)
+        response = FileResponse(exported, content_type=EXPORT_FORMATS[fmt], filename=f"{template.name or 'template'}.{fmt}")
+        return set_validators(response, etag, template.updated_at)
+
+
+    @action(detail=True, methods=['POST'])
+    def clone(self, request, pk=None):
+        template = get_object_or_404(Template, pk=pk)
+        name = request.data.get('name')
+        max_length = Template._meta.get_field('name').max_length
+        if name is not None and (not isinstance(name, str) or not 0 < len(name) <= max_length):
+            return Response({"name": [f"A name of at most {max_length} characters is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        copy = clone_template(template, request.user, name)
+        res = dict(TemplateSerializer(instance=copy, fields=TemplateSerializer.summary_fields).data)
+        res.update({"layouts": [{"_id": layout.id} for layout in copy.cloned_layouts]})
+        return Response(res, status=status.HTTP_201_CREATED)
 
-        res = {
+
+    @action(detail=True, methods=['GET'])
+    def changes(self, request, pk=None):
+        try:
+            since = int(request.query_params.get('since', 0))
+        except ValueError:
+            return Response({"since": ["A revision number is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        template = get_object_or_404(Template, pk=pk)
+        return Response(build_change_feed(template, since), status=status.HTTP_200_OK)
+
+
+    @staticmethod
+    def render_document(template):
+        template_serializer = TemplateSerializer(instance=template).data
+        context = load_template_tree([template])
+
+        layouts_data = LayoutSerializer(instance=template.loaded_layouts, many=True, context=context).data
+
+        return {
             "name": template_serializer["name"],
             "layouts": layouts_data,
             "stage_width": template_serializer["width"],
-            "stage_height": template_serializer["height"]
+            "stage_height": template_serializer["height"],
+            "revision": template.revision
         }
-
-
-        return Response(res)
     
 
 def get_model_fields(model):
@@ -139,132 +286,328 @@ class MediaContentView(viewsets.ModelViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         image_content_instance = serializer.save()
-        
-        
-        media_data = {
+
+        layout = get_object_or_404(Layout.objects.only('id', 'template_id', 'storage'), pk=formatted_data['layout'])
+        shapes, errors = get_shape_storage(layout).create(layout, [{
+            "type": "Image",
             "media_content": image_content_instance.id,
             "width": float(formatted_data['width']),
             "height": float(formatted_data['height'])
-        }
-        image_serializer = MediaSerializer(data=media_data)
-        if not image_serializer.is_valid():
-            return Response(image_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        image_instance = image_serializer.save()
+        }])
+        if errors:
+            return Response(errors[0], status=status.HTTP_400_BAD_REQUEST)
 
-        shape_media_data = {
-            "content_type": CLASSNAME_TO_MODELS['Image']['content_type'],
-            "shape_id": image_instance.id,
-            "layout": formatted_data['layout']
-        }
+        return Response(shapes[0], status=status.HTTP_201_CREATED)
 
-        shape_serializer = ShapeSerializer(data=shape_media_data)
-        if not shape_serializer.is_valid():
-            return Response(shape_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        shape_serializer.save()
 
-        return Response(shape_serializer.data, status=status.HTTP_201_CREATED)
+    @action(detail=True, methods=['GET'])
+    def render(self, request, pk=None):
+        media_content = get_object_or_404(MediaContent, pk=pk)
+        if not media_content.content:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        width = request.query_params.get('w')
+        if width is not None:
+            if not width.isdigit() or not 0 < int(width) <= MEDIA_RENDER_MAX_WIDTH:
+                return Response({"w": [f"A width between 1 and {MEDIA_RENDER_MAX_WIDTH} is required."]}, status=status.HTTP_400_BAD_REQUEST)
+            width = int(width)
+
+        fmt = request.query_params.get('fmt')
+        if fmt is not None and fmt not in RENDER_FORMATS:
+            return Response({"fmt": [f"One of {', '.join(RENDER_FORMATS)} is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            fmt = fmt or source_format(media_content.content)
+            key, derivative = get_derivative(media_content.content, width, fmt)
+        except (InvalidImage, OSError):
+            return Response({"content": ["The media is not a readable image."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Derivatives of a file name never change, the storage does not reuse names
+        etag = make_etag("d", key)
+        not_modified = conditional_response(request, etag)
+        if not_modified is not None:
+            derivative.close()
+            return not_modified
+
+        response = FileResponse(derivative, content_type=RENDER_FORMATS[fmt][1])
+        response.headers["Cache-Control"] = "private, max-age=86400"
+        return set_validators(response, etag)
     
 
+# Detail routes of the UUID keyed viewsets, other ids are a 404 instead of a ValidationError of the lookup
+UUID_LOOKUP = '[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+
+
+class UploadSessionView(viewsets.ViewSet):
+    permission_classes = [IsAuthenticated]
+    lookup_value_regex = UUID_LOOKUP
+
+    def create(self, request):
+        serializer = UploadSessionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            session = start_session(request.user, serializer.validated_data)
+        except UploadError as error:
+            return Response(error.errors, status=error.status_code)
+        return Response(UploadSessionSerializer(instance=session).data, status=status.HTTP_201_CREATED)
+
+
+    def retrieve(self, request, pk=None):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        return Response(UploadSessionSerializer(instance=session).data)
+
+
+    def update(self, request, pk=None):
+        content_length = request.META.get('CONTENT_LENGTH')
+        try:
+            # Read block by block from the request body, request.data is never parsed
+            session = write_chunk(
+                pk, request.user, request.META.get('HTTP_CONTENT_RANGE'),
+                int(content_length) if content_length else None, request.stream
+            )
+        except UploadError as error:
+            return Response(error.errors, status=error.status_code)
+        return Response(UploadSessionSerializer(instance=session).data)
+
+
+    @action(detail=True, methods=['POST'])
+    def finalize(self, request, pk=None):
+        try:
+            shape = finalize_session(pk, request.user)
+        except UploadError as error:
+            return Response(error.errors, status=error.status_code)
+        return Response(shape, status=status.HTTP_201_CREATED)
+
+
+    def destroy(self, request, pk=None):
+        if not abort_session(pk, request.user):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ExportJobView(viewsets.ViewSet):
+    permission_classes = [IsAuthenticated]
+    lookup_value_regex = UUID_LOOKUP
+
+    def create(self, request):
+        serializer = ExportJobSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            job = start_job(request.user, serializer.validated_data, request.build_absolute_uri('/'))
+        except JobError as error:
+            return Response(error.errors, status=error.status_code)
+        return Response(ExportJobSerializer(instance=job, context={'request': request}).data, status=status.HTTP_202_ACCEPTED)
+
+
+    def list(self, request):
+        jobs = ExportJob.objects.filter(user=request.user).order_by('-created_at')
+        return Response(ExportJobSerializer(instance=jobs, many=True, context={'request': request}).data)
+
+
+    def retrieve(self, request, pk=None):
+        job = get_object_or_404(ExportJob, pk=pk, user=request.user)
+        if job.status == ExportJob.QUEUED:
+            # Picks up the jobs queued before a restart of the process
+            schedule_jobs()
+            job.refresh_from_db()
+        return Response(ExportJobSerializer(instance=job, context={'request': request}).data)
+
+
+    @action(detail=True, methods=['GET'])
+    def artifact(self, request, pk=None):
+        job = get_object_or_404(ExportJob, pk=pk, user=request.user)
+        if job.status != ExportJob.DONE or not job.artifact:
+            return Response({"status": job.status}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(job.artifact.open('rb'), content_type='application/zip', as_attachment=True, filename=f"export-{job.id}.zip")
+
+
 class ShapeView(viewsets.ModelViewSet):
     queryset = Shape.objects.all()
     serializer_class = ShapeSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ShapeKeysetPagination
+
+    @staticmethod
+    def get_layout(layout_id):
+        return get_object_or_404(Layout.objects.only('id', 'template_id', 'storage', 'shapes_document'), pk=layout_id)
+
 
     @classmethod
     def create_shape(cls, data, serializer_class):
+        layout = cls.get_layout(data.pop("layout", None))
+        shape_type = next(classname for classname, model_data in CLASSNAME_TO_MODELS.items() if model_data["serializer"] is serializer_class)
+
+        shapes, errors = get_shape_storage(layout).create(layout, [{**data, "type": shape_type}])
+        if errors:
+            return Response(errors[0], status=status.HTTP_400_BAD_REQUEST)
 
-        layout_id = data.pop("layout", None)
+        return Response(shapes[0], status=status.HTTP_201_CREATED)
+            
 
-        generic_shape_serializer = serializer_class(data=data)
+    def list(self, request, *args, **kwargs):
+        """?bbox=x0,y0,x1,y1 keeps the shapes whose bounding box overlaps the box"""
+        bbox = request.query_params.get('bbox')
+        if bbox is not None:
+            try:
+                bbox = parse_box(bbox)
+            except ValueError:
+                return Response({"bbox": ["Expected x0,y0,x1,y1."]}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not generic_shape_serializer.is_valid():
-            return Response(generic_shape_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        generic_shape = generic_shape_serializer.save()
+        layout = self.get_layout(kwargs['layout_pk'])
+        if not self.paginator.requested(request):
+            return Response(get_shape_storage(layout).representations(layout, bbox=bbox))
 
-        shape_dict = {
-            "layout": layout_id,
-            "content_type": ContentType.objects.get_for_model(generic_shape).id,
-            "shape_id": generic_shape.id,
-            "object": generic_shape.id,
-        }
-        shape_serializer = ShapeSerializer(data=shape_dict)
+        shapes = get_shape_storage(layout).paginate(
+            layout, lambda source: self.paginator.paginate_queryset(source, request, self), bbox=bbox
+        )
+        return self.get_paginated_response(shapes)
 
-        if shape_serializer.is_valid():
-            shape_serializer.save()
-            return Response(shape_serializer.data, status=status.HTTP_201_CREATED)
 
-        return Response(shape_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-            
+    @action(detail=False, methods=['GET'])
+    def hit(self, request, *args, **kwargs):
+        """?x=&y= shapes under the point, topmost first"""
+        try:
+            x, y = float(request.query_params['x']), float(request.query_params['y'])
+        except (KeyError, ValueError):
+            return Response({"non_field_errors": ["Expected numeric x and y."]}, status=status.HTTP_400_BAD_REQUEST)
+        if not (math.isfinite(x) and math.isfinite(y)):
+            return Response({"non_field_errors": ["Expected numeric x and y."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        layout = self.get_layout(kwargs['layout_pk'])
+        return Response(get_shape_storage(layout).hit_test(layout, x, y))
+
+
+    @action(detail=False, methods=['GET'])
+    def snap(self, request, *args, **kwargs):
+        """?box=x0,y0,x1,y1[&tolerance=][&exclude=id,...] snapping guide candidates of the box, nearest first"""
+        try:
+            box = parse_box(request.query_params.get('box', ''))
+        except ValueError:
+            return Response({"box": ["Expected x0,y0,x1,y1."]}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            tolerance = float(request.query_params.get('tolerance', SNAP_DEFAULT_TOLERANCE))
+        except ValueError:
+            tolerance = math.nan
+        if not 0 <= tolerance <= SNAP_MAX_TOLERANCE:
+            return Response({"tolerance": [f"Expected a number from 0 to {SNAP_MAX_TOLERANCE}."]}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            exclude = [int(shape_id) for shape_id in request.query_params.get('exclude', '').split(',') if shape_id]
+        except ValueError:
+            return Response({"exclude": ["Expected shape ids."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        layout = self.get_layout(kwargs['layout_pk'])
+        return Response(get_shape_storage(layout).snap(layout, box, tolerance, exclude))
+
 
     def create(self, request, *args, **kwargs):
-        layout_id = kwargs['layout_pk']
+        layout = self.get_layout(kwargs['layout_pk'])
 
-        request_data = request.data
-        request_data = camel_to_snake(request_data)
-        shape_type = request_data.pop('type', None)
-        model_data = CLASSNAME_TO_MODELS.get(shape_type, None)
-        if not model_data:
+        if request.data.get('type', None) not in CLASSNAME_TO_MODELS:
             return Response("Error")
 
-        data_object = dict()
-        for field in model_data["fields"]:
-            data_object[field] = request_data.pop(field, None)
-        
-        serializer_class = model_data["serializer"]
-        serializer = serializer_class(data=data_object)
+        shapes, errors = get_shape_storage(layout).create(layout, [request.data])
+        if errors:
+            return Response(errors[0], status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(shapes[0], status=status.HTTP_201_CREATED)
+    
+
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request, *args, **kwargs):
+        layout = self.get_layout(kwargs['layout_pk'])
+        if not isinstance(request.data, list):
+            return Response({"non_field_errors": ["Expected a list of shapes."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        shapes, errors = get_shape_storage(layout).create(layout, request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(shapes, status=status.HTTP_201_CREATED)
+
+
+    @action(detail=False, methods=['PATCH'])
+    def transform(self, request, *args, **kwargs):
+        layout = self.get_layout(kwargs['layout_pk'])
+        if not isinstance(request.data, list):
+            return Response({"non_field_errors": ["Expected a list of transforms."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        updated, errors = get_shape_storage(layout).update(layout, request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"updated": updated}, status=status.HTTP_200_OK)
+
+
+    @action(detail=True, methods=['POST'])
+    def order(self, request, *args, **kwargs):
+        """{"position": "front" | "back"} or {"position": "after" | "before", "target": shape id}"""
+        serializer = ShapeOrderSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        obj = serializer.save()
 
+        layout = self.get_layout(kwargs['layout_pk'])
+        shape, errors = get_shape_storage(layout).reorder(layout, int(kwargs['pk']), **serializer.validated_data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        shape_dict = {
-            "layout": layout_id,
-            "content_type": ContentType.objects.get_for_model(obj).id,
-            "shape_id": obj.id,
-            "object": obj.id,
-        }
-        request_data["draggable"] = str(request_data["draggable"])
-        shape_dict.update(request_data)
-        shape_dict = camel_to_snake(shape_dict)
-        print('--->', shape_dict)
-        shape_serializer = ShapeSerializer(data=shape_dict) 
-        
-        if shape_serializer.is_valid():
-            shape_serializer.save()
-            return Response(shape_serializer.data, status=status.HTTP_201_CREATED)
+        return Response(shape, status=status.HTTP_200_OK)
+
+
+    def retrieve(self, request, *args, **kwargs):
+        template = get_template_stamp(kwargs['template_pk'])
+        etag = template_etag(template, "s", kwargs['pk'])
+        not_modified = conditional_response(request, etag, template.updated_at)
+        if not_modified is not None:
+            return not_modified
+
+        layout = self.get_layout(kwargs['layout_pk'])
+        shape = get_shape_storage(layout).get(layout, int(kwargs['pk']))
+        if shape is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return set_validators(Response(shape), etag, template.updated_at)
 
-        return Response(shape_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    
 
     def update(self, request, *args, **kwargs):
         request_data = request.data
         request_data["draggable"] = str(request_data["draggable"])
         
         snake_case_data = camel_to_snake(request_data)
-        print(request_data)
 
-        shape_instance = Shape.objects.get(pk=kwargs['pk'])
-        fields = [field.name for field in shape_instance.content_object._meta.fields if field.name != "id"]
+        layout = self.get_layout(kwargs['layout_pk'])
+        # Conditional PUT: stale writes are rejected from the revision stamp alone
+        conditional = 'HTTP_IF_MATCH' in request.META
+        with transaction.atomic():
+            if conditional:
+                # Checked on the locked rows, in the layout then template order writes lock them in:
+                # a concurrent write with the same ETag waits for this one, then fails the check
+                list(Layout.objects.select_for_update().filter(pk=layout.id).values_list('pk', flat=True))
+                template = get_template_stamp(kwargs['template_pk'], for_update=True)
+                precondition_failed = conditional_response(request, template_etag(template, "s", kwargs['pk']))
+                if precondition_failed is not None:
+                    return precondition_failed
 
-        snake_case_data = flattern_to_nested(snake_case_data, fields, "updated_object")
-        nested_object_data = snake_case_data.pop('updated_object')
-        nested_serializer = CLASSNAME_TO_MODELS[CONTENT_TYPE_TO_CLASSNAME[str(shape_instance.content_type.id)]]["serializer"]
+            shape, errors = get_shape_storage(layout).replace(layout, int(kwargs['pk']), snake_case_data)
+            if errors:
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        updated_nested_object = nested_serializer(shape_instance.content_object, data=nested_object_data)
-        if updated_nested_object.is_valid():
-            updated_nested_object.save()
+            response = Response(shape, status=status.HTTP_200_OK)
+            if conditional:
+                template = get_template_stamp(kwargs['template_pk'])
+                set_validators(response, template_etag(template, "s", kwargs['pk']), template.updated_at)
+        return response
 
 
-        serializer = ShapeSerializer(instance=shape_instance, data=snake_case_data)
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-            
-        serializer.save()
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def destroy(self, request, *args, **kwargs):
+        layout = self.get_layout(kwargs['layout_pk'])
+        if not get_shape_storage(layout).delete(layout, int(kwargs['pk'])):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class LayoutView(viewsets.ModelViewSet):
@@ -272,6 +615,48 @@ class LayoutView(viewsets.ModelViewSet):
     serializer_class = LayoutSerializer
     permission_classes = [IsAuthenticated]
 
+    def retrieve(self, request, *args, **kwargs):
+        template = get_template_stamp(kwargs['template_pk'])
+        etag = template_etag(template, "l", kwargs['pk'])
+        not_modified = conditional_response(request, etag, template.updated_at)
+        if not_modified is not None:
+            return not_modified
+
+        return set_validators(super().retrieve(request, *args, **kwargs), etag, template.updated_at)
+
+
+    def destroy(self, request, *args, **kwargs):
+        delete_layout(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+    @action(detail=True, methods=['POST'])
+    def arrange(self, request, *args, **kwargs):
+        """{"shapes": [ids], "operation": "align" | "distribute" | "transform", ...}, see ShapeArrangeSerializer"""
+        serializer = ShapeArrangeSerializer(data=camel_to_snake(request.data) if isinstance(request.data, dict) else request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        options = dict(serializer.validated_data)
+        layout = get_object_or_404(
+            Layout.objects.only('id', 'template_id', 'storage', 'shapes_document'), pk=kwargs['pk'], template=kwargs['template_pk']
+        )
+        updates, errors = get_shape_storage(layout).arrange(layout, options.pop('shapes'), **options)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            "updated": [update["id"] for update in updates],
+            "transforms": [dict_keys_snake_to_camel(update) for update in updates],
+        }, status=status.HTTP_200_OK)
+
+
+    @action(detail=True, methods=['POST'])
+    def clone(self, request, *args, **kwargs):
+        layout = get_object_or_404(Layout, pk=kwargs['pk'], template=kwargs['template_pk'])
+        copy = clone_layout(layout)
+        return Response(LayoutSerializer(instance=copy).data, status=status.HTTP_201_CREATED)
+
 
         
 